@@ -1,7 +1,7 @@
 import os
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from app.database import ProfiledSQLAlchemy
 
 STATIC_FILE_DIRECTORY = "static"
 TEMPLATE_DIRECTORY = "templates"
@@ -12,17 +12,83 @@ app.config.from_mapping(
     SECRET_KEY="dev",
     SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(basedir, "app.db"),
     SQLALCHEMY_TRACK_MODIFICATIONS = False,
+    # PRAGMAs used for SQLite connections, "default" or "concurrent" (WAL, see app/database.py)
+    DATABASE_PROFILE="default",
+    # Extra PRAGMAs applied on top of the profile e.g. { "busy_timeout": 20000 }
+    SQLITE_PRAGMAS={},
+    # Connection pool settings, None uses the SQLAlchemy defaults (SQLite files only use a pool if DATABASE_POOL_SIZE is set)
+    DATABASE_POOL_SIZE=None,
+    DATABASE_MAX_OVERFLOW=None,
+    DATABASE_POOL_TIMEOUT=None,
+    DATABASE_POOL_RECYCLE=None,
+    # Number of seconds before the cached puzzle ids are reloaded from the database
+    PUZZLE_INDEX_TTL=300,
+    # Number of seconds before the in-memory leaderboard is reloaded from the database
+    LEADERBOARD_TTL=60,
+    # Default and largest number of puzzles in a page of GET /api/puzzles, and the number of rows fetched at a time when streaming NDJSON
+    PUZZLES_PAGE_SIZE=100,
+    PUZZLES_MAX_PAGE_SIZE=1000,
+    PUZZLES_STREAM_BATCH_SIZE=500,
+    # Read the stats page performance from the LessonPerformance totals instead of aggregating PuzzleCompletion
+    USE_PERFORMANCE_SUMMARY=True,
+    # Maximum number of users kept in the user cache and the number of seconds before an entry is reloaded
+    USER_CACHE_SIZE=10000,
+    USER_CACHE_TTL=30,
+    # Number of seconds an API token is valid for
+    API_TOKEN_MAX_AGE=3600,
+    # Queue puzzle completions and save them in batches from a background thread instead of one commit per request
+    # A request only saves the queue of its own worker before reading, so write-behind requires WORKER_PROCESSES=1
+    COMPLETION_WRITE_BEHIND=False,
+    # Number of queued completions that triggers a batch, the longest a completion waits (seconds) and the size of the queue
+    COMPLETION_BATCH_SIZE=100,
+    COMPLETION_FLUSH_INTERVAL=1.0,
+    COMPLETION_QUEUE_SIZE=10000,
+    # Count and time the SQL queries of each request (Server-Timing header and per-endpoint totals)
+    SQL_INSTRUMENTATION=True,
+    # Requests slower than this (in milliseconds) are logged with their slowest queries
+    SLOW_REQUEST_BUDGET_MS=500,
+    # Number of slowest queries kept per request and per endpoint
+    SLOW_QUERIES_KEPT=5,
+    # Directory where each worker writes its metrics (None uses instance/metrics) and how often (seconds) it is rewritten
+    METRICS_DIRECTORY=None,
+    METRICS_WRITE_INTERVAL=5,
+    # Tests started within this many seconds which haven't been finished count as active
+    ACTIVE_TEST_WINDOW=3600,
+    # Fraction of requests profiled with cProfile, admins can also profile a request by sending PROFILE_HEADER
+    PROFILE_SAMPLE_RATE=0.0,
+    PROFILE_HEADER="X-Profile",
+    # Directory of the profiles (None uses instance/profiles) and the number of newest profiles kept
+    PROFILE_DIRECTORY=None,
+    PROFILES_KEPT=50,
+    # Number of worker processes serving the app (gunicorn also reads WEB_CONCURRENCY for its number of workers)
+    WORKER_PROCESSES=int(os.environ.get("WEB_CONCURRENCY", 1)),
 )
+# Deployments can override the settings in instance/config.py or with environment variables
+app.config.from_pyfile("config.py", silent=True)
+if "DATABASE_URL" in os.environ:
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ["DATABASE_URL"]
+if "DATABASE_PROFILE" in os.environ:
+    app.config["DATABASE_PROFILE"] = os.environ["DATABASE_PROFILE"]
 os.makedirs(app.instance_path, exist_ok=True)
 
-db = SQLAlchemy(app)
+def check_config(config):
+    """ Raises ValueError for combinations of settings that can't work """
+    # Completions queued in another worker aren't saved by flush_user, so a test could be served or finished without them
+    if config["COMPLETION_WRITE_BEHIND"] and config["WORKER_PROCESSES"] > 1:
+        raise ValueError("COMPLETION_WRITE_BEHIND requires WORKER_PROCESSES=1, got {}".format(config["WORKER_PROCESSES"]))
+
+check_config(app.config)
+
+db = ProfiledSQLAlchemy(app)
 migrate = Migrate(app, db)
 
-from app import routes, auth
-from app.api import settings_api, lessons_api, puzzles_api, auth
+from app import routes, auth, instrumentation, metrics, profiling
+from app.api import settings_api, lessons_api, puzzles_api, tokens_api, metrics_api, auth
 from app.lessons import init
 
-from app.cli import init_db
+from app.cli import init_db, seed_load_command, puzzles_cli
 app.cli.add_command(init_db)
+app.cli.add_command(seed_load_command)
+app.cli.add_command(puzzles_cli)
 
 init()
@@ -1,7 +1,12 @@
 import functools
 
-from flask import g, jsonify
+from flask import g, jsonify, request
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from werkzeug.http import HTTP_STATUS_CODES
+from app import app
+from app.user_cache import UserSnapshot
+
+API_TOKEN_SALT = "api-token"
 
 def error_response(error_code, message=None):
     """ Utility function which returns an error as JSON """
@@ -14,24 +19,50 @@ def error_response(error_code, message=None):
     response.status_code = error_code
     return response
 
+def get_token_serializer():
+    return URLSafeTimedSerializer(app.config["SECRET_KEY"], salt=API_TOKEN_SALT)
+
+def generate_api_token(user):
+    """ Creates a signed token which identifies a user (or UserSnapshot) until it expires after API_TOKEN_MAX_AGE seconds """
+    return get_token_serializer().dumps({ "id": user.id, "username": user.username, "admin": user.is_admin })
+
+def load_api_token(token):
+    """ Returns a UserSnapshot from a token, or None if the token is invalid or has expired
+    Settings are not stored in the token so the snapshot's settings are None.
+    """
+    try:
+        data = get_token_serializer().loads(token, max_age=app.config["API_TOKEN_MAX_AGE"])
+    except BadSignature:
+        return None
+    return UserSnapshot(id=data["id"], username=data["username"], is_admin=data["admin"], settings=None)
+
+def authenticate_api_request():
+    """ Assigns g.user_snapshot from the request's bearer token if it has one (no session or database access), returns the snapshot """
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        g.user_snapshot = load_api_token(authorization[len("Bearer "):])
+    return g.user_snapshot
+
 def api_login_required(view):
     """ Decorator that ensures someone is authenticated via the API
-    For now uses same authentication as normal login but could be extended to support tokens.
+    Accepts either a bearer token (see generate_api_token) or the same session as normal login.
+    Views should use g.user_snapshot (cached) rather than g.user (database query) where possible.
     """
     @functools.wraps(view)
     def wrapped_view(**kwargs):
-        if (not "user" in g) or g.user is None:
+        if authenticate_api_request() is None:
             return error_response(401)
         return view(**kwargs)
     return wrapped_view
 
 def api_admin_login_required(view):
     """ Decorator that ensures someone is authenticated via the API and is an admin user
-    For now uses same authentication as normal login but could be extended to support tokens.
+    Accepts either a bearer token (see generate_api_token) or the same session as normal login.
     """
     @functools.wraps(view)
     def wrapped_view(**kwargs):
-        if (not "user" in g) or g.user is None or (not g.user.is_admin):
+        snapshot = authenticate_api_request()
+        if snapshot is None or (not snapshot.is_admin):
             return error_response(403)
         return view(**kwargs)
     return wrapped_view
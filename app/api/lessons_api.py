@@ -75,7 +75,7 @@ def lesson_api(lesson_id):
         if completed_test is not None and not is_valid_complete(completed_test):
             return error_response(400, "Invalid value for field 'completed_test'")
 
-        update_lesson_completion(lesson_id, g.user.id, progression=progression, completed_lesson=completed_lesson, completed_test=completed_test)
+        update_lesson_completion(lesson_id, g.user_snapshot.id, progression=progression, completed_lesson=completed_lesson, completed_test=completed_test)
         return jsonify({"status": "Ok"})
 
     # Convert lesson to JSON
@@ -87,10 +87,9 @@ def lesson_api(lesson_id):
         "completed_lesson": False,
         "progression": 0
     }
-    for lesson in g.user.lessons:
-        if lesson.lesson_id == lesson_id:
-            lesson_data["completed_lesson"] = lesson.completed_lesson
-            lesson_data["completed_test"] = lesson.completed_test
-            lesson_data["progression"] = lesson.progression
-            break
+    completion = LessonCompletion.query.filter_by(lesson_id=lesson_id, user=g.user_snapshot.id).first()
+    if completion is not None:
+        lesson_data["completed_lesson"] = completion.completed_lesson
+        lesson_data["completed_test"] = completion.completed_test
+        lesson_data["progression"] = completion.progression
     return jsonify({ "lesson": lesson_data })
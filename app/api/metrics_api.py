@@ -0,0 +1,19 @@
+import datetime
+
+from flask import Response
+from app import app
+from app.api.auth import api_admin_login_required
+from app.models import Test
+from app.metrics import read_fleet_snapshots, merge_snapshots, format_prometheus
+
+def get_num_active_tests():
+    """ Returns the number of final tests started in the last ACTIVE_TEST_WINDOW seconds that haven't been finished """
+    start_time = datetime.datetime.now() - datetime.timedelta(seconds=app.config["ACTIVE_TEST_WINDOW"])
+    return Test.query.filter(Test.end_time==None, Test.start_time >= start_time).count()
+
+@app.route("/api/admin/metrics")
+@api_admin_login_required
+def metrics_api():
+    """ API route which serves the request metrics of every worker in the Prometheus text format """
+    merged = merge_snapshots(read_fleet_snapshots())
+    return Response(format_prometheus(merged, get_num_active_tests()), mimetype="text/plain; version=0.0.4")
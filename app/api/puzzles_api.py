@@ -1,15 +1,25 @@
 from logging import error
-import random
 import datetime
+import json
+import math
+import re
 
 from app.lessons import LESSONS_BY_ID
-from flask import jsonify, g, request
+from flask import jsonify, g, request, Response, stream_with_context
 from app import app, db
 from app.api.auth import api_admin_login_required, api_login_required, error_response
-from app.models import Puzzle, PuzzleCompletion, Test
+from app.models import Puzzle, PuzzleCompletion, Test, User, LessonPerformance
+from app.puzzle_selection import puzzle_index, create_test_plan
+from app.leaderboard import leaderboard
+from app.completion_writer import completion_writer, record_completions
+from app.move_trees import decode_move_tree
+from app.puzzle_verification import verify_puzzle, has_errors, ISSUE_ERROR
 from flask_sqlalchemy import sqlalchemy
 
 PUZZLES_PER_TEST = 10
+# Promotion piece types of a move (knight, bishop, rook, queen), -1 for no promotion
+PROMOTION_PIECES = (-1, 1, 2, 3, 4)
+FEN_RANK_PATTERN = re.compile(r"[pnbrqkPNBRQK1-8]+")
 
 def validate_puzzle_data(puzzle):
     """ Validate puzzle data from client """
@@ -17,17 +27,99 @@ def validate_puzzle_data(puzzle):
         return False
     return "fen" in puzzle and "move_tree" in puzzle and "is_atomic" in puzzle and "lesson_id" in puzzle
 
+def validate_fen(fen):
+    """ Validate the structure of a FEN, the halfmove clock and fullmove number are optional """
+    if not isinstance(fen, str):
+        return False
+    fields = fen.split(" ")
+    if len(fields) not in (4, 6):
+        return False
+    ranks = fields[0].split("/")
+    if len(ranks) != 8 or not all(FEN_RANK_PATTERN.fullmatch(rank) and sum(int(c) if c.isdigit() else 1 for c in rank) == 8 for rank in ranks):
+        return False
+    if fields[1] not in ("w", "b") or not re.fullmatch(r"-|(?=.)K?Q?k?q?", fields[2]) or not re.fullmatch(r"-|[a-h][36]", fields[3]):
+        return False
+    return all(field.isdigit() for field in fields[4:])
+
+def validate_move(move):
+    """ Validate a move object """
+    if not isinstance(move, dict) or set(move) != { "from", "to", "promotion" } or not all(type(value) is int for value in move.values()):
+        return False
+    return 0 <= move["from"] < 64 and 0 <= move["to"] < 64 and move["promotion"] in PROMOTION_PIECES
+
+def validate_move_tree(move_tree):
+    """ Validate the structure of a move tree: a non-empty list of nodes with a move and optionally a continuation (a move tree) """
+    if not isinstance(move_tree, list) or not move_tree:
+        return False
+    for node in move_tree:
+        if not isinstance(node, dict) or "move" not in node or set(node) - { "move", "continuation" } or not validate_move(node["move"]):
+            return False
+        if "continuation" in node and not validate_move_tree(node["continuation"]):
+            return False
+    return True
+
+def validate_puzzle_record(puzzle):
+    """ Validate a puzzle being imported, which is checked more strictly than puzzles from the client """
+    if not isinstance(puzzle, dict) or not validate_puzzle_data(puzzle):
+        return False
+    return (validate_fen(puzzle["fen"]) and validate_move_tree(puzzle["move_tree"])
+        and isinstance(puzzle["is_atomic"], bool) and type(puzzle["lesson_id"]) is int and puzzle["lesson_id"] in LESSONS_BY_ID)
+
+def validate_timestamps(start_time, end_time):
+    """ Validate the start and end times of a completion, in milliseconds since the epoch """
+    for timestamp in (start_time, end_time):
+        if type(timestamp) not in (int, float) or not math.isfinite(timestamp):
+            return False
+        try:
+            datetime.datetime.fromtimestamp(timestamp / 1000)
+        except (OverflowError, OSError, ValueError):
+            return False
+    return end_time >= start_time
+
 def validate_completion_data(data):
     """ Validate completion data """
     if data is None:
         return False
-    return "attempts" in data and "start_time" in data and "end_time" in data and "test_id" in data
+    if not ("attempts" in data and "start_time" in data and "end_time" in data and "test_id" in data):
+        return False
+    # Accuracy is 1 / attempts, so a completion takes at least one attempt
+    return type(data["attempts"]) is int and data["attempts"] >= 1 and validate_timestamps(data["start_time"], data["end_time"])
 
-def get_all_puzzles(lesson_id=None):
-    """ Returns all puzzles for a given lesson, if lesson_id==None, returns all puzzles """
-    if lesson_id is None:
-        return Puzzle.query.all()
-    return Puzzle.query.filter_by(lesson_id=lesson_id).all()
+def validate_test_completion_data(data):
+    """ Validate an item of a batch of completions for a test """
+    if not isinstance(data, dict) or not all(key in data for key in ("puzzle_id", "attempts", "start_time", "end_time")):
+        return False
+    return (type(data["puzzle_id"]) is int and type(data["attempts"]) is int and data["attempts"] >= 1
+        and validate_timestamps(data["start_time"], data["end_time"]))
+
+def get_puzzle_rows(lesson_id=None, after_id=0):
+    """ Returns a query of the puzzles (for a given lesson) with an id greater than after_id in order of id """
+    query = db.session.query(Puzzle.id, Puzzle.fen, Puzzle.move_tree_data, Puzzle.is_atomic, Puzzle.lesson_id).filter(Puzzle.id>after_id)
+    if lesson_id is not None:
+        query = query.filter(Puzzle.lesson_id==lesson_id)
+    return query.order_by(Puzzle.id)
+
+def puzzle_row_to_json(row):
+    """ Same as Puzzle.to_json for a row of get_puzzle_rows """
+    return {
+        "id": row.id,
+        "fen": row.fen,
+        "move_tree": decode_move_tree(row.move_tree_data),
+        "is_atomic": row.is_atomic,
+        "lesson_id": row.lesson_id,
+    }
+
+def generate_puzzles_ndjson(query):
+    """ Yields the rows of a query as lines of JSON, fetching them in batches from the cursor """
+    batch_size = app.config["PUZZLES_STREAM_BATCH_SIZE"]
+    lines = []
+    for row in query.execution_options(stream_results=True).yield_per(batch_size):
+        lines.append(json.dumps(puzzle_row_to_json(row), separators=(",", ":")) + "\n")
+        if len(lines) >= batch_size:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
 
 def get_incomplete_puzzles_for_test(test_id, user_id):
     query = Puzzle.query.outerjoin(PuzzleCompletion, (Puzzle.id==PuzzleCompletion.puzzle_id) & (PuzzleCompletion.test_number==test_id) & (PuzzleCompletion.user==user_id)).filter(PuzzleCompletion.id==None)
@@ -42,40 +134,125 @@ def random_puzzle_api():
     """ API route which serves a random puzzle
     Accepts a query parameter ?lesson to select puzzles for a given lesson
     """
-    lesson_id = request.args.get("lesson")
-    puzzles = get_all_puzzles(lesson_id=lesson_id)
-    if len(puzzles) > 0:
-        return jsonify({ "puzzle": random.choice(puzzles).to_json() })
+    lesson_id = request.args.get("lesson", type=int)
+    if lesson_id is None and "lesson" in request.args:
+        return jsonify({ "puzzle": None })
+    puzzle = puzzle_index.random_puzzle(lesson_id=lesson_id)
+    if puzzle is not None:
+        return jsonify({ "puzzle": puzzle.to_json() })
     return jsonify({ "puzzle": None })
 
 @app.route("/api/puzzles/test/<int:test_id>")
 @api_login_required
 def random_test_puzzle_api(test_id):
-    """ API route which serves a random puzzle that hasn't been completed by the current user """
+    """ API route which serves the current puzzle from the plan of a final test
+    Accepts a query parameter ?position to serve a later puzzle of the plan while completions are buffered by the client
+    """
+    # The test is only advanced once the user's completions are saved
+    completion_writer.flush_user(g.user_snapshot.id)
     test = Test.query.get(test_id)
+    if test is None:
+        return error_response(404)
     # Ensure that the request is from the correct user
-    if test.user != g.user.id:
+    if test.user != g.user_snapshot.id:
         return error_response(401)
-    puzzles = get_incomplete_puzzles_for_test(test_id, g.user.id)
-    if len(puzzles) > 0:
-        return jsonify({ "puzzle": random.choice(puzzles).to_json(), "is_final": len(get_unique_puzzle_completions_for_test(test_id, g.user.id)) >= (PUZZLES_PER_TEST - 1) })
+    if test.puzzle_plan is None:
+        # Tests started before plans existed: keep the puzzles already completed (at most a plan's worth) and choose the rest
+        completed_ids = [completion.puzzle_id for completion in get_unique_puzzle_completions_for_test(test_id, g.user_snapshot.id)][:PUZZLES_PER_TEST]
+        test.puzzle_plan = completed_ids + create_test_plan(max(0, PUZZLES_PER_TEST - len(completed_ids)), exclude_ids=completed_ids)
+        test.completed_puzzles = len(completed_ids)
+        db.session.commit()
+    requested_position = request.args.get("position", type=int)
+    while True:
+        if requested_position is None:
+            position = test.completed_puzzles
+            puzzle_id = test.get_current_puzzle_id()
+            is_final = test.is_final_puzzle()
+        else:
+            position = requested_position
+            puzzle_id = test.puzzle_plan[position] if 0 <= position < len(test.puzzle_plan) else None
+            is_final = position >= len(test.puzzle_plan) - 1
+        puzzle = Puzzle.query.get(puzzle_id) if puzzle_id is not None else None
+        if puzzle is not None or puzzle_id is None or position < test.completed_puzzles:
+            break
+        # The puzzle was deleted after the plan was made, replace it (or drop it if there are no other puzzles) so the test can be finished
+        plan = list(test.puzzle_plan)
+        replacement = create_test_plan(1, exclude_ids=plan)
+        if replacement:
+            plan[position] = replacement[0]
+        else:
+            del plan[position]
+        test.puzzle_plan = plan
+        db.session.commit()
+    if puzzle is not None:
+        return jsonify({ "puzzle": puzzle.to_json(), "is_final": is_final, "position": position })
     return jsonify({ "puzzle": None, "is_final": True })
 
 @app.route("/api/tests/<int:test_id>", methods=["POST"])
 @api_login_required
 def test_api(test_id):
+    completion_writer.flush_user(g.user_snapshot.id)
     test = Test.query.filter_by(id=test_id).first()
     if test is not None:
         # Ensure the request is from the correct user
-        if test.user != g.user.id:
+        if test.user != g.user_snapshot.id:
             return error_response(401)
-        if len(get_unique_puzzle_completions_for_test(test_id, g.user.id)) >= PUZZLES_PER_TEST:
+        if test.is_complete():
             test.end_time = datetime.datetime.now()
+            time_taken = test.get_time_taken()
+            User.record_test_time(g.user_snapshot.id, time_taken)
             db.session.commit()
+            leaderboard.record(g.user_snapshot.id, time_taken)
             return jsonify({ "status": "Ok" })
         return error_response(403)
     return error_response(404)
 
+@app.route("/api/tests/<int:test_id>/completions", methods=["POST"])
+@api_login_required
+def test_completions_api(test_id):
+    """ API route which saves several puzzle completions of a test in one transaction
+    Expects { "completions": [{ "puzzle_id", "attempts", "start_time", "end_time" }, ...] } and returns the status of each item in order.
+    """
+    test = Test.query.get(test_id)
+    if test is None:
+        return error_response(404)
+    # Ensure the request is from the correct user
+    if test.user != g.user_snapshot.id:
+        return error_response(401)
+    data = request.get_json()
+    if not isinstance(data, dict) or not isinstance(data.get("completions"), list):
+        return error_response(400, message="Invalid JSON data")
+
+    valid_items = [item for item in data["completions"] if validate_test_completion_data(item)]
+    lesson_ids = dict(db.session.query(Puzzle.id, Puzzle.lesson_id).filter(Puzzle.id.in_({ item["puzzle_id"] for item in valid_items }))) if valid_items else {}
+    completions = []
+    results = []
+    for item in data["completions"]:
+        if not validate_test_completion_data(item):
+            results.append({ "status": "Invalid data" })
+        elif item["puzzle_id"] not in lesson_ids:
+            results.append({ "puzzle_id": item["puzzle_id"], "status": "Puzzle not found" })
+        else:
+            completions.append({
+                "user": g.user_snapshot.id,
+                "puzzle_id": item["puzzle_id"],
+                "lesson_id": lesson_ids[item["puzzle_id"]],
+                "attempts": item["attempts"],
+                "start_time": datetime.datetime.fromtimestamp(item["start_time"] / 1000),
+                "end_time": datetime.datetime.fromtimestamp(item["end_time"] / 1000),
+                "test_number": test_id,
+            })
+            results.append({ "puzzle_id": item["puzzle_id"], "status": "Ok" })
+
+    if completions:
+        if app.config["COMPLETION_WRITE_BEHIND"]:
+            for completion in completions:
+                completion_writer.add(completion)
+        else:
+            record_completions(completions)
+            db.session.commit()
+    return jsonify({ "results": results })
+
 @app.route("/api/puzzles/<int:puzzle_id>", methods=["POST"])
 @api_login_required
 def puzzle_api(puzzle_id):
@@ -84,16 +261,20 @@ def puzzle_api(puzzle_id):
     if puzzle is not None:
         data = request.get_json()
         if validate_completion_data(data):
-            completion = PuzzleCompletion(
-                user=g.user.id,
-                puzzle_id=puzzle_id,
-                attempts=data["attempts"],
-                start_time=datetime.datetime.fromtimestamp(data["start_time"] / 1000),
-                end_time=datetime.datetime.fromtimestamp(data["end_time"] / 1000),
-                test_number=data["test_id"],
-            )
-            db.session.add(completion)
-            db.session.commit()
+            completion = {
+                "user": g.user_snapshot.id,
+                "puzzle_id": puzzle_id,
+                "lesson_id": puzzle.lesson_id,
+                "attempts": data["attempts"],
+                "start_time": datetime.datetime.fromtimestamp(data["start_time"] / 1000),
+                "end_time": datetime.datetime.fromtimestamp(data["end_time"] / 1000),
+                "test_number": data["test_id"],
+            }
+            if app.config["COMPLETION_WRITE_BEHIND"]:
+                completion_writer.add(completion)
+            else:
+                record_completions([completion])
+                db.session.commit()
             return jsonify({ "status": "Ok" })
         return error_response(400)
     return error_response(404, message="Puzzle not found or already completed")
@@ -101,18 +282,43 @@ def puzzle_api(puzzle_id):
 @app.route("/api/puzzles", methods=["GET"])
 @api_login_required
 def puzzles_api():
-    """ API route which serves all puzzle data """
-    lesson_id = request.args.get("lesson")
-    puzzles = get_all_puzzles(lesson_id=lesson_id)
-    return jsonify({ "puzzles": list(map(lambda puzzle: puzzle.to_json(), puzzles)) })
+    """ API route which serves puzzle data a page at a time in order of id
+    Accepts query parameters ?lesson to select puzzles for a given lesson, ?limit for the size of the page
+    and ?after_id to continue from the next_after_id of the previous page (which is null on the last page)
+    With ?format=ndjson every puzzle after after_id (up to limit) is streamed as one JSON object per line
+    """
+    lesson_id = request.args.get("lesson", type=int)
+    after_id = request.args.get("after_id", 0, type=int)
+    limit = request.args.get("limit", type=int)
+    if (limit is not None and limit < 1) or ("limit" in request.args and limit is None):
+        return error_response(400, "limit must be a positive integer")
+    if lesson_id is None and "lesson" in request.args:
+        return jsonify({ "puzzles": [], "next_after_id": None })
+    query = get_puzzle_rows(lesson_id=lesson_id, after_id=after_id)
+
+    if request.args.get("format") == "ndjson":
+        if limit is not None:
+            query = query.limit(limit)
+        return Response(stream_with_context(generate_puzzles_ndjson(query)), mimetype="application/x-ndjson")
+
+    limit = min(limit or app.config["PUZZLES_PAGE_SIZE"], app.config["PUZZLES_MAX_PAGE_SIZE"])
+    # One extra row tells whether there is another page
+    rows = query.limit(limit + 1).all()
+    next_after_id = rows[limit - 1].id if len(rows) > limit else None
+    return jsonify({ "puzzles": [puzzle_row_to_json(row) for row in rows[:limit]], "next_after_id": next_after_id })
 
 @app.route("/api/puzzles", methods=["POST"])
 @api_admin_login_required
 @api_login_required
 def puzzles_post_api():
-    """ API route used to create a new puzzle from the create_puzzle page """
+    """ API route used to create a new puzzle from the create_puzzle page
+    The move tree is replayed from the FEN, puzzles with illegal moves are rejected and other issues are returned as warnings.
+    """
     data = request.get_json()
-    if validate_puzzle_data(data):
+    if validate_puzzle_record(data):
+        issues = verify_puzzle(data["fen"], data["move_tree"], data["is_atomic"])
+        if has_errors(issues):
+            return error_response(400, "; ".join(message for level, message in issues if level == ISSUE_ERROR))
         puzzle = Puzzle(
             fen=data["fen"],
             move_tree=data["move_tree"],
@@ -121,14 +327,16 @@ def puzzles_post_api():
         )
         db.session.add(puzzle)
         db.session.commit()
-        return jsonify({ "status": "Ok" })
+        puzzle_index.add_puzzle(puzzle)
+        return jsonify({ "status": "Ok", "warnings": [message for _, message in issues] })
     return error_response(400)
 
 @app.route("/api/stats/<int:test_id>", methods=["GET"])
 @api_login_required
 def get_stats(test_id):
+    completion_writer.flush_user(g.user_snapshot.id)
     test = Test.query.filter_by(id=test_id).first()
-    time_taken = round(test.end_time.timestamp() - test.start_time.timestamp(), 1)
+    time_taken = test.get_time_taken()
 
     total_accuracy = 0
     puzzles = PuzzleCompletion.query.filter_by(test_number=test_id).all()
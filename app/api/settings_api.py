@@ -1,6 +1,8 @@
 from flask import jsonify, g, request
 from app import app, db
 from app.api.auth import api_login_required, error_response
+from app.models import User
+from app.user_cache import user_cache
 
 DEFAULT_USER_SETTINGS = {
     "light_square_color": "#EEEEEE",
@@ -26,12 +28,21 @@ def get_settings():
         for key in DEFAULT_USER_SETTINGS:
             if key in data:
                 settings[key] = data[key]
-        g.user.settings = settings
+        # Updating the user invalidates their cached snapshot
+        user = User.query.get(g.user_snapshot.id)
+        # The user behind a token or cached snapshot may have been deleted
+        if user is None:
+            return error_response(401)
+        user.settings = settings
         db.session.commit()
         return error_response(200)
 
+    # Snapshots loaded from API tokens don't contain settings
+    snapshot = g.user_snapshot if g.user_snapshot.settings is not None else user_cache.get(g.user_snapshot.id)
+    if snapshot is None:
+        return error_response(401)
     # Return user settings - return default values if missing key
-    settings = { **DEFAULT_USER_SETTINGS, **g.user.settings }
+    settings = { **DEFAULT_USER_SETTINGS, **snapshot.settings }
     return jsonify({ "settings": settings })
 
 @app.route("/api/default_settings")
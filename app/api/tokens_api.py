@@ -0,0 +1,13 @@
+from flask import jsonify, g
+from app import app
+from app.api.auth import error_response, generate_api_token
+
+@app.route("/api/tokens", methods=["POST"])
+def tokens_api():
+    """ API route which issues a signed token for the logged in user
+    Send the token in an "Authorization: Bearer <token>" header to authenticate API requests without the session.
+    Tokens can only be issued from a session (not from another token) so they can't be renewed indefinitely.
+    """
+    if g.user_snapshot is None:
+        return error_response(401)
+    return jsonify({ "token": generate_api_token(g.user_snapshot), "expires_in": app.config["API_TOKEN_MAX_AGE"] })
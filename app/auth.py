@@ -1,21 +1,38 @@
 import functools
 import re
 
-from flask import render_template, abort, flash, redirect, request, url_for, session, g
+from flask import render_template, abort, flash, redirect, request, url_for, session, g, has_request_context
+from flask.ctx import _AppCtxGlobals
 from app import app, db
-from app.models import User, LessonCompletion
+from app.models import User, LessonCompletion, StatsCounter, STAT_NUM_USERS, STAT_NUM_CHESS_BEGINNERS
 from app.forms import SignUpForm, LoginForm
 from app.lessons import LESSON_INTRO
 from app.api.lessons_api import mark_lesson_complete
+from app.user_cache import user_cache
 from werkzeug.security import check_password_hash, generate_password_hash
 
+class AppGlobals(_AppCtxGlobals):
+    """ Globals object which resolves the logged in user the first time a view touches it
+    g.user is the User model (queried from the database), g.user_snapshot is a UserSnapshot from the user cache.
+    """
+    def __getattr__(self, name):
+        if name == "user":
+            user_id = session.get("current_user") if has_request_context() else None
+            self.user = User.query.get(user_id) if user_id is not None else None
+            return self.user
+        if name == "user_snapshot":
+            user_id = session.get("current_user") if has_request_context() else None
+            self.user_snapshot = user_cache.get(user_id) if user_id is not None else None
+            return self.user_snapshot
+        raise AttributeError(name)
+
+app.app_ctx_globals_class = AppGlobals
+
 @app.before_request
-def load_logged_in_user():
-    user_id = session.get("current_user")
-    if user_id is None:
-        g.user = None
-    else:
-        g.user = User.query.get(user_id)
+def reset_logged_in_user():
+    """ Forget the user resolved by a previous request that shared the app context """
+    g.pop("user", None)
+    g.pop("user_snapshot", None)
 
 def login_required(view):
     """ Decorator used to ensure the user is logged in """
@@ -30,7 +47,7 @@ def admin_login_required(view):
     """ Decorator used to ensure the user is logged in and is an admin """
     @functools.wraps(view)
     def wrapped_view(**kwargs):
-        if (not "user" in g) or g.user is None or (not g.user.is_admin):
+        if g.user is None or (not g.user.is_admin):
             return redirect(url_for("login", next=url_for(request.endpoint, **request.view_args)))
         return view(**kwargs)
     return wrapped_view
@@ -44,6 +61,10 @@ def create_user(username, password, chess_beginner, admin=False):
         is_admin=admin,
     )
     db.session.add(user)
+    # Update the global stats in the same transaction
+    StatsCounter.increment(STAT_NUM_USERS)
+    if chess_beginner:
+        StatsCounter.increment(STAT_NUM_CHESS_BEGINNERS)
     db.session.commit()
 
     # Mark intro to chess lesson as complete
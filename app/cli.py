@@ -1,21 +1,35 @@
 import click
 import getpass
-from flask.cli import with_appcontext
+import json
+import os
+import re
+import time
+from flask.cli import AppGroup, with_appcontext
 
 from werkzeug.security import check_password_hash, generate_password_hash
-from app.lessons import LESSON_ATOMIC, LESSON_OPENING_TRAPS, LESSON_WIN_CONDITIONS, LESSON_PIECE_SAFETY, LESSON_KINGS_TOUCHING
 from app.models import Puzzle, User
 from app.auth import create_user
+from app.puzzle_selection import puzzle_index
+from app.leaderboard import leaderboard
+from app.user_cache import user_cache
+from app.completion_writer import completion_writer
+from app.seeding import seed_load, seed_puzzles, load_puzzle_corpus, SEED_PASSWORD, PUZZLE_CORPUS_PATH
+from app.api.puzzles_api import validate_puzzle_record
+from app.move_trees import decode_move_tree
+from app.puzzle_verification import verify_puzzles, has_errors, ISSUE_ERROR
 from app import db
 
-# Populate database with puzzles
+# Utilities for writing the moves of puzzles in app/data/puzzles.json
 
-def create_move(from_square, to_square):
-    """ Utility function that creates a move object (does not support promotions) """
+# Promotion piece type of each UCI promotion character
+PROMOTION_PIECES = { "n": 1, "b": 2, "r": 3, "q": 4 }
+
+def create_move(from_square, to_square, promotion=-1):
+    """ Utility function that creates a move object """
     return {
         "from": from_square,
         "to": to_square,
-        "promotion": -1,
+        "promotion": promotion,
     }
 
 def create_square_from_string(string):
@@ -25,10 +39,10 @@ def create_square_from_string(string):
     return file + rank * 8
 
 def create_move_from_string(string):
-    """ Utility function that creates a move from a string like e2e4 """
+    """ Utility function that creates a move from a string like e2e4 or e7e8q """
     from_square = create_square_from_string(string[:2])
-    to_square = create_square_from_string(string[2:])
-    return create_move(from_square, to_square)
+    to_square = create_square_from_string(string[2:4])
+    return create_move(from_square, to_square, PROMOTION_PIECES[string[4]] if len(string) == 5 else -1)
 
 def create_linear_move_tree(moves):
     """ Utility function that generates a move tree from a list of moves """
@@ -46,321 +60,153 @@ def create_linear_move_tree(moves):
             current = current["continuation"][0]
     return result
 
-def create_atomic_puzzles():
-    """ Create the puzzles for the Atomic Lesson """
+def move_to_string(move):
+    """ Converts a move to a string like e2e4 or e7e8q """
+    promotion = next((char for char, piece in PROMOTION_PIECES.items() if piece == move["promotion"]), "")
+    return "".join(chr(ord("a") + square % 8) + chr(ord("1") + square // 8) for square in (move["from"], move["to"])) + promotion
+
+def move_tree_to_string(move_tree):
+    """ Converts a move tree to a string of moves, alternatives are each written in brackets
+    e.g. "h3h4 (f4e3 h4h5) (f4e4 h4h5)" is h3h4 followed by either f4e3 then h4h5 or f4e4 then h4h5
+    """
+    strings = []
+    for node in move_tree:
+        string = move_to_string(node["move"])
+        if "continuation" in node:
+            string += " " + move_tree_to_string(node["continuation"])
+        strings.append(string)
+    if len(strings) == 1:
+        return strings[0]
+    return " ".join("(" + string + ")" for string in strings)
+
+def create_move_tree_from_string(string):
+    """ Utility function that generates a move tree from a string of moves (see move_tree_to_string) """
+    tokens = re.findall(r"[()]|[^\s()]+", string)
+    def parse(position):
+        moves = []
+        while position < len(tokens) and tokens[position] not in ("(", ")"):
+            if not re.fullmatch(r"[a-h][1-8][a-h][1-8][nbrq]?", tokens[position]):
+                raise ValueError("Invalid move: {}".format(tokens[position]))
+            moves.append(create_move_from_string(tokens[position]))
+            position += 1
+        alternatives = []
+        while position < len(tokens) and tokens[position] == "(":
+            move_tree, position = parse(position + 1)
+            if position >= len(tokens) or tokens[position] != ")":
+                raise ValueError("Unclosed bracket")
+            alternatives += move_tree
+            position += 1
+        if not moves:
+            return alternatives, position
+        move_tree = create_linear_move_tree(moves)
+        if alternatives:
+            node = move_tree[0]
+            while "continuation" in node:
+                node = node["continuation"][0]
+            node["continuation"] = alternatives
+        return move_tree, position
+    move_tree, position = parse(0)
+    if position != len(tokens):
+        raise ValueError("Unexpected bracket")
+    return move_tree
+
+# Puzzle records for `flask puzzles import` and `flask puzzles export`, one puzzle per line
 
-    db.session.add(Puzzle(
-        fen="rnb1kbnr/pppppppp/2q5/8/4P3/8/PPPP1PPP/RNBQKBNR b - -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("d7d5"),
-            create_move_from_string("e4d5"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_ATOMIC.id,
-    ))
-    db.session.add(Puzzle(
-        fen="1kr2bnr/ppp1pppp/3q4/5N2/4P3/3P4/PPP2PPP/RNBQKB1R b - -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("d6g6"),
-            create_move_from_string("f5g7"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_ATOMIC.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkbnr/ppp1pppp/8/3p4/4P3/8/PPPP1PPP/RNBQKBNR w KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("d1f3"),
-            create_move_from_string("d5e4"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_ATOMIC.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqk1r1/1p2p2p/p1pp1pp1/2N5/3PP3/8/PPP2PPP/R2QK2R b KQq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("d8a5"),
-            create_move_from_string("c5a6"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_ATOMIC.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkbnr/ppp1p2p/6p1/3p4/3P1B2/8/PPP2PPP/RN2KB1R b KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("e7e6"),
-            create_move_from_string("f4c7"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_ATOMIC.id,
-    ))
+def format_ndjson_record(puzzle):
+    return json.dumps(puzzle, separators=(",", ":"))
 
-def create_win_condition_puzzles():
-    """ Create puzzles for the Win Condition Lesson """
+def parse_ndjson_record(line):
+    return json.loads(line)
 
-    db.session.add(Puzzle(
-        fen="rnbqkb1r/ppppp1pp/5p2/7Q/3N1P2/4P3/PPPP1nPP/RNB1KB1R b KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("g7g6"),
-            create_move_from_string("h5d5"),
-            create_move_from_string("d7d6"),
-            create_move_from_string("d5f7"),
-            create_move_from_string("e8d7"),
-            create_move_from_string("f7e7"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_WIN_CONDITIONS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkbnr/pppp3p/6p1/4p3/8/7Q/PPPP1PPP/RNB1KBNR b KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("e8f7"),
-            create_move_from_string("h3e6"),
-            create_move_from_string("f7g7"),
-            [create_move_from_string("e6g6"), create_move_from_string("e6g8")],
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_WIN_CONDITIONS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkbnr/ppppp1pp/8/8/8/4P3/PPPP1PPP/RNBQKB1R b KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("b8c6"),
-            create_move_from_string("d1h5"),
-            create_move_from_string("g7g6"),
-            create_move_from_string("h5d5"),
-            create_move_from_string("d7d6"),
-            create_move_from_string("d5f7"),
-            create_move_from_string("e8d7"),
-            create_move_from_string("f7e7"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_WIN_CONDITIONS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="2kr1b1r/ppnp3p/6p1/4p1B1/3P4/5P2/PPP3PP/R3K2R b KQ -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("f8b4"),
-            create_move_from_string("g5d8"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_WIN_CONDITIONS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkbnr/pppp2pp/4p3/5pN1/8/8/PPPPPPPP/RNBQKB1R w KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("g5f7"),
-            create_move_from_string("d8h4"),
-            create_move_from_string("g2g3"),
-            create_move_from_string("h4d4"),
-            create_move_from_string("e2e3"),
-            create_move_from_string("d4d2"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_WIN_CONDITIONS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkbnr/p7/2pp1pp1/1p5p/1P2Q3/3BP3/PBPP1PPP/RN2K2R b KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("c8e6"),
-            create_move_from_string("b2f6"),
-            create_move_from_string("f8e7"),
-            create_move_from_string("e4e7"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_WIN_CONDITIONS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="r4rk1/p3p2p/4b1p1/1p6/P2p4/1P2P2P/2PP2P1/R1B1KB1R w KQ -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("e1d1"),
-            create_move_from_string("f8f2"),
-            create_move_from_string("d2d3"),
-            create_move_from_string("f2c2"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_WIN_CONDITIONS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="r1bqkbnr/1p1p3p/4ppp1/1B6/8/4P2N/PPPP1PPP/R1B1K2R b KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("e8f7"),
-            create_move_from_string("h3f4"),
-            create_move_from_string("e6e5"),
-            create_move_from_string("f4g6"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_WIN_CONDITIONS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqk3/pppp3p/4pppQ/8/5P2/4P3/PP1P2PP/RNB1KB1R b KQq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("d7d6"),
-            create_move_from_string("h6f8"),
-            create_move_from_string("e8d7"),
-            [create_move_from_string("f8d8"), create_move_from_string("f8d6")],
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_WIN_CONDITIONS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkbnr/pp2pp1p/8/3p4/4P3/BP6/P1PP1PPP/RN2K1NR b KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("d8d6"),
-            create_move_from_string("e4d5"),
-            create_move_from_string("e8d8"),
-            create_move_from_string("a3e7"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_WIN_CONDITIONS.id,
-    ))
+def format_epd_record(puzzle):
+    """ Formats a puzzle as an EPD record, the move tree is written with the pv opcode (see move_tree_to_string) """
+    fields = puzzle["fen"].split(" ")
+    operations = []
+    if len(fields) == 6:
+        operations += ["hmvc {}".format(fields[4]), "fmvn {}".format(fields[5])]
+    operations += ["lesson {}".format(puzzle["lesson_id"]), "atomic {}".format(int(puzzle["is_atomic"])), "pv {}".format(move_tree_to_string(puzzle["move_tree"]))]
+    return " ".join(fields[:4]) + " " + " ".join(operation + ";" for operation in operations)
 
-def create_opening_traps_puzzles():
-    """ Create the puzzles for the Opening Traps Lesson """
+def parse_epd_record(line):
+    """ Parses a record written by format_epd_record """
+    fields = line.split(None, 4)
+    if len(fields) != 5:
+        raise ValueError("Missing operations")
+    operations = {}
+    for operation in fields[4].split(";"):
+        if operation.strip():
+            opcode, _, operand = operation.strip().partition(" ")
+            operations[opcode] = operand.strip()
+    try:
+        fen = " ".join(fields[:4])
+        if "hmvc" in operations or "fmvn" in operations:
+            fen += " {} {}".format(operations["hmvc"], operations["fmvn"])
+        return {
+            "lesson_id": int(operations["lesson"]),
+            "fen": fen,
+            "is_atomic": operations["atomic"] == "1",
+            "move_tree": create_move_tree_from_string(operations["pv"]),
+        }
+    except KeyError as error:
+        raise ValueError("Missing opcode: {}".format(error))
 
-    db.session.add(Puzzle(
-        fen="rnbqkbnr/pppppppp/8/8/8/5N2/PPPPPPPP/RNBQKB1R b KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("f7f5"),
-            create_move_from_string("f3e5"),
-            create_move_from_string("d7d6"),
-            create_move_from_string("e5d7"),
-            create_move_from_string("e8f7"),
-            create_move_from_string("d7f8"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_OPENING_TRAPS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkb1r/ppppp1pp/5p1n/4N3/3P4/8/PPP1PPPP/RNBQKB1R b KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("f6e5"),
-            create_move_from_string("c1g5"),
-            create_move_from_string("e7e6"),
-            create_move_from_string("g5d8"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_OPENING_TRAPS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkb1r/pppp1ppp/4p2n/3N4/8/8/PPPPPPPP/RNBQKB1R w KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("d5c7"),
-            create_move_from_string("h6g4"),
-            create_move_from_string("f2f3"),
-            create_move_from_string("g4f2"),
-            create_move_from_string("e2e4"),
-            create_move_from_string("f2d1"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_OPENING_TRAPS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkbnr/pppppppp/8/8/8/5N2/PPPPPPPP/RNBQKB1R b KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("d7d6"),
-            create_move_from_string("f3g5"),
-            create_move_from_string("f7f6"),
-            create_move_from_string("g5f7"),
-            create_move_from_string("d8d7"),
-            create_move_from_string("f7d6"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_OPENING_TRAPS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkbnr/pppp1p1p/4p1p1/7Q/8/4PN2/PPPP1PPP/RNB1KB1R b KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("g6h5"),
-            create_move_from_string("f3e5"),
-            create_move_from_string("f7f6"),
-            create_move_from_string("e5d7"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_OPENING_TRAPS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkb1r/pp1pp1pp/2p4n/8/7Q/2P5/PP1PPPPP/RNB1KB1R b KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("g7g5"),
-            create_move_from_string("h4h5"),
-            create_move_from_string("h6f7"),
-            create_move_from_string("h5f7"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_OPENING_TRAPS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkbnr/pp1ppppp/2p5/8/4N3/8/PPPPPPPP/R1BQKBNR b KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("f7f6"),
-            create_move_from_string("e4c5"),
-            create_move_from_string("d7d5"),
-            create_move_from_string("c5d7"),
-            create_move_from_string("d8a5"),
-            create_move_from_string("d7f8"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_OPENING_TRAPS.id,
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("g1f3"),
-            create_move_from_string("f7f6"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_OPENING_TRAPS.id,
-    ))
+RECORD_FORMATS = {
+    "ndjson": (format_ndjson_record, parse_ndjson_record),
+    "epd": (format_epd_record, parse_epd_record),
+}
 
-def create_piece_safety_puzzles():
-    db.session.add(Puzzle(
-        fen="2k1q3/pn2b3/bp1pp3/2p5/4P1P1/QP1P3P/P1PB1N2/R1N1K2R b - - 0 1",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("e8f8"),
-            create_move_from_string("d2f4")
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_PIECE_SAFETY.id
-    ))
-    db.session.add(Puzzle(
-        fen="rnbqkbnr/pp2pppp/2pp4/8/2P5/1P1P1N2/P2NPPPP/R1BQKB1R b KQkq - 0 1",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("d8a5"),
-            create_move_from_string("b3b4"),
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_PIECE_SAFETY.id
-    ))
+def iter_puzzles(lesson_id=None, chunk_size=1000, include_id=False):
+    """ Yields every puzzle as a record (with its id if `include_id`), `chunk_size` puzzles are fetched at a time in order of id """
+    query = db.session.query(Puzzle.id, Puzzle.lesson_id, Puzzle.fen, Puzzle.is_atomic, Puzzle.move_tree_data)
+    if lesson_id is not None:
+        query = query.filter(Puzzle.lesson_id==lesson_id)
+    last_id = 0
+    while True:
+        rows = query.filter(Puzzle.id>last_id).order_by(Puzzle.id).limit(chunk_size).all()
+        if not rows:
+            return
+        for row in rows:
+            record = { "lesson_id": row.lesson_id, "fen": row.fen, "is_atomic": row.is_atomic, "move_tree": decode_move_tree(row.move_tree_data) }
+            if include_id:
+                record["id"] = row.id
+            yield record
+        last_id = rows[-1].id
 
-def create_kings_touching_puzzles():
-    db.session.add(Puzzle(
-        fen="8/8/4k3/8/6K1/8/1Q6/8 w - - 0 1",
-        move_tree=create_linear_move_tree([
-            create_move_from_string("b2e5"),
-            create_move_from_string("e6f5"),
-            create_move_from_string("g4h3"),
-            create_move_from_string("f5g4")
-        ]),
-        is_atomic=True,
-        lesson_id=LESSON_KINGS_TOUCHING.id
-    ))
-    db.session.add(Puzzle(
-        fen="8/6Q1/8/8/5K2/7k/8/8 b - - 0 1",
-        move_tree=[{ "move": create_move_from_string("h3h4"), "continuation" : [
-                { "move": create_move_from_string("f4e3"), "continuation": [{ "move": create_move_from_string("h4h5"), "continuation": [{ "move": create_move_from_string("g7g5") }] }] },
-				{ "move": create_move_from_string("f4e4"), "continuation": [{ "move": create_move_from_string("h4h5"), "continuation": [{ "move": create_move_from_string("g7g5") }] }] },
-				{ "move": create_move_from_string("f4e5"), "continuation": [{ "move": create_move_from_string("h4h5"), "continuation": [{ "move": create_move_from_string("g7g5") }] }] }]
-                }],
-        is_atomic=True,
-        lesson_id=LESSON_KINGS_TOUCHING.id
-    ))
+def read_puzzle_records(lines, parse, errors):
+    """ Yields the (line number, puzzle) of the valid puzzles of some lines, the line number and reason of each invalid line is appended to `errors` """
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            puzzle = parse(line)
+        except ValueError as error:
+            errors.append((line_number, str(error)))
+            continue
+        if validate_puzzle_record(puzzle):
+            yield line_number, puzzle
+        else:
+            errors.append((line_number, "Invalid puzzle"))
+
+def verify_puzzle_records(records, errors, warnings, processes=None):
+    """ Yields the puzzles of (line number, puzzle) records whose move trees replay without errors
+    The line number and message of each issue is appended to `errors` or `warnings`, puzzles with only warnings are still yielded.
+    """
+    for line_number, puzzle, issues in verify_puzzles(records, processes=processes):
+        for level, message in issues:
+            (errors if level == ISSUE_ERROR else warnings).append((line_number, message))
+        if not has_errors(issues):
+            yield puzzle
 
 def clear_database():
     """ Utility function that clears the data from all tables """
+    completion_writer.clear()
     for table in reversed(db.metadata.sorted_tables):
         db.session.execute(table.delete())
     db.session.commit()
+    puzzle_index.clear()
+    leaderboard.clear()
+    user_cache.clear()
 
 def create_admin_user():
     """ Prompts user to create an admin user """
@@ -375,21 +221,133 @@ def create_admin_user():
     print("Created admin user: {}".format(username))
 
 @click.command("init-db")
+@click.option("--clear", is_flag=True, help="Delete all data (including users and completions) before seeding")
+@click.option("--corpus", default=PUZZLE_CORPUS_PATH, show_default=True, help="Puzzle corpus file to load")
+@click.option("--chunk-size", default=5000, show_default=True, help="Number of puzzles written per statement and commit")
 @with_appcontext
-def init_db():
+def init_db(clear, corpus, chunk_size):
     """
     This is a command run from the command line using `flask init-db`
-    that will add all the puzzles to the database."""
-    clear_database()
-    print("Cleared Database.")
+    that will add the puzzles of the puzzle corpus to the database.
+    It can be run again after the corpus changes, only the new and changed puzzles are written."""
+    if clear:
+        clear_database()
+        print("Cleared Database.")
 
-    create_atomic_puzzles()
-    create_win_condition_puzzles()
-    create_opening_traps_puzzles()
-    create_piece_safety_puzzles()
-    create_kings_touching_puzzles()
+    start = time.perf_counter()
+    version, puzzles = load_puzzle_corpus(corpus)
+    num_added, num_updated, num_unchanged = seed_puzzles(puzzles, chunk_size=chunk_size)
+    puzzle_index.clear()
+    elapsed = time.perf_counter() - start
+    print("Loaded puzzle corpus version {} in {:.2f}s: {} added, {} updated, {} unchanged".format(version, elapsed, num_added, num_updated, num_unchanged))
+    num_other = Puzzle.query.count() - num_added - num_updated - num_unchanged
+    if num_other > 0:
+        print("{} puzzles in the database aren't in the corpus and were kept".format(num_other))
 
-    create_admin_user()
+    if not User.query.filter_by(is_admin=True).first():
+        create_admin_user()
 
-    db.session.commit()
     print("Success.")
+
+@click.command("seed-load")
+@click.option("--users", default=10000, show_default=True, help="Number of users to generate")
+@click.option("--completions", default=100000, show_default=True, help="Approximate number of puzzle completions (final tests x puzzles per test)")
+@click.option("--seed", type=int, default=None, help="Random seed, the same seed generates the same data")
+@click.option("--chunk-size", default=10000, show_default=True, help="Number of rows inserted per statement and commit")
+@with_appcontext
+def seed_load_command(users, completions, seed, chunk_size):
+    """
+    This is a command run from the command line using `flask seed-load`
+    that adds synthetic users, lesson progress and final tests for scale testing (run `flask init-db` first for the puzzles)."""
+    start = time.perf_counter()
+    try:
+        num_inserted = seed_load(users, completions, seed=seed, chunk_size=chunk_size)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    puzzle_index.clear()
+    leaderboard.clear()
+    user_cache.clear()
+    elapsed = time.perf_counter() - start
+    for table, num_rows in num_inserted.items():
+        print("Inserted {} rows into {}".format(num_rows, table))
+    total = sum(num_inserted.values())
+    print("Inserted {} rows in {:.1f}s ({:.0f} rows/s), users can log in with the password {}".format(total, elapsed, total / elapsed, SEED_PASSWORD))
+
+puzzles_cli = AppGroup("puzzles", help="Import and export puzzles.")
+
+@puzzles_cli.command("export")
+@click.argument("output", type=click.File("w"), default="-")
+@click.option("--format", "record_format", type=click.Choice(list(RECORD_FORMATS)), default="ndjson", show_default=True, help="Format of the records")
+@click.option("--lesson", type=int, default=None, help="Only export the puzzles of a lesson")
+def export_puzzles_command(output, record_format, lesson):
+    """
+    This is a command run from the command line using `flask puzzles export [OUTPUT]`
+    that writes the puzzles to a file (or stdout) as one record per line."""
+    format_record, _ = RECORD_FORMATS[record_format]
+    start = time.perf_counter()
+    num_rows = 0
+    for puzzle in iter_puzzles(lesson_id=lesson):
+        output.write(format_record(puzzle) + "\n")
+        num_rows += 1
+    elapsed = time.perf_counter() - start
+    click.echo("Exported {} puzzles in {:.2f}s ({:.0f} rows/s)".format(num_rows, elapsed, num_rows / elapsed if elapsed else 0), err=True)
+
+@puzzles_cli.command("import")
+@click.argument("input_file", type=click.File("r"), default="-")
+@click.option("--format", "record_format", type=click.Choice(list(RECORD_FORMATS)), default=None, help="Format of the records  [default: epd for .epd files, otherwise ndjson]")
+@click.option("--chunk-size", default=5000, show_default=True, help="Number of puzzles written per statement and commit")
+@click.option("--verify/--no-verify", default=True, show_default=True, help="Replay the move trees and skip puzzles with illegal moves")
+@click.option("--processes", type=int, default=None, help="Number of processes verifying puzzles  [default: number of CPUs]")
+def import_puzzles_command(input_file, record_format, chunk_size, verify, processes):
+    """
+    This is a command run from the command line using `flask puzzles import [INPUT]`
+    that adds the puzzles of a file (or stdin) which aren't in the database, the same way as `flask init-db`.
+    Invalid records and puzzles with illegal moves are reported and skipped, other issues found replaying the puzzles are reported."""
+    if record_format is None:
+        record_format = "epd" if os.path.splitext(input_file.name)[1].lower() == ".epd" else "ndjson"
+    _, parse_record = RECORD_FORMATS[record_format]
+    start = time.perf_counter()
+    errors = []
+    warnings = []
+    records = read_puzzle_records(input_file, parse_record, errors)
+    if verify:
+        puzzles = verify_puzzle_records(records, errors, warnings, processes=processes)
+    else:
+        puzzles = (puzzle for _, puzzle in records)
+    num_added, num_updated, num_unchanged = seed_puzzles(puzzles, chunk_size=chunk_size)
+    puzzle_index.clear()
+    elapsed = time.perf_counter() - start
+    for line_number, reason in errors:
+        click.echo("Line {}: {}".format(line_number, reason), err=True)
+    for line_number, reason in warnings:
+        click.echo("Line {}: warning: {}".format(line_number, reason), err=True)
+    num_invalid = len({ line_number for line_number, _ in errors })
+    num_rows = num_added + num_updated + num_unchanged + num_invalid
+    click.echo("Imported {} records in {:.2f}s ({:.0f} rows/s): {} added, {} updated, {} unchanged, {} invalid, {} with warnings".format(
+        num_rows, elapsed, num_rows / elapsed if elapsed else 0, num_added, num_updated, num_unchanged, num_invalid,
+        len({ line_number for line_number, _ in warnings })), err=True)
+
+@puzzles_cli.command("verify")
+@click.option("--lesson", type=int, default=None, help="Only verify the puzzles of a lesson")
+@click.option("--processes", type=int, default=None, help="Number of processes verifying puzzles  [default: number of CPUs]")
+def verify_puzzles_command(lesson, processes):
+    """
+    This is a command run from the command line using `flask puzzles verify`
+    that replays the move tree of every puzzle in the database and reports illegal moves and missing winning moves.
+    Exits with status 1 if any puzzle has an illegal move."""
+    start = time.perf_counter()
+    num_puzzles = num_errors = num_warnings = 0
+    records = ((puzzle["id"], puzzle) for puzzle in iter_puzzles(lesson_id=lesson, include_id=True))
+    for puzzle_id, _, issues in verify_puzzles(records, processes=processes):
+        num_puzzles += 1
+        for level, message in issues:
+            click.echo("Puzzle {}: {}{}".format(puzzle_id, "" if level == ISSUE_ERROR else "warning: ", message))
+        if has_errors(issues):
+            num_errors += 1
+        elif issues:
+            num_warnings += 1
+    elapsed = time.perf_counter() - start
+    click.echo("Verified {} puzzles in {:.2f}s ({:.0f} puzzles/s): {} with errors, {} with warnings".format(
+        num_puzzles, elapsed, num_puzzles / elapsed if elapsed else 0, num_errors, num_warnings), err=True)
+    if num_errors:
+        raise SystemExit(1)
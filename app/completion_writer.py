@@ -0,0 +1,197 @@
+""" Module that saves puzzle completions, optionally in batches from a background thread (write-behind) """
+import atexit
+import collections
+import logging
+import threading
+import time
+
+from app import app, db
+from app.models import PuzzleCompletion, LessonPerformance, Test
+from flask_sqlalchemy import sqlalchemy
+
+logger = logging.getLogger(__name__)
+
+# Keys of a completion that are PuzzleCompletion columns, completions also contain the "lesson_id" of the puzzle
+COMPLETION_COLUMNS = ("user", "puzzle_id", "attempts", "start_time", "end_time", "test_number")
+
+def record_completions(completions):
+    """ Saves a list of completions as part of the current transaction (caller commits)
+    Also adds them to the LessonPerformance totals and advances the tests they belong to.
+    """
+    db.session.bulk_insert_mappings(PuzzleCompletion, [{ key: completion[key] for key in COMPLETION_COLUMNS } for completion in completions])
+
+    # Completions for the same lesson only need one update of the totals
+    totals = collections.defaultdict(lambda: [0, 0, 0])
+    for completion in completions:
+        total = totals[(completion["user"], completion["lesson_id"])]
+        total[0] += 1
+        total[1] += (completion["end_time"] - completion["start_time"]).total_seconds()
+        total[2] += 1 / completion["attempts"]
+    for (user_id, lesson_id), (num_puzzles, total_time, total_accuracy) in totals.items():
+        LessonPerformance.add_totals(user_id, lesson_id, num_puzzles, total_time, total_accuracy)
+
+    # Advance each test onto the next puzzle in its plan (completions are applied in the order they were made)
+    tests = { test.id: test for test in Test.query.filter(Test.id.in_({ completion["test_number"] for completion in completions })) }
+    for completion in completions:
+        test = tests.get(completion["test_number"])
+        if test is not None and test.user == completion["user"] and test.get_current_puzzle_id() == completion["puzzle_id"]:
+            test.completed_puzzles += 1
+
+class CompletionWriter:
+    """ Bounded queue of completions which a background thread saves in batches
+    A batch is written once COMPLETION_BATCH_SIZE completions are waiting or the oldest has waited COMPLETION_FLUSH_INTERVAL seconds.
+    When the queue holds COMPLETION_QUEUE_SIZE completions the request that adds to it writes the batch itself.
+    Requests which read a user's completions should call flush_user first so that they see the user's own writes.
+    The queue belongs to one process, so write-behind is only enabled with a single worker (see check_config).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        # Only one batch is written at a time so that tests are advanced in order
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._oldest_time = None
+        # user_id -> number of completions that haven't been committed yet (including the batch being written)
+        self._unsaved_users = collections.Counter()
+        self._thread = None
+        self._stopping = False
+
+    def add(self, completion):
+        """ Queues a completion (see record_completions) to be saved later """
+        with self._lock:
+            if not self._pending:
+                self._oldest_time = time.monotonic()
+            self._pending.append(completion)
+            self._unsaved_users[completion["user"]] += 1
+            queue_full = len(self._pending) >= app.config["COMPLETION_QUEUE_SIZE"]
+            if len(self._pending) >= app.config["COMPLETION_BATCH_SIZE"]:
+                self._condition.notify()
+            self._start_thread()
+        if queue_full:
+            self.flush()
+
+    @property
+    def queue_size(self):
+        """ Number of completions waiting to be saved """
+        return len(self._pending)
+
+    def has_unsaved(self, user_id):
+        with self._lock:
+            return self._unsaved_users[user_id] > 0
+
+    def flush_user(self, user_id):
+        """ Saves the queue if it holds any completions of a user (read-your-writes) """
+        if self.has_unsaved(user_id):
+            self.flush()
+
+    def flush(self):
+        """ Saves every queued completion in one transaction using the current session
+        Never raises so that a bad batch doesn't fail the request that happens to flush it.
+        Returns False if the database is unavailable and the completions were put back to be retried.
+        """
+        with self._flush_lock:
+            with self._lock:
+                completions = self._pending
+                self._pending = []
+                self._oldest_time = None
+            if not completions:
+                return True
+            try:
+                record_completions(completions)
+                db.session.commit()
+            except sqlalchemy.exc.OperationalError:
+                db.session.rollback()
+                self._put_back(completions)
+                logger.warning("Database unavailable, %d puzzle completions will be retried", len(completions), exc_info=True)
+                return False
+            except Exception:
+                # Save the completions one at a time so that only the ones which fail are dropped
+                db.session.rollback()
+                return self._save_each(completions)
+            self._forget(completions)
+            return True
+
+    def _save_each(self, completions):
+        for index, completion in enumerate(completions):
+            try:
+                record_completions([completion])
+                db.session.commit()
+            except sqlalchemy.exc.OperationalError:
+                db.session.rollback()
+                self._forget(completions[:index])
+                self._put_back(completions[index:])
+                logger.warning("Database unavailable, %d puzzle completions will be retried", len(completions) - index, exc_info=True)
+                return False
+            except Exception:
+                db.session.rollback()
+                logger.exception("Discarded puzzle completion of user %s for puzzle %s", completion.get("user"), completion.get("puzzle_id"))
+        self._forget(completions)
+        return True
+
+    def _put_back(self, completions):
+        with self._lock:
+            self._pending = completions + self._pending
+            self._oldest_time = time.monotonic()
+
+    def _forget(self, completions):
+        with self._lock:
+            for completion in completions:
+                self._unsaved_users[completion["user"]] -= 1
+                if self._unsaved_users[completion["user"]] <= 0:
+                    del self._unsaved_users[completion["user"]]
+
+    def _start_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="completion-writer", daemon=True)
+            self._thread.start()
+
+    def _should_flush(self):
+        if not self._pending:
+            return False
+        return (len(self._pending) >= app.config["COMPLETION_BATCH_SIZE"]
+            or time.monotonic() - self._oldest_time >= app.config["COMPLETION_FLUSH_INTERVAL"])
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._stopping and not self._should_flush():
+                    timeout = app.config["COMPLETION_FLUSH_INTERVAL"]
+                    if self._pending:
+                        timeout -= time.monotonic() - self._oldest_time
+                    self._condition.wait(max(timeout, 0))
+                if self._stopping:
+                    return
+            with app.app_context():
+                try:
+                    if not self.flush():
+                        # The batch was put back, wait for the next interval before retrying
+                        time.sleep(app.config["COMPLETION_FLUSH_INTERVAL"])
+                finally:
+                    db.session.remove()
+
+    def stop(self):
+        """ Stops the background thread and saves the remaining completions """
+        with self._lock:
+            self._stopping = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        with app.app_context():
+            try:
+                self.flush()
+            finally:
+                db.session.remove()
+
+    def clear(self):
+        """ Discards every queued completion """
+        with self._lock:
+            self._pending = []
+            self._oldest_time = None
+            self._unsaved_users.clear()
+
+completion_writer = CompletionWriter()
+
+# Save the queue when the worker shuts down
+atexit.register(completion_writer.stop)
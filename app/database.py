@@ -0,0 +1,71 @@
+""" Module that configures the database engine from the DATABASE_PROFILE and DATABASE_POOL_* settings """
+import functools
+
+from flask_sqlalchemy import SQLAlchemy, sqlalchemy
+
+# PRAGMAs applied to every new SQLite connection for each profile
+SQLITE_PROFILES = {
+    # SQLite defaults: rollback journal and the 5 second lock timeout of the sqlite3 module
+    "default": {},
+    # Write-ahead log so that readers don't block the writer (and the reverse), writers wait longer for the lock
+    # and only the log is synced on commit. A negative cache size is in KiB.
+    "concurrent": {
+        "journal_mode": "WAL",
+        "busy_timeout": 10000,
+        "synchronous": "NORMAL",
+        "cache_size": -16000,
+    },
+}
+
+# Only these PRAGMAs can be set from the config since they are formatted into the statement
+SQLITE_PRAGMA_NAMES = { "journal_mode", "busy_timeout", "synchronous", "cache_size", "temp_store", "mmap_size", "foreign_keys" }
+
+# Config key -> sqlalchemy.create_engine argument
+POOL_OPTIONS = {
+    "DATABASE_POOL_SIZE": "pool_size",
+    "DATABASE_MAX_OVERFLOW": "max_overflow",
+    "DATABASE_POOL_TIMEOUT": "pool_timeout",
+    "DATABASE_POOL_RECYCLE": "pool_recycle",
+}
+
+def get_sqlite_pragmas(config):
+    """ Returns the PRAGMAs of the configured profile with SQLITE_PRAGMAS applied on top """
+    profile = config["DATABASE_PROFILE"]
+    if profile not in SQLITE_PROFILES:
+        raise ValueError("Unknown DATABASE_PROFILE {}".format(profile))
+    pragmas = { **SQLITE_PROFILES[profile], **config["SQLITE_PRAGMAS"] }
+    for name, value in pragmas.items():
+        if name not in SQLITE_PRAGMA_NAMES or not str(value).lstrip("-").isalnum():
+            raise ValueError("Invalid SQLite PRAGMA {}={}".format(name, value))
+    return pragmas
+
+def set_sqlite_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute("PRAGMA {}={}".format(name, value))
+    cursor.close()
+
+class ProfiledSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy extension which applies the database profile when the engine is created
+    The engine is created on first use so tests can still change SQLALCHEMY_DATABASE_URI after import.
+    """
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        pool_options = { option: app.config[key] for key, option in POOL_OPTIONS.items() if app.config.get(key) is not None }
+        if sa_url.drivername.startswith("sqlite"):
+            options["sqlite_pragmas"] = get_sqlite_pragmas(app.config)
+            # SQLite files use a new connection for every session unless a pool size is configured
+            if pool_options and sa_url.database not in (None, "", ":memory:"):
+                options["poolclass"] = sqlalchemy.pool.QueuePool
+                options.setdefault("connect_args", {})["check_same_thread"] = False
+                options.update(pool_options)
+        else:
+            options.update(pool_options)
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop("sqlite_pragmas", None)
+        engine = super().create_engine(sa_url, engine_opts)
+        if pragmas:
+            sqlalchemy.event.listen(engine, "connect", functools.partial(set_sqlite_pragmas, pragmas))
+        return engine
@@ -0,0 +1,6 @@
+""" Server-side atomic (and standard) chess move generation on 64-bit integer bitboards
+Matches the rules of the JS chess library in app/static/chess so that puzzles can be checked on the server.
+"""
+from app.engine.bitboards import WHITE, BLACK, NO_PIECE, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING
+from app.engine.position import (Position, perft, create_move, move_to_dict, move_from_dict, move_to_string, move_from_string,
+    VALID, DRAW, WHITE_WIN, BLACK_WIN)
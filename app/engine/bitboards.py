@@ -0,0 +1,105 @@
+""" Bitboard constants and precomputed masks
+Squares are numbered like the JS chess library (a1 = 0, h1 = 7, h8 = 63) and bit n of a bitboard is square n.
+"""
+
+WHITE = 0
+BLACK = 1
+
+NO_PIECE = -1
+PAWN = 0
+KNIGHT = 1
+BISHOP = 2
+ROOK = 3
+QUEEN = 4
+KING = 5
+# Same order as PROMOTION_PIECE_TYPES in chess.js
+PROMOTION_PIECES = (QUEEN, ROOK, BISHOP, KNIGHT)
+
+FULL = (1 << 64) - 1
+FILE_A = 0x0101010101010101
+FILE_H = FILE_A << 7
+RANK_1 = 0xFF
+RANK_3 = RANK_1 << 16
+RANK_6 = RANK_1 << 40
+RANK_8 = RANK_1 << 56
+
+SQUARE_BITS = [1 << square for square in range(64)]
+
+KNIGHT_VECTORS = [(-1, 2), (1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1)]
+KING_VECTORS = [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]
+
+def square_mask(square, vectors):
+    """ Returns the bitboard of the squares reached from `square` by each (file, rank) vector which stay on the board """
+    mask = 0
+    for file_offset, rank_offset in vectors:
+        file, rank = square % 8 + file_offset, square // 8 + rank_offset
+        if 0 <= file < 8 and 0 <= rank < 8:
+            mask |= 1 << (file + rank * 8)
+    return mask
+
+def ray_masks(vector):
+    """ Returns the bitboard of the squares along a direction from each square, excluding the square itself """
+    masks = []
+    for square in range(64):
+        mask = 0
+        file, rank = square % 8 + vector[0], square // 8 + vector[1]
+        while 0 <= file < 8 and 0 <= rank < 8:
+            mask |= 1 << (file + rank * 8)
+            file, rank = file + vector[0], rank + vector[1]
+        masks.append(mask)
+    return masks
+
+KNIGHT_ATTACKS = [square_mask(square, KNIGHT_VECTORS) for square in range(64)]
+KING_ATTACKS = [square_mask(square, KING_VECTORS) for square in range(64)]
+# Squares around a capture whose non-pawn pieces are destroyed, the same squares as a king's moves
+EXPLOSION_MASKS = KING_ATTACKS
+# Squares a pawn of each color captures on
+PAWN_ATTACKS = [
+    [square_mask(square, [(-1, 1), (1, 1)]) for square in range(64)],
+    [square_mask(square, [(-1, -1), (1, -1)]) for square in range(64)],
+]
+
+# Directions which increase the square number find their first blocker with the lowest set bit, the others with the highest
+NORTH_RAYS = ray_masks((0, 1))
+EAST_RAYS = ray_masks((1, 0))
+NORTH_EAST_RAYS = ray_masks((1, 1))
+NORTH_WEST_RAYS = ray_masks((-1, 1))
+SOUTH_RAYS = ray_masks((0, -1))
+WEST_RAYS = ray_masks((-1, 0))
+SOUTH_EAST_RAYS = ray_masks((1, -1))
+SOUTH_WEST_RAYS = ray_masks((-1, -1))
+
+# Squares a bishop or rook attacks on an empty board, a slider outside these can't attack the square whatever the blockers
+BISHOP_RAYS = [NORTH_EAST_RAYS[square] | NORTH_WEST_RAYS[square] | SOUTH_EAST_RAYS[square] | SOUTH_WEST_RAYS[square] for square in range(64)]
+ROOK_RAYS = [NORTH_RAYS[square] | EAST_RAYS[square] | SOUTH_RAYS[square] | WEST_RAYS[square] for square in range(64)]
+
+def positive_ray_attacks(rays, square, occupied):
+    ray = rays[square]
+    blockers = ray & occupied
+    if blockers:
+        return ray ^ rays[(blockers & -blockers).bit_length() - 1]
+    return ray
+
+def negative_ray_attacks(rays, square, occupied):
+    ray = rays[square]
+    blockers = ray & occupied
+    if blockers:
+        return ray ^ rays[blockers.bit_length() - 1]
+    return ray
+
+def bishop_attacks(square, occupied):
+    """ Returns the squares a bishop on `square` attacks, up to and including the first piece in each direction """
+    return (positive_ray_attacks(NORTH_EAST_RAYS, square, occupied) | positive_ray_attacks(NORTH_WEST_RAYS, square, occupied)
+        | negative_ray_attacks(SOUTH_EAST_RAYS, square, occupied) | negative_ray_attacks(SOUTH_WEST_RAYS, square, occupied))
+
+def rook_attacks(square, occupied):
+    """ Returns the squares a rook on `square` attacks, up to and including the first piece in each direction """
+    return (positive_ray_attacks(NORTH_RAYS, square, occupied) | positive_ray_attacks(EAST_RAYS, square, occupied)
+        | negative_ray_attacks(SOUTH_RAYS, square, occupied) | negative_ray_attacks(WEST_RAYS, square, occupied))
+
+def iter_squares(bitboard):
+    """ Yields the squares of the set bits of a bitboard in increasing order """
+    while bitboard:
+        bit = bitboard & -bitboard
+        yield bit.bit_length() - 1
+        bitboard ^= bit
@@ -0,0 +1,441 @@
+""" Bitboard position with the same move generation and atomic rules as Position in app/static/chess/board.js
+Moves are ints packed like app/move_trees.py: from square, to square and promotion + 1 in 6, 6 and 3 bits.
+Positions without a king have no legal moves (there is no sandbox mode as puzzles are never played in one).
+"""
+from app.engine.bitboards import (WHITE, BLACK, NO_PIECE, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, PROMOTION_PIECES,
+    SQUARE_BITS, KNIGHT_ATTACKS, KING_ATTACKS, EXPLOSION_MASKS, PAWN_ATTACKS, BISHOP_RAYS, ROOK_RAYS, FILE_A, FILE_H, RANK_3, RANK_6, FULL,
+    bishop_attacks, rook_attacks, iter_squares)
+
+# Results of Position.result(), the same values as POSITION_STATE in board.js
+VALID = 0
+DRAW = 1
+WHITE_WIN = 2
+BLACK_WIN = 3
+
+# Squares hold the piece index color * 6 + piece type
+EMPTY = -1
+
+WHITE_KINGSIDE = 1
+WHITE_QUEENSIDE = 2
+BLACK_KINGSIDE = 4
+BLACK_QUEENSIDE = 8
+KINGSIDE_RIGHTS = (WHITE_KINGSIDE, BLACK_KINGSIDE)
+QUEENSIDE_RIGHTS = (WHITE_QUEENSIDE, BLACK_QUEENSIDE)
+# Castling right lost when a rook of each color leaves (or is removed from) a square
+ROOK_SQUARE_RIGHTS = ([0] * 64, [0] * 64)
+ROOK_SQUARE_RIGHTS[WHITE][0] = WHITE_QUEENSIDE
+ROOK_SQUARE_RIGHTS[WHITE][7] = WHITE_KINGSIDE
+ROOK_SQUARE_RIGHTS[BLACK][56] = BLACK_QUEENSIDE
+ROOK_SQUARE_RIGHTS[BLACK][63] = BLACK_KINGSIDE
+
+PIECE_CHARACTERS = "pnbrqk"
+CASTLING_CHARACTERS = ((WHITE_KINGSIDE, "K"), (WHITE_QUEENSIDE, "Q"), (BLACK_KINGSIDE, "k"), (BLACK_QUEENSIDE, "q"))
+FILE_CHARACTERS = "abcdefgh"
+
+def create_move(from_square, to_square, promotion=NO_PIECE):
+    return from_square | to_square << 6 | (promotion + 1) << 12
+
+def move_to_dict(move):
+    """ Returns the { from, to, promotion } object used by the JS and move trees """
+    return { "from": move & 63, "to": move >> 6 & 63, "promotion": (move >> 12) - 1 }
+
+def move_from_dict(move):
+    return create_move(move["from"], move["to"], move["promotion"])
+
+def square_to_string(square):
+    return FILE_CHARACTERS[square & 7] + str((square >> 3) + 1)
+
+def square_from_string(string):
+    if len(string) != 2 or string[0] not in FILE_CHARACTERS or string[1] not in "12345678":
+        raise ValueError("Invalid square: {!r}".format(string))
+    return FILE_CHARACTERS.index(string[0]) + (int(string[1]) - 1) * 8
+
+def move_to_string(move):
+    """ Returns the UCI string of a move (e.g. e2e4, e7e8q) """
+    promotion = (move >> 12) - 1
+    return square_to_string(move & 63) + square_to_string(move >> 6 & 63) + (PIECE_CHARACTERS[promotion] if promotion != NO_PIECE else "")
+
+def move_from_string(string):
+    if len(string) not in (4, 5) or (len(string) == 5 and string[4] not in "nbrq"):
+        raise ValueError("Invalid move: {!r}".format(string))
+    promotion = PIECE_CHARACTERS.index(string[4]) if len(string) == 5 else NO_PIECE
+    return create_move(square_from_string(string[:2]), square_from_string(string[2:4]), promotion)
+
+class Position:
+    """ Chess position stored as one bitboard per piece type and color, with a square to piece lookup
+    Moves are applied in place with make_move and reverted with unmake_move.
+    """
+    __slots__ = ("pieces", "occupied", "squares", "color", "castling", "ep_square", "in_check", "atomic", "_undo")
+
+    def __init__(self, atomic=True):
+        self.pieces = [0] * 12
+        self.occupied = [0, 0]
+        self.squares = [EMPTY] * 64
+        self.color = WHITE
+        self.castling = 0
+        self.ep_square = -1
+        self.in_check = False
+        self.atomic = atomic
+        self._undo = []
+
+    @classmethod
+    def from_fen(cls, fen, atomic=True):
+        """ Returns the position of a FEN, raises ValueError if it is malformed
+        Only the placement and side to move are required, the halfmove clock and fullmove number are ignored.
+        """
+        fields = fen.split()
+        if len(fields) < 2 or fields[1] not in ("w", "b"):
+            raise ValueError("Invalid FEN: {!r}".format(fen))
+        position = cls(atomic)
+        ranks = fields[0].split("/")
+        if len(ranks) != 8:
+            raise ValueError("Invalid FEN: {!r}".format(fen))
+        for rank_index, rank in enumerate(ranks):
+            file = 0
+            for character in rank:
+                if character.isdigit():
+                    file += int(character)
+                elif character.lower() in PIECE_CHARACTERS and file < 8:
+                    color = WHITE if character.isupper() else BLACK
+                    position._put((7 - rank_index) * 8 + file, color * 6 + PIECE_CHARACTERS.index(character.lower()))
+                    file += 1
+                else:
+                    raise ValueError("Invalid FEN: {!r}".format(fen))
+            if file != 8:
+                raise ValueError("Invalid FEN: {!r}".format(fen))
+        position.color = WHITE if fields[1] == "w" else BLACK
+        castling = fields[2] if len(fields) > 2 else "-"
+        for right, character in CASTLING_CHARACTERS:
+            if character in castling:
+                position.castling |= right
+        if len(fields) > 3 and fields[3] != "-":
+            position.ep_square = square_from_string(fields[3])
+        position._initialize_check()
+        return position
+
+    def _initialize_check(self):
+        """ Same as _initialize in board.js: in check if the opponent has a legal move to our king """
+        king = self.king_square(self.color)
+        self.color ^= 1
+        self.in_check = False
+        self.in_check = any(move >> 6 & 63 == king and self.is_legal(move) for move in self.pseudo_legal_moves())
+        self.color ^= 1
+
+    @property
+    def fen(self):
+        """ The FEN of the position without the halfmove clock and fullmove number """
+        ranks = []
+        for rank in range(7, -1, -1):
+            characters = ""
+            num_empty = 0
+            for square in range(rank * 8, rank * 8 + 8):
+                piece = self.squares[square]
+                if piece == EMPTY:
+                    num_empty += 1
+                    continue
+                if num_empty:
+                    characters += str(num_empty)
+                    num_empty = 0
+                character = PIECE_CHARACTERS[piece % 6]
+                characters += character.upper() if piece < 6 else character
+            ranks.append(characters + (str(num_empty) if num_empty else ""))
+        castling = "".join(character for right, character in CASTLING_CHARACTERS if self.castling & right) or "-"
+        ep_square = square_to_string(self.ep_square) if self.ep_square >= 0 else "-"
+        return "{} {} {} {}".format("/".join(ranks), "w" if self.color == WHITE else "b", castling, ep_square)
+
+    def piece_at(self, square):
+        """ Returns the (color, piece type) on a square or None """
+        piece = self.squares[square]
+        return None if piece == EMPTY else divmod(piece, 6)
+
+    def king_square(self, color):
+        """ Returns the square of a color's king or -1 if it has exploded """
+        return self.pieces[color * 6 + KING].bit_length() - 1
+
+    def _put(self, square, piece):
+        bit = SQUARE_BITS[square]
+        self.pieces[piece] |= bit
+        self.occupied[piece // 6] |= bit
+        self.squares[square] = piece
+
+    def _remove(self, square):
+        piece = self.squares[square]
+        if piece != EMPTY:
+            bit = SQUARE_BITS[square]
+            self.pieces[piece] ^= bit
+            self.occupied[piece // 6] ^= bit
+            self.squares[square] = EMPTY
+
+    def is_attacked(self, square, color, occupied=None, remaining=FULL):
+        """ Whether a pseudo-legal move of `color` could capture on `square`
+        `occupied` and `remaining` (the squares of `color` which still have their pieces) check the position after a move without applying it.
+        """
+        pieces = self.pieces
+        base = color * 6
+        if occupied is None:
+            occupied = self.occupied[WHITE] | self.occupied[BLACK]
+        if (PAWN_ATTACKS[color ^ 1][square] & pieces[base + PAWN] | KNIGHT_ATTACKS[square] & pieces[base + KNIGHT]
+                | KING_ATTACKS[square] & pieces[base + KING]) & remaining:
+            return True
+        diagonal = BISHOP_RAYS[square] & (pieces[base + BISHOP] | pieces[base + QUEEN]) & remaining
+        if diagonal and bishop_attacks(square, occupied) & diagonal:
+            return True
+        straight = ROOK_RAYS[square] & (pieces[base + ROOK] | pieces[base + QUEEN]) & remaining
+        return bool(straight and rook_attacks(square, occupied) & straight)
+
+    def pseudo_legal_moves(self):
+        """ Returns the moves generatePseudoLegalMoves in chess.js generates (in a different order) """
+        us = self.color
+        pieces = self.pieces
+        own = self.occupied[us]
+        enemy = self.occupied[us ^ 1]
+        occupied = own | enemy
+        not_own = ~own
+        base = us * 6
+        moves = []
+        append = moves.append
+
+        forward = 8 if us == WHITE else -8
+        promotion_rank = 7 if us == WHITE else 0
+        double_push_rank = 1 if us == WHITE else 6
+        capturable = enemy | (SQUARE_BITS[self.ep_square] if self.ep_square >= 0 else 0)
+        pawn_attacks = PAWN_ATTACKS[us]
+        for square in iter_squares(pieces[base + PAWN]):
+            to_square = square + forward
+            if not 0 <= to_square < 64:
+                continue
+            captures = pawn_attacks[square] & capturable
+            if to_square >> 3 == promotion_rank:
+                if not occupied & SQUARE_BITS[to_square]:
+                    for promotion in PROMOTION_PIECES:
+                        append(square | to_square << 6 | (promotion + 1) << 12)
+                for capture in iter_squares(captures):
+                    for promotion in PROMOTION_PIECES:
+                        append(square | capture << 6 | (promotion + 1) << 12)
+                continue
+            if not occupied & SQUARE_BITS[to_square]:
+                append(square | to_square << 6)
+                if square >> 3 == double_push_rank and not occupied & SQUARE_BITS[to_square + forward]:
+                    append(square | (to_square + forward) << 6)
+            for capture in iter_squares(captures):
+                append(square | capture << 6)
+
+        for square in iter_squares(pieces[base + KNIGHT]):
+            for to_square in iter_squares(KNIGHT_ATTACKS[square] & not_own):
+                append(square | to_square << 6)
+        for square in iter_squares(pieces[base + BISHOP]):
+            for to_square in iter_squares(bishop_attacks(square, occupied) & not_own):
+                append(square | to_square << 6)
+        for square in iter_squares(pieces[base + ROOK]):
+            for to_square in iter_squares(rook_attacks(square, occupied) & not_own):
+                append(square | to_square << 6)
+        for square in iter_squares(pieces[base + QUEEN]):
+            for to_square in iter_squares((bishop_attacks(square, occupied) | rook_attacks(square, occupied)) & not_own):
+                append(square | to_square << 6)
+
+        for square in iter_squares(pieces[base + KING]):
+            for to_square in iter_squares(KING_ATTACKS[square] & not_own):
+                append(square | to_square << 6)
+            # Like chess.js only the castling right and the empty squares between the king and rook are checked here
+            rank = square & 56
+            if self.castling & KINGSIDE_RIGHTS[us] and not occupied & (SQUARE_BITS[rank + 5] | SQUARE_BITS[rank + 6]):
+                append(square | (rank + 6) << 6)
+            if self.castling & QUEENSIDE_RIGHTS[us] and not occupied & (SQUARE_BITS[rank + 1] | SQUARE_BITS[rank + 2] | SQUARE_BITS[rank + 3]):
+                append(square | (rank + 2) << 6)
+        return moves
+
+    def pseudo_legal_targets(self, color):
+        """ Returns the bitboard of every square a pseudo-legal move of `color` moves to (including empty squares) """
+        pieces = self.pieces
+        own = self.occupied[color]
+        occupied = own | self.occupied[color ^ 1]
+        empty = ~occupied & FULL
+        base = color * 6
+        pawns = pieces[base + PAWN]
+        capturable = self.occupied[color ^ 1] | (SQUARE_BITS[self.ep_square] if self.ep_square >= 0 else 0)
+        if color == WHITE:
+            pushes = pawns << 8 & empty
+            targets = pushes | (pushes & RANK_3) << 8 & empty
+            targets |= ((pawns & ~FILE_A) << 7 | (pawns & ~FILE_H) << 9) & capturable
+        else:
+            pushes = pawns >> 8 & empty
+            targets = pushes | (pushes & RANK_6) >> 8 & empty
+            targets |= ((pawns & ~FILE_A) >> 9 | (pawns & ~FILE_H) >> 7) & capturable
+        for square in iter_squares(pieces[base + KNIGHT]):
+            targets |= KNIGHT_ATTACKS[square]
+        for square in iter_squares(pieces[base + BISHOP] | pieces[base + QUEEN]):
+            targets |= bishop_attacks(square, occupied)
+        for square in iter_squares(pieces[base + ROOK] | pieces[base + QUEEN]):
+            targets |= rook_attacks(square, occupied)
+        for square in iter_squares(pieces[base + KING]):
+            targets |= KING_ATTACKS[square]
+            rank = square & 56
+            if self.castling & KINGSIDE_RIGHTS[color] and not occupied & (SQUARE_BITS[rank + 5] | SQUARE_BITS[rank + 6]):
+                targets |= SQUARE_BITS[rank + 6]
+            if self.castling & QUEENSIDE_RIGHTS[color] and not occupied & (SQUARE_BITS[rank + 1] | SQUARE_BITS[rank + 2] | SQUARE_BITS[rank + 3]):
+                targets |= SQUARE_BITS[rank + 2]
+        return targets & ~own
+
+    def _can_castle_through(self, from_square, kingside):
+        """ The castling checks of isLegal: not in check, no attacked squares on the king's path and no enemy pawns in front of it """
+        if self.in_check:
+            return False
+        rank = from_square & 56
+        them = self.color ^ 1
+        if kingside:
+            path = SQUARE_BITS[rank + 5] | SQUARE_BITS[rank + 6]
+            pawn_files = (4, 5, 6, 7)
+        else:
+            path = SQUARE_BITS[rank + 3] | SQUARE_BITS[rank + 2]
+            pawn_files = (4, 3, 2, 1)
+        if self.pseudo_legal_targets(them) & path:
+            return False
+        shift = 8 if self.color == WHITE else -8
+        enemy_pawn = them * 6 + PAWN
+        return not any(0 <= rank + file + shift < 64 and self.squares[rank + file + shift] == enemy_pawn for file in pawn_files)
+
+    def is_legal(self, move):
+        """ Whether a pseudo-legal move is legal, following isLegal in board.js """
+        us = self.color
+        king = self.pieces[us * 6 + KING].bit_length() - 1
+        if king < 0:
+            return False
+        from_square = move & 63
+        to_square = move >> 6 & 63
+        to_bit = SQUARE_BITS[to_square]
+        piece = self.squares[from_square] - us * 6
+        castling = piece == KING and from_square & 7 == 4 and to_square & 7 in (6, 2)
+        if castling and not self._can_castle_through(from_square, to_square & 7 == 6):
+            return False
+
+        if self.atomic:
+            is_capture = self.squares[to_square] != EMPTY or (piece == PAWN and to_square == self.ep_square)
+            # Kings can't capture
+            if piece == KING and is_capture:
+                return False
+            other_king = self.pieces[(us ^ 1) * 6 + KING].bit_length() - 1
+            if other_king < 0:
+                return False
+            if is_capture:
+                # A capture can't explode our own king but exploding the enemy king wins even when in check
+                if KING_ATTACKS[king] & to_bit:
+                    return False
+                if to_square == other_king or KING_ATTACKS[other_king] & to_bit:
+                    return True
+            # Touching kings can't be captured as the capture would explode both
+            if piece == KING:
+                if KING_ATTACKS[other_king] & to_bit:
+                    return True
+            elif KING_ATTACKS[other_king] & SQUARE_BITS[king]:
+                return True
+
+        # Moves which only move one piece and remove at most the piece they capture are checked without applying them
+        if not castling and (not self.atomic or self.squares[to_square] == EMPTY) and not (piece == PAWN and to_square == self.ep_square):
+            occupied = (self.occupied[WHITE] | self.occupied[BLACK]) & ~SQUARE_BITS[from_square] | to_bit
+            return not self.is_attacked(to_square if piece == KING else king, us ^ 1, occupied, ~to_bit)
+
+        self.make_move(move)
+        king = self.pieces[us * 6 + KING].bit_length() - 1
+        legal = king < 0 or not self.is_attacked(king, us ^ 1)
+        self.unmake_move()
+        return legal
+
+    def legal_moves(self):
+        return [move for move in self.pseudo_legal_moves() if self.is_legal(move)]
+
+    def has_legal_move(self):
+        return any(self.is_legal(move) for move in self.pseudo_legal_moves())
+
+    def _explode(self, square):
+        """ Removes the non-pawn pieces around a capture and the capturing piece """
+        pieces = self.pieces
+        blast = EXPLOSION_MASKS[square] & (self.occupied[WHITE] | self.occupied[BLACK]) & ~(pieces[PAWN] | pieces[6 + PAWN])
+        for blast_square in iter_squares(blast):
+            piece = self.squares[blast_square]
+            if piece % 6 == ROOK:
+                self.castling &= ~ROOK_SQUARE_RIGHTS[piece // 6][blast_square]
+            self._remove(blast_square)
+        self._remove(square)
+
+    def make_move(self, move):
+        """ Applies a pseudo-legal move, following applyMove in board.js """
+        from_square = move & 63
+        to_square = move >> 6 & 63
+        promotion = (move >> 12) - 1
+        us = self.color
+        squares = self.squares
+        self._undo.append((self.pieces[:], self.occupied[:], squares[:], self.castling, self.ep_square, self.in_check))
+        moving = squares[from_square]
+        piece = moving - us * 6
+        captured = squares[to_square]
+        ep_square = self.ep_square
+        self.ep_square = -1
+
+        self._remove(from_square)
+        if captured != EMPTY:
+            self._remove(to_square)
+        self._put(to_square, moving)
+        if captured != EMPTY:
+            if captured % 6 == ROOK:
+                self.castling &= ~ROOK_SQUARE_RIGHTS[captured // 6][to_square]
+            if self.atomic:
+                self._explode(to_square)
+        if piece == PAWN and to_square == ep_square:
+            self._remove(to_square - 8 if us == WHITE else to_square + 8)
+            if self.atomic:
+                self._explode(to_square)
+
+        if promotion != NO_PIECE and piece == PAWN and (not self.atomic or captured == EMPTY):
+            self._remove(to_square)
+            self._put(to_square, us * 6 + promotion)
+        if piece == PAWN and abs((from_square >> 3) - (to_square >> 3)) == 2:
+            self.ep_square = to_square - 8 if us == WHITE else to_square + 8
+        elif piece == KING:
+            self.castling &= ~(KINGSIDE_RIGHTS[us] | QUEENSIDE_RIGHTS[us])
+            # Castling moves the rook from the corner of the king's rank
+            if from_square & 7 == 4 and to_square & 7 in (6, 2):
+                rank = from_square & 56
+                rook_from, rook_to = (rank + 7, rank + 5) if to_square & 7 == 6 else (rank, rank + 3)
+                self._remove(rook_from)
+                self._remove(rook_to)
+                self._put(rook_to, us * 6 + ROOK)
+        elif piece == ROOK:
+            self.castling &= ~ROOK_SQUARE_RIGHTS[us][from_square]
+
+        # Checks are any pseudo-legal move to the enemy king, even by our king
+        other_king = self.pieces[(us ^ 1) * 6 + KING].bit_length() - 1
+        self.in_check = other_king >= 0 and self.is_attacked(other_king, us)
+        self.color = us ^ 1
+
+    def unmake_move(self):
+        """ Reverts the last move applied with make_move """
+        self.pieces, self.occupied, self.squares, self.castling, self.ep_square, self.in_check = self._undo.pop()
+        self.color ^= 1
+
+    def result(self):
+        """ Returns VALID, DRAW, WHITE_WIN or BLACK_WIN, following getResult in board.js """
+        white_king = self.king_square(WHITE)
+        black_king = self.king_square(BLACK)
+        if white_king < 0 or black_king < 0:
+            return WHITE_WIN if black_king < 0 else BLACK_WIN
+        if not (self.occupied[WHITE] | self.occupied[BLACK]) & ~(self.pieces[KING] | self.pieces[6 + KING]):
+            return DRAW
+        if self.has_legal_move():
+            return VALID
+        if self.in_check:
+            return WHITE_WIN if self.color == BLACK else BLACK_WIN
+        return DRAW
+
+def perft(position, depth):
+    """ Returns the number of move sequences of length `depth`, counted the same way as perft in chess.js """
+    if depth <= 0:
+        return 1
+    moves = position.legal_moves()
+    if depth == 1:
+        return len(moves)
+    total = 0
+    for move in moves:
+        position.make_move(move)
+        total += perft(position, depth - 1)
+        position.unmake_move()
+    return total
@@ -0,0 +1,143 @@
+""" Module that counts and times the SQL queries of each request
+Adds a Server-Timing header to every response, logs requests slower than SLOW_REQUEST_BUDGET_MS and
+keeps per-endpoint totals and histograms in memory (see request_metrics).
+"""
+import bisect
+import logging
+import re
+import threading
+import time
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy import sqlalchemy
+from app import app
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (in milliseconds) of the request duration histogram buckets, the last bucket has no upper bound
+DURATION_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# Longest statement text kept for the slowest queries
+MAX_STATEMENT_LENGTH = 300
+
+def shorten_statement(statement):
+    """ Replaces the column list of a SELECT with ... so the tables and conditions fit in the kept text """
+    return re.sub(r"^SELECT\s.*?\sFROM\s", "SELECT ... FROM ", " ".join(statement.split()), count=1)[:MAX_STATEMENT_LENGTH]
+
+class RequestStats:
+    """ SQL statistics of the current request """
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.query_count = 0
+        self.sql_time = 0
+        # List of (seconds, statement) of the slowest queries, slowest first
+        self.slowest_queries = []
+
+    def add_query(self, statement, duration):
+        self.query_count += 1
+        self.sql_time += duration
+        if len(self.slowest_queries) < app.config["SLOW_QUERIES_KEPT"] or duration > self.slowest_queries[-1][0]:
+            self.slowest_queries.append((duration, shorten_statement(statement)))
+            self.slowest_queries.sort(key=lambda query: -query[0])
+            del self.slowest_queries[app.config["SLOW_QUERIES_KEPT"]:]
+
+class EndpointStats:
+    """ Totals and a histogram of the request durations of an endpoint """
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0
+        self.query_count = 0
+        self.sql_time = 0
+        self.max_query_count = 0
+        # Number of requests in each of DURATION_BUCKETS_MS (not cumulative), plus one for slower requests
+        self.buckets = [0] * (len(DURATION_BUCKETS_MS) + 1)
+        self.slowest_queries = []
+
+    def add_request(self, duration, stats):
+        self.count += 1
+        self.total_time += duration
+        self.query_count += stats.query_count
+        self.sql_time += stats.sql_time
+        self.max_query_count = max(self.max_query_count, stats.query_count)
+        self.buckets[bisect.bisect_left(DURATION_BUCKETS_MS, duration * 1000)] += 1
+        self.slowest_queries = sorted(self.slowest_queries + stats.slowest_queries, key=lambda query: -query[0])[:app.config["SLOW_QUERIES_KEPT"]]
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "total_time": self.total_time,
+            "query_count": self.query_count,
+            "sql_time": self.sql_time,
+            "max_query_count": self.max_query_count,
+            "buckets": list(self.buckets),
+            "slowest_queries": list(self.slowest_queries),
+        }
+
+class RequestMetrics:
+    """ Per-endpoint request statistics of this worker """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, duration, stats):
+        with self._lock:
+            self._endpoints.setdefault(endpoint, EndpointStats()).add_request(duration, stats)
+
+    def snapshot(self):
+        """ Returns a JSON serializable copy of the statistics keyed by endpoint """
+        with self._lock:
+            return { endpoint: stats.to_json() for endpoint, stats in self._endpoints.items() }
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+request_metrics = RequestMetrics()
+
+def get_request_stats():
+    """ Returns the statistics of the current request, or None outside of a request (e.g. background threads) """
+    if not has_request_context():
+        return None
+    return g.get("request_stats")
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_times", []).append(time.perf_counter())
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["query_start_times"].pop()
+    stats = get_request_stats()
+    if stats is not None:
+        stats.add_query(statement, duration)
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, "handle_error")
+def discard_query_start_time(exception_context):
+    # after_cursor_execute isn't called for a statement that raises, so its start time is removed here
+    connection = exception_context.connection
+    if connection is not None:
+        start_times = connection.info.get("query_start_times")
+        if start_times:
+            start_times.pop()
+
+@app.before_request
+def start_request_stats():
+    if app.config["SQL_INSTRUMENTATION"]:
+        g.request_stats = RequestStats()
+
+@app.after_request
+def record_request_stats(response):
+    stats = g.pop("request_stats", None)
+    if stats is None:
+        return response
+    duration = time.perf_counter() - stats.start_time
+    endpoint = request.endpoint or "unknown"
+    request_metrics.record(endpoint, duration, stats)
+
+    response.headers.add("Server-Timing", 'db;dur={:.1f};desc="{} queries"'.format(stats.sql_time * 1000, stats.query_count))
+    response.headers.add("Server-Timing", "app;dur={:.1f}".format(duration * 1000))
+
+    if duration * 1000 > app.config["SLOW_REQUEST_BUDGET_MS"]:
+        logger.warning("Slow request %s %s (%s): %.1f ms, %d queries taking %.1f ms, slowest: %s",
+            request.method, request.path, endpoint, duration * 1000, stats.query_count, stats.sql_time * 1000,
+            "; ".join("{:.1f} ms {}".format(seconds * 1000, statement) for seconds, statement in stats.slowest_queries))
+    return response
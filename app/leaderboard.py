@@ -0,0 +1,113 @@
+""" Module that keeps the fastest final test times in memory so the leaderboard doesn't need to sort every user """
+import bisect
+import math
+import threading
+import time
+
+from app import app, db
+from app.models import User
+
+# Test times are rounded to 0.1 seconds so they can be counted in fixed buckets
+# Any time slower than MAX_BUCKETED_TIME shares the final bucket
+TIME_RESOLUTION = 0.1
+MAX_BUCKETED_TIME = 3600
+NUM_BUCKETS = int(MAX_BUCKETED_TIME / TIME_RESOLUTION) + 1
+
+class FenwickTree:
+    """ Binary indexed tree which supports adding to a bucket and counting a prefix of buckets in O(log n) """
+    def __init__(self, size):
+        self._tree = [0] * (size + 1)
+
+    def add(self, index, amount):
+        index += 1
+        while index < len(self._tree):
+            self._tree[index] += amount
+            index += index & -index
+
+    def prefix_sum(self, index):
+        """ Returns the sum of the buckets [0, index) """
+        total = 0
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+
+class Leaderboard:
+    """ Keeps the best test time of every user, a sorted list of the fastest `size` users and a
+    Fenwick tree of the times so that the rank of any user can be found in logarithmic time.
+    Loaded lazily from User.best_test_time and reloaded after LEADERBOARD_TTL seconds to pick up tests finished on other workers.
+    """
+    def __init__(self, size=10):
+        self.size = size
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._reset()
+
+    def _reset(self):
+        self._best_times = {}
+        self._counts = FenwickTree(NUM_BUCKETS)
+        # Sorted list of (time, user_id)
+        self._top = []
+
+    def _bucket(self, time_taken):
+        return min(int(round(time_taken / TIME_RESOLUTION)), NUM_BUCKETS - 1)
+
+    def _ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < app.config["LEADERBOARD_TTL"]:
+            return
+        rows = db.session.query(User.id, User.best_test_time).filter(User.best_test_time!=None).all()
+        with self._lock:
+            self._reset()
+            for user_id, time_taken in rows:
+                self._record(user_id, time_taken)
+            self._loaded_at = time.monotonic()
+
+    def _record(self, user_id, time_taken):
+        previous_time = self._best_times.get(user_id)
+        if previous_time is not None and previous_time <= time_taken:
+            return
+        self._best_times[user_id] = time_taken
+        if previous_time is not None:
+            self._counts.add(self._bucket(previous_time), -1)
+            if (previous_time, user_id) in self._top:
+                self._top.remove((previous_time, user_id))
+        self._counts.add(self._bucket(time_taken), 1)
+        # Times only ever decrease so a user that falls out of the top list can only return through this function
+        if len(self._top) < self.size or (time_taken, user_id) < self._top[-1]:
+            bisect.insort(self._top, (time_taken, user_id))
+            del self._top[self.size:]
+
+    def record(self, user_id, time_taken):
+        """ Records a finished test, only kept if it is the user's best time """
+        self._ensure_loaded()
+        with self._lock:
+            self._record(user_id, time_taken)
+
+    def clear(self):
+        """ Drops the loaded times, forcing them to be reloaded from the database """
+        with self._lock:
+            self._reset()
+            self._loaded_at = None
+
+    def get_best_times(self):
+        """ Returns the fastest users as a list of (user, time) pairs """
+        self._ensure_loaded()
+        with self._lock:
+            top = list(self._top)
+        users = { user.id: user for user in User.query.filter(User.id.in_([user_id for _, user_id in top])) } if top else {}
+        return [(users[user_id], time_taken) for time_taken, user_id in top if user_id in users]
+
+    def get_placement(self, user_id):
+        """ Returns (rank, number of ranked users, top percentage) for a user or None if they haven't completed a test
+        Users with the same time share a rank.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            time_taken = self._best_times.get(user_id)
+            if time_taken is None:
+                return None
+            total = len(self._best_times)
+            rank = self._counts.prefix_sum(self._bucket(time_taken)) + 1
+        return rank, total, math.ceil(100 * rank / total)
+
+leaderboard = Leaderboard()
@@ -0,0 +1,208 @@
+""" Module that shares the request metrics of every worker through files so any worker can report fleet-wide numbers
+Each worker writes a JSON snapshot of its own totals to METRICS_DIRECTORY (at most every METRICS_WRITE_INTERVAL seconds).
+The totals only ever increase so merging is a sum of the files of the running workers.
+The totals of workers that have exited are folded into an archive snapshot before their files are deleted,
+so that the fleet totals never go down (Prometheus would read a drop as a counter reset).
+"""
+import glob
+import json
+import os
+import time
+
+# fcntl is POSIX only, Windows locks files with msvcrt and checks processes through the Win32 API
+if os.name == "nt":
+    import ctypes
+    import msvcrt
+else:
+    import fcntl
+
+from app import app
+from app.instrumentation import DURATION_BUCKETS_MS, request_metrics
+from app.user_cache import user_cache
+from app.completion_writer import completion_writer
+
+# Totals of EndpointStats which are summed across workers
+SUMMED_FIELDS = ("count", "total_time", "query_count", "sql_time")
+
+# Win32 constants used by is_process_running
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+ERROR_ACCESS_DENIED = 5
+STILL_ACTIVE = 259
+
+def get_metrics_directory():
+    return app.config["METRICS_DIRECTORY"] or os.path.join(app.instance_path, "metrics")
+
+def get_worker_snapshot():
+    """ Returns the totals of this worker """
+    endpoints = request_metrics.snapshot()
+    for stats in endpoints.values():
+        # Statement text isn't merged
+        del stats["slowest_queries"]
+    return {
+        "pid": os.getpid(),
+        "endpoints": endpoints,
+        "user_cache": { "hits": user_cache.hits, "misses": user_cache.misses },
+        "completion_queue_size": completion_writer.queue_size,
+    }
+
+def read_snapshot(path):
+    """ Returns the snapshot in a file, or None if it can't be read (e.g. deleted by another worker) """
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def write_snapshot(path, snapshot):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(snapshot, file)
+    os.replace(temporary_path, path)
+
+class WorkerMetricsFile:
+    """ The metrics file of this worker """
+    def __init__(self):
+        self._written_at = None
+
+    def write(self):
+        """ Atomically replaces the file of this worker with its current totals """
+        directory = get_metrics_directory()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "worker-{}.json".format(os.getpid()))
+        write_snapshot(path, get_worker_snapshot())
+        self._written_at = time.monotonic()
+
+    def write_if_due(self):
+        # Checked without a lock, two threads writing the same snapshot at once is harmless
+        if self._written_at is None or time.monotonic() - self._written_at >= app.config["METRICS_WRITE_INTERVAL"]:
+            self.write()
+
+worker_metrics_file = WorkerMetricsFile()
+
+def is_process_running(pid):
+    """ Returns whether the process with the pid is still running """
+    if os.name == "nt":
+        # os.kill terminates the process on Windows instead of probing it
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            # The process exists but can't be opened by this user
+            return ctypes.get_last_error() == ERROR_ACCESS_DENIED
+        try:
+            exit_code = ctypes.c_ulong()
+            return bool(kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))) and exit_code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def lock_exclusively(lock_file):
+    """ Waits until this process holds the exclusive lock on an open file, which is released when the file is closed """
+    if os.name == "nt":
+        # Locks the first byte, LK_LOCK retries every second for 10 seconds before raising OSError
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+    else:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+def archive_worker_snapshot(path):
+    """ Adds the totals in the file of an exited worker to the archive snapshot and deletes the file
+    The archive has no pid and no queued completions (a gauge which isn't kept after a worker exits).
+    """
+    directory = get_metrics_directory()
+    archive_path = os.path.join(directory, "archive.json")
+    with open(os.path.join(directory, "archive.lock"), "w") as lock_file:
+        # Only one worker folds a file into the archive, others find it already deleted
+        lock_exclusively(lock_file)
+        snapshot = read_snapshot(path)
+        if snapshot is None:
+            return
+        archive = read_snapshot(archive_path)
+        merged = merge_snapshots([archive, snapshot] if archive is not None else [snapshot])
+        write_snapshot(archive_path, { "pid": None, "endpoints": merged["endpoints"], "user_cache": merged["user_cache"], "completion_queue_size": 0 })
+        os.remove(path)
+
+def read_fleet_snapshots():
+    """ Returns the snapshots of every running worker (including this one, which is written first) and the archive of exited workers
+    Files left by workers that have exited are folded into the archive.
+    """
+    worker_metrics_file.write()
+    snapshots = []
+    for path in glob.glob(os.path.join(get_metrics_directory(), "worker-*.json")):
+        snapshot = read_snapshot(path)
+        if snapshot is None:
+            continue
+        if snapshot["pid"] != os.getpid() and not is_process_running(snapshot["pid"]):
+            archive_worker_snapshot(path)
+        else:
+            snapshots.append(snapshot)
+    archive = read_snapshot(os.path.join(get_metrics_directory(), "archive.json"))
+    if archive is not None:
+        snapshots.append(archive)
+    return snapshots
+
+def merge_snapshots(snapshots):
+    """ Sums the totals of several worker snapshots """
+    merged = { "workers": sum(1 for snapshot in snapshots if snapshot["pid"] is not None), "endpoints": {}, "user_cache": { "hits": 0, "misses": 0 }, "completion_queue_size": 0 }
+    for snapshot in snapshots:
+        for endpoint, stats in snapshot["endpoints"].items():
+            totals = merged["endpoints"].setdefault(endpoint, { **{ field: 0 for field in SUMMED_FIELDS }, "max_query_count": 0, "buckets": [0] * (len(DURATION_BUCKETS_MS) + 1) })
+            for field in SUMMED_FIELDS:
+                totals[field] += stats[field]
+            totals["max_query_count"] = max(totals["max_query_count"], stats["max_query_count"])
+            totals["buckets"] = [a + b for a, b in zip(totals["buckets"], stats["buckets"])]
+        merged["user_cache"]["hits"] += snapshot["user_cache"]["hits"]
+        merged["user_cache"]["misses"] += snapshot["user_cache"]["misses"]
+        merged["completion_queue_size"] += snapshot["completion_queue_size"]
+    return merged
+
+def format_prometheus(merged, active_tests):
+    """ Formats merged metrics in the Prometheus text exposition format """
+    lines = []
+    def add_metric(name, metric_type, description, samples):
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for suffix, labels, value in samples:
+            label_text = ",".join('{}="{}"'.format(key, label) for key, label in labels)
+            lines.append("{}{}{} {}".format(name, suffix, "{" + label_text + "}" if label_text else "", value))
+
+    endpoints = sorted(merged["endpoints"].items())
+    add_metric("atomic_http_requests_total", "counter", "Number of requests served.",
+        [("", [("endpoint", endpoint)], stats["count"]) for endpoint, stats in endpoints])
+
+    histogram_samples = []
+    for endpoint, stats in endpoints:
+        cumulative = 0
+        for upper_bound, count in zip(DURATION_BUCKETS_MS + ("+Inf",), stats["buckets"]):
+            cumulative += count
+            le = "+Inf" if upper_bound == "+Inf" else repr(upper_bound / 1000)
+            histogram_samples.append(("_bucket", [("endpoint", endpoint), ("le", le)], cumulative))
+        histogram_samples.append(("_sum", [("endpoint", endpoint)], stats["total_time"]))
+        histogram_samples.append(("_count", [("endpoint", endpoint)], stats["count"]))
+    add_metric("atomic_http_request_duration_seconds", "histogram", "Time taken to serve requests.", histogram_samples)
+
+    add_metric("atomic_db_queries_total", "counter", "Number of SQL queries made by requests.",
+        [("", [("endpoint", endpoint)], stats["query_count"]) for endpoint, stats in endpoints])
+    add_metric("atomic_db_time_seconds_total", "counter", "Time spent executing SQL queries for requests.",
+        [("", [("endpoint", endpoint)], stats["sql_time"]) for endpoint, stats in endpoints])
+
+    cache = merged["user_cache"]
+    lookups = cache["hits"] + cache["misses"]
+    add_metric("atomic_user_cache_hits_total", "counter", "Number of user cache lookups served from the cache.", [("", [], cache["hits"])])
+    add_metric("atomic_user_cache_misses_total", "counter", "Number of user cache lookups that queried the database.", [("", [], cache["misses"])])
+    add_metric("atomic_user_cache_hit_ratio", "gauge", "Fraction of user cache lookups served from the cache.", [("", [], cache["hits"] / lookups if lookups else 0)])
+
+    add_metric("atomic_completion_queue_size", "gauge", "Number of puzzle completions waiting to be saved.", [("", [], merged["completion_queue_size"])])
+    add_metric("atomic_active_tests", "gauge", "Number of final tests started recently which haven't been finished.", [("", [], active_tests)])
+    add_metric("atomic_metrics_workers", "gauge", "Number of workers included in these metrics.", [("", [], merged["workers"])])
+    return "\n".join(lines) + "\n"
+
+@app.after_request
+def write_worker_metrics(response):
+    if app.config["SQL_INSTRUMENTATION"]:
+        worker_metrics_file.write_if_due()
+    return response
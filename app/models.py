@@ -1,8 +1,11 @@
+import hashlib
 import json
 
 from app.lessons import get_all_lessons
+from app.move_trees import encode_move_tree, decode_move_tree
 from flask_sqlalchemy import sqlalchemy
-from app import db
+from sqlalchemy.ext.compiler import compiles
+from app import app, db
 from datetime import datetime
 
 # Column type that represents a JSON object stored as TEXT in the database
@@ -19,6 +22,48 @@ class JSONString(sqlalchemy.TypeDecorator):
 			value = json.loads(value)
 		return value
 
+# SQL expression for the number of seconds between two DateTime columns
+class seconds_between(sqlalchemy.sql.expression.FunctionElement):
+	type = sqlalchemy.types.Float()
+	name = "seconds_between"
+
+@compiles(seconds_between)
+def compile_seconds_between(element, compiler, **kw):
+	start, end = list(element.clauses)
+	return "EXTRACT(EPOCH FROM ({} - {}))".format(compiler.process(end, **kw), compiler.process(start, **kw))
+
+@compiles(seconds_between, "sqlite")
+def compile_seconds_between_sqlite(element, compiler, **kw):
+	start, end = list(element.clauses)
+	return "((julianday({}) - julianday({})) * 86400.0)".format(compiler.process(end, **kw), compiler.process(start, **kw))
+
+@compiles(seconds_between, "mysql")
+def compile_seconds_between_mysql(element, compiler, **kw):
+	start, end = list(element.clauses)
+	return "(TIMESTAMPDIFF(MICROSECOND, {}, {}) / 1000000.0)".format(compiler.process(start, **kw), compiler.process(end, **kw))
+
+# Names of the global counters stored in StatsCounter
+STAT_NUM_USERS = "num_users"
+STAT_NUM_CHESS_BEGINNERS = "num_chess_beginners"
+
+# Global counters which are updated in the same transaction as the rows they count
+# so that the stats page doesn't need to count entire tables
+class StatsCounter(db.Model):
+	name = db.Column(db.String(40), primary_key=True)
+	value = db.Column(db.Integer, nullable=False, default=0)
+
+	@staticmethod
+	def get(name):
+		counter = StatsCounter.query.get(name)
+		return counter.value if counter is not None else 0
+
+	@staticmethod
+	def increment(name, amount=1):
+		""" Increments a counter as part of the current transaction (caller commits) """
+		updated = StatsCounter.query.filter_by(name=name).update({ StatsCounter.value: StatsCounter.value + amount }, synchronize_session=False)
+		if updated == 0:
+			db.session.add(StatsCounter(name=name, value=amount))
+
 class User(db.Model):
 	id = db.Column(db.Integer, primary_key=True)
 	username = db.Column(db.String(80), unique=True, nullable=False)
@@ -28,6 +73,8 @@ class User(db.Model):
 	is_admin = db.Column(db.Boolean, nullable=False, default=False)
 	# Personal settings like board square colors, etc.
 	settings = db.Column(JSONString, default={})
+	# Fastest time (in seconds) taken to complete the final test, None if no test has been completed
+	best_test_time = db.Column(db.Float, nullable=True, index=True)
 
 	# List of all LessonCompletions
 	lessons = db.relationship("LessonCompletion", lazy=True)
@@ -38,38 +85,48 @@ class User(db.Model):
 		return '<User %r>' % self.username
 
 	def get_num_users():
-		return len(User.query.all())
+		return StatsCounter.get(STAT_NUM_USERS)
 
 	def get_num_completed_lessons(self):
 		return len(self.lessons)
 	
 	def get_percentage_chess_beginners():
-		num = len(User.query.filter_by(chess_beginner=True).all())
-		return int(100*num/User.get_num_users())
+		num_users = User.get_num_users()
+		if num_users == 0:
+			return 0
+		return int(100*StatsCounter.get(STAT_NUM_CHESS_BEGINNERS)/num_users)
+
+	def record_test_time(user_id, time_taken):
+		""" Updates the best test time of a user as part of the current transaction (caller commits) """
+		User.query.filter(User.id==user_id, (User.best_test_time==None) | (User.best_test_time > time_taken)).update({ User.best_test_time: time_taken }, synchronize_session=False)
 
 	def get_performance(self):
+		""" Returns the average time and accuracy for each lesson along with the number of completed puzzles
+		Reads the LessonPerformance rows if USE_PERFORMANCE_SUMMARY is enabled, otherwise aggregates the completions in a single grouped query
+		"""
+		if app.config["USE_PERFORMANCE_SUMMARY"]:
+			rows = db.session.query(LessonPerformance.lesson_id, LessonPerformance.num_puzzles, LessonPerformance.total_time, LessonPerformance.total_accuracy).filter(LessonPerformance.user==self.id)
+		else:
+			rows = LessonPerformance.query_completion_totals().filter(PuzzleCompletion.user==self.id)
+
 		time_taken_by_lesson_id = {}
 		num_puzzles_by_lesson_id = {}
 		accuracy_by_lesson_id = {}
-		completed_puzzles = PuzzleCompletion.query.filter(PuzzleCompletion.user==self.id)
-
-		for completed_puzzle in completed_puzzles:
-			lesson_id = completed_puzzle.puzzle.lesson_id
-			time_taken = completed_puzzle.end_time.timestamp() - completed_puzzle.start_time.timestamp()
-			time_taken_by_lesson_id[lesson_id] = time_taken_by_lesson_id.get(lesson_id, 0) + time_taken
-			num_puzzles_by_lesson_id[lesson_id] = num_puzzles_by_lesson_id.get(lesson_id, 0) + 1
-			accuracy_by_lesson_id[lesson_id] = accuracy_by_lesson_id.get(lesson_id, 0) + 1/completed_puzzle.attempts
+		for lesson_id, num_puzzles, total_time, total_accuracy in rows:
+			time_taken_by_lesson_id[lesson_id] = total_time
+			num_puzzles_by_lesson_id[lesson_id] = num_puzzles
+			accuracy_by_lesson_id[lesson_id] = total_accuracy
 
 		NUM_LESSONS = len(get_all_lessons())
 		time_performance = [0]*NUM_LESSONS
 		average_accuracy = [0]*NUM_LESSONS
 
 		for i in range(NUM_LESSONS):
-			if i in time_taken_by_lesson_id:
+			if num_puzzles_by_lesson_id.get(i):
 				average_accuracy[i] = round(100*accuracy_by_lesson_id[i]/num_puzzles_by_lesson_id[i], 1)
 				time_performance[i] = round(time_taken_by_lesson_id[i]/num_puzzles_by_lesson_id[i], 1)
 
-		return time_performance, num_puzzles_by_lesson_id, len(completed_puzzles.all()), average_accuracy
+		return time_performance, num_puzzles_by_lesson_id, sum(num_puzzles_by_lesson_id.values()), average_accuracy
 
 class LessonCompletion(db.Model):
 	user = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True, nullable=False)
@@ -85,12 +142,34 @@ class Puzzle(db.Model):
 	# https://en.wikipedia.org/wiki/Forsyth%E2%80%93Edwards_Notation
 	# FEN string which represents the starting position of the puzzle
 	fen = db.Column(db.Text, nullable=False)
-	# JSON object which represents the tree of correct moves for the puzzle
-	move_tree = db.Column(JSONString, nullable=False)
+	# Tree of correct moves for the puzzle, packed by app/move_trees.py (read and written through move_tree)
+	move_tree_data = db.Column("move_tree", db.LargeBinary, nullable=False)
 	is_atomic = db.Column(db.Boolean, nullable=False)
 	# The lesson which this puzzle is associated with
 	# Note that lessons are not stored in the database so this is not a foreign key
-	lesson_id = db.Column(db.Integer, nullable=False)
+	lesson_id = db.Column(db.Integer, nullable=False, index=True)
+	# SHA-256 of the fen and move tree which identifies the puzzle when the puzzle corpus is seeded
+	content_hash = db.Column(db.String(64), nullable=True, index=True)
+
+	@property
+	def move_tree(self):
+		""" The tree of correct moves, only decoded when it is first used """
+		cached = getattr(self, "_move_tree_cache", None)
+		if cached is None or cached[0] is not self.move_tree_data:
+			cached = (self.move_tree_data, decode_move_tree(self.move_tree_data))
+			self._move_tree_cache = cached
+		return cached[1]
+
+	@move_tree.setter
+	def move_tree(self, move_tree):
+		self.move_tree_data = encode_move_tree(move_tree)
+		self._move_tree_cache = (self.move_tree_data, move_tree)
+
+	@staticmethod
+	def compute_content_hash(fen, move_tree):
+		""" Returns the hash of a puzzle's content, independent of the key order of the move tree """
+		content = json.dumps({ "fen": fen, "move_tree": move_tree }, sort_keys=True, separators=(",", ":"))
+		return hashlib.sha256(content.encode()).hexdigest()
 
 	def to_json(self):
 		""" Get a JSON representation for the puzzle """
@@ -102,7 +181,19 @@ class Puzzle(db.Model):
 			"lesson_id": self.lesson_id,
 		}
 
+@sqlalchemy.event.listens_for(Puzzle, "before_insert")
+@sqlalchemy.event.listens_for(Puzzle, "before_update")
+def set_puzzle_content_hash(mapper, connection, puzzle):
+	puzzle.content_hash = Puzzle.compute_content_hash(puzzle.fen, puzzle.move_tree)
+
 class PuzzleCompletion(db.Model):
+	__table_args__ = (
+		# Completions of a test (optionally for a user and puzzle)
+		db.Index("ix_puzzle_completion_test_number_user_puzzle_id", "test_number", "user", "puzzle_id"),
+		# Completions of a user (User.completed_puzzles and the performance totals)
+		db.Index("ix_puzzle_completion_user_puzzle_id", "user", "puzzle_id"),
+	)
+
 	id = db.Column(db.Integer, primary_key=True)
 	user = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
 	puzzle_id = db.Column(db.Integer, db.ForeignKey("puzzle.id"), nullable=False)
@@ -115,27 +206,91 @@ class PuzzleCompletion(db.Model):
 
 	puzzle = db.relationship("Puzzle", lazy=True, uselist=False, backref="completions")
 
+# Running totals of a user's puzzle completions for a lesson, updated whenever a completion is saved
+class LessonPerformance(db.Model):
+	user = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True, nullable=False)
+	lesson_id = db.Column(db.Integer, primary_key=True, nullable=False)
+	num_puzzles = db.Column(db.Integer, nullable=False, default=0)
+	# Sum of the seconds taken to solve each puzzle
+	total_time = db.Column(db.Float, nullable=False, default=0)
+	# Sum of 1/attempts for each puzzle
+	total_accuracy = db.Column(db.Float, nullable=False, default=0)
+
+	@staticmethod
+	def query_completion_totals():
+		""" Returns a query of (lesson_id, num_puzzles, total_time, total_accuracy) aggregated from PuzzleCompletion, grouped by lesson """
+		return db.session.query(
+			Puzzle.lesson_id,
+			sqlalchemy.func.count(PuzzleCompletion.id),
+			sqlalchemy.func.sum(seconds_between(PuzzleCompletion.start_time, PuzzleCompletion.end_time)),
+			sqlalchemy.func.sum(sqlalchemy.literal(1.0) / PuzzleCompletion.attempts),
+		).join(Puzzle, Puzzle.id==PuzzleCompletion.puzzle_id).group_by(Puzzle.lesson_id)
+
+	@staticmethod
+	def record_completion(user_id, lesson_id, time_taken, attempts):
+		""" Adds a completion to the totals as part of the current transaction (caller commits) """
+		LessonPerformance.add_totals(user_id, lesson_id, 1, time_taken, 1/attempts)
+
+	@staticmethod
+	def add_totals(user_id, lesson_id, num_puzzles, total_time, total_accuracy):
+		""" Adds the totals of one or more completions as part of the current transaction (caller commits) """
+		updated = LessonPerformance.query.filter_by(user=user_id, lesson_id=lesson_id).update({
+			LessonPerformance.num_puzzles: LessonPerformance.num_puzzles + num_puzzles,
+			LessonPerformance.total_time: LessonPerformance.total_time + total_time,
+			LessonPerformance.total_accuracy: LessonPerformance.total_accuracy + total_accuracy,
+		}, synchronize_session=False)
+		if updated == 0:
+			db.session.add(LessonPerformance(user=user_id, lesson_id=lesson_id, num_puzzles=num_puzzles, total_time=total_time, total_accuracy=total_accuracy))
+
+	@staticmethod
+	def rebuild(user_id=None):
+		""" Recomputes the totals from PuzzleCompletion (for all users if user_id==None) as part of the current transaction """
+		query = LessonPerformance.query_completion_totals().add_columns(PuzzleCompletion.user).group_by(PuzzleCompletion.user)
+		delete_query = LessonPerformance.query
+		if user_id is not None:
+			query = query.filter(PuzzleCompletion.user==user_id)
+			delete_query = delete_query.filter_by(user=user_id)
+		delete_query.delete(synchronize_session=False)
+		db.session.bulk_insert_mappings(LessonPerformance, [
+			{ "user": user, "lesson_id": lesson_id, "num_puzzles": num_puzzles, "total_time": total_time, "total_accuracy": total_accuracy }
+			for lesson_id, num_puzzles, total_time, total_accuracy, user in query
+		])
+
 # A series of puzzles make up the final test
 class Test(db.Model):
+	__table_args__ = (
+		# Finished tests of a user
+		db.Index("ix_test_user_end_time", "user", "end_time"),
+		# Unfinished tests started after a given time (the active tests metric)
+		db.Index("ix_test_end_time_start_time", "end_time", "start_time"),
+	)
+
 	id = db.Column(db.Integer, primary_key=True)
 	user = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
 	start_time = db.Column(db.DateTime, nullable=False)
 	end_time = db.Column(db.DateTime, nullable=True)
+	# Ordered list of the ids of the puzzles chosen for the test
+	puzzle_plan = db.Column(JSONString, nullable=True)
+	# Number of puzzles in the plan that have been completed (index of the current puzzle)
+	completed_puzzles = db.Column(db.Integer, nullable=False, default=0)
 
 	def __repr__(self):
 		return "Test {} completed by User {}".format(self.id, self.user)
+
+	def get_current_puzzle_id(self):
+		""" Returns the id of the puzzle the user is currently on, or None if every puzzle has been completed """
+		if self.puzzle_plan is None or self.completed_puzzles >= len(self.puzzle_plan):
+			return None
+		return self.puzzle_plan[self.completed_puzzles]
+
+	def is_final_puzzle(self):
+		""" Returns True if the current puzzle is the last puzzle of the test """
+		return self.puzzle_plan is not None and self.completed_puzzles >= len(self.puzzle_plan) - 1
+
+	def is_complete(self):
+		""" Returns True if every puzzle in the plan has been completed """
+		return bool(self.puzzle_plan) and self.completed_puzzles >= len(self.puzzle_plan)
 	
-	def get_best_times():
-		all_tests = Test.query.all()
-		times = {}
-		for test in all_tests:
-			if test.end_time:
-				user = User.query.get(test.user)
-				time_taken = round(test.end_time.timestamp() - test.start_time.timestamp(), 1)
-				if user not in times or time_taken < times[user]:
-					times[user] = time_taken
-		
-		best_users = sorted(times.items(), key=lambda x: times[x[0]])
-		return best_users[:10]
-				
-				
+	def get_time_taken(self):
+		""" Returns the number of seconds taken to complete the test """
+		return round(self.end_time.timestamp() - self.start_time.timestamp(), 1)
@@ -0,0 +1,73 @@
+""" Module that packs puzzle move trees into a compact binary format
+
+A packed move tree is a format version byte, the number of root nodes and then every node in preorder.
+Each node is a 16-bit move (from square, to square and promotion + 1 in 6, 6 and 3 bits) followed by its number of children,
+so a node takes 3 bytes instead of the ~60 bytes of its JSON.
+Move trees which can't be packed losslessly (e.g. moves with extra keys) are stored as JSON bytes instead.
+"""
+import json
+import struct
+
+PACKED_FORMAT_VERSION = 1
+HEADER = struct.Struct("<BB")
+NODE = struct.Struct("<HB")
+# Children of a node and roots of a tree are counted in one byte
+MAX_CHILDREN = 255
+# The promotion is stored as promotion + 1 so that no promotion (-1) is 0
+MAX_PROMOTION = 6
+
+def pack_move(move):
+    if not isinstance(move, dict) or move.keys() != { "from", "to", "promotion" } or not all(type(value) is int for value in move.values()):
+        raise ValueError("Move can't be packed: {!r}".format(move))
+    if not (0 <= move["from"] < 64 and 0 <= move["to"] < 64 and -1 <= move["promotion"] <= MAX_PROMOTION - 1):
+        raise ValueError("Move can't be packed: {!r}".format(move))
+    return move["from"] | move["to"] << 6 | (move["promotion"] + 1) << 12
+
+def pack_move_tree(move_tree):
+    """ Returns the packed bytes of a move tree, raises ValueError if it can't be packed losslessly """
+    if not isinstance(move_tree, list) or len(move_tree) > MAX_CHILDREN:
+        raise ValueError("Move tree can't be packed")
+    parts = [HEADER.pack(PACKED_FORMAT_VERSION, len(move_tree))]
+    def pack_nodes(nodes):
+        for node in nodes:
+            if not isinstance(node, dict) or "move" not in node or node.keys() - { "move", "continuation" }:
+                raise ValueError("Node can't be packed: {!r}".format(node))
+            continuation = node.get("continuation")
+            if "continuation" in node and (not isinstance(continuation, list) or not 0 < len(continuation) <= MAX_CHILDREN):
+                # An empty or null continuation would be unpacked without the key
+                raise ValueError("Continuation can't be packed: {!r}".format(continuation))
+            parts.append(NODE.pack(pack_move(node["move"]), len(continuation) if continuation else 0))
+            if continuation:
+                pack_nodes(continuation)
+    pack_nodes(move_tree)
+    return b"".join(parts)
+
+def unpack_move_tree(data):
+    """ Returns the move tree of packed bytes """
+    version, num_roots = HEADER.unpack_from(data)
+    if version != PACKED_FORMAT_VERSION:
+        raise ValueError("Unknown move tree format: {}".format(version))
+    nodes = NODE.iter_unpack(memoryview(data)[HEADER.size:])
+    def unpack_nodes(count):
+        result = []
+        for _ in range(count):
+            move, num_children = next(nodes)
+            node = { "move": { "from": move & 63, "to": move >> 6 & 63, "promotion": (move >> 12) - 1 } }
+            if num_children:
+                node["continuation"] = unpack_nodes(num_children)
+            result.append(node)
+        return result
+    return unpack_nodes(num_roots)
+
+def encode_move_tree(move_tree):
+    """ Returns the bytes stored for a move tree, packed if possible otherwise JSON """
+    try:
+        return pack_move_tree(move_tree)
+    except ValueError:
+        return json.dumps(move_tree).encode()
+
+def decode_move_tree(data):
+    """ Returns the move tree of stored bytes, JSON starts with a character rather than the format version """
+    if data[:1] == bytes([PACKED_FORMAT_VERSION]):
+        return unpack_move_tree(data)
+    return json.loads(bytes(data))
@@ -0,0 +1,91 @@
+""" Module that profiles a sample of requests with cProfile
+A request is profiled if it is chosen with probability PROFILE_SAMPLE_RATE or an admin sends the PROFILE_HEADER header.
+Each profile is written as a pstats file to PROFILE_DIRECTORY, only the newest PROFILES_KEPT files are kept.
+"""
+import cProfile
+import datetime
+import glob
+import os
+import pstats
+import random
+
+from flask import g, request
+from app import app
+from app.api.auth import authenticate_api_request
+
+def get_profile_directory():
+    return app.config["PROFILE_DIRECTORY"] or os.path.join(app.instance_path, "profiles")
+
+def get_modified_time(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        # Deleted by another worker since the directory was listed
+        return 0
+
+def get_profile_files():
+    """ Returns the paths of the saved profiles, newest first """
+    return sorted(glob.glob(os.path.join(get_profile_directory(), "*.prof")), key=get_modified_time, reverse=True)
+
+def should_profile():
+    if random.random() < app.config["PROFILE_SAMPLE_RATE"]:
+        return True
+    if request.headers.get(app.config["PROFILE_HEADER"]):
+        snapshot = authenticate_api_request()
+        return snapshot is not None and snapshot.is_admin
+    return False
+
+@app.before_request
+def start_profiling():
+    if should_profile():
+        g.profiler = cProfile.Profile()
+        try:
+            g.profiler.enable()
+        except ValueError:
+            # Another profiler is already active on this thread
+            g.profiler = None
+
+@app.teardown_request
+def save_profile(exception=None):
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return
+    profiler.disable()
+    directory = get_profile_directory()
+    os.makedirs(directory, exist_ok=True)
+    name = "{}-{}-{}.prof".format(datetime.datetime.now().strftime("%Y%m%d%H%M%S%f"), request.endpoint or "unknown", os.getpid())
+    profiler.dump_stats(os.path.join(directory, name))
+    for path in get_profile_files()[app.config["PROFILES_KEPT"]:]:
+        try:
+            os.remove(path)
+        except OSError:
+            # Already removed by another worker
+            pass
+
+def get_hot_functions(limit=20, sort_by="tottime"):
+    """ Returns the number of profiles and the `limit` functions with the most time (tottime or cumtime) across all saved profiles """
+    stats = None
+    num_profiles = 0
+    for path in get_profile_files():
+        try:
+            if stats is None:
+                stats = pstats.Stats(path)
+            else:
+                stats.add(path)
+        except (OSError, EOFError, ValueError, TypeError):
+            # Deleted or still being written by another worker
+            continue
+        num_profiles += 1
+    if stats is None:
+        return 0, []
+    functions = []
+    for (filename, line, name), (primitive_calls, calls, tottime, cumtime, callers) in stats.stats.items():
+        functions.append({
+            "function": name,
+            "location": "{}:{}".format(os.path.relpath(filename, os.path.dirname(app.root_path)) if filename.startswith(os.sep) else filename, line),
+            "calls": calls,
+            "tottime": tottime,
+            "cumtime": cumtime,
+        })
+    functions.sort(key=lambda function: -function[sort_by])
+    return num_profiles, functions[:limit]
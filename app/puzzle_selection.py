@@ -0,0 +1,77 @@
+""" Module that keeps an in-memory index of puzzle ids so that puzzles can be selected without loading the whole Puzzle table """
+import random
+import threading
+import time
+
+from app import app, db
+from app.models import Puzzle
+
+class PuzzleIndex:
+    """ Caches the ids of the puzzles for each lesson (the key None holds the ids of every puzzle)
+    Entries are loaded lazily and reloaded after PUZZLE_INDEX_TTL seconds so that puzzles created by other workers are eventually picked up.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids_by_lesson = {}
+        self._loaded_at = {}
+
+    def get_ids(self, lesson_id=None):
+        """ Returns the list of puzzle ids for a given lesson, if lesson_id==None, returns the ids of all puzzles """
+        with self._lock:
+            ids = self._ids_by_lesson.get(lesson_id)
+            if ids is not None and time.monotonic() - self._loaded_at[lesson_id] < app.config["PUZZLE_INDEX_TTL"]:
+                return ids
+        # Only the id column is fetched (served by the lesson_id index)
+        query = db.session.query(Puzzle.id)
+        if lesson_id is not None:
+            query = query.filter(Puzzle.lesson_id == lesson_id)
+        ids = [row[0] for row in query]
+        with self._lock:
+            self._ids_by_lesson[lesson_id] = ids
+            self._loaded_at[lesson_id] = time.monotonic()
+        return ids
+
+    def add_puzzle(self, puzzle):
+        """ Adds a newly created puzzle to any loaded entries """
+        with self._lock:
+            for lesson_id in (puzzle.lesson_id, None):
+                ids = self._ids_by_lesson.get(lesson_id)
+                if ids is not None and puzzle.id not in ids:
+                    # Copy so that readers holding the old list are unaffected
+                    self._ids_by_lesson[lesson_id] = ids + [puzzle.id]
+
+    def clear(self):
+        """ Drops every entry, forcing them to be reloaded from the database """
+        with self._lock:
+            self._ids_by_lesson.clear()
+            self._loaded_at.clear()
+
+    def random_puzzle(self, lesson_id=None):
+        """ Returns a random puzzle for a given lesson using a single primary key lookup, or None if there are no puzzles """
+        # Retry once with a fresh index in case the chosen puzzle was deleted
+        for _ in range(2):
+            ids = self.get_ids(lesson_id)
+            if len(ids) == 0:
+                return None
+            puzzle = Puzzle.query.get(random.choice(ids))
+            if puzzle is not None:
+                return puzzle
+            self.clear()
+        return None
+
+puzzle_index = PuzzleIndex()
+
+def create_test_plan(num_puzzles, exclude_ids=()):
+    """ Chooses the ordered list of puzzle ids for a final test, skipping any puzzles in exclude_ids
+    The chosen ids are checked against the database as the index may still hold puzzles deleted since it was loaded.
+    """
+    exclude_ids = set(exclude_ids)
+    # Retry once with a fresh index if any of the chosen puzzles were deleted
+    for _ in range(2):
+        ids = [puzzle_id for puzzle_id in puzzle_index.get_ids() if puzzle_id not in exclude_ids]
+        plan = random.sample(ids, min(num_puzzles, len(ids)))
+        existing_ids = { row[0] for row in db.session.query(Puzzle.id).filter(Puzzle.id.in_(plan)) } if plan else set()
+        if len(existing_ids) == len(plan):
+            return plan
+        puzzle_index.clear()
+    return [puzzle_id for puzzle_id in plan if puzzle_id in existing_ids]
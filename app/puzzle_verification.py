@@ -0,0 +1,86 @@
+""" Module that verifies puzzles by replaying every branch of their move tree with the server-side engine (app/engine)
+
+The player of a puzzle is the color not to move in its FEN (see Puzzle.reset in puzzle.js): the first move of the tree
+is the opponent's, then the player's moves and opponent replies alternate.
+An illegal move (or an invalid FEN) is an error which makes the puzzle unplayable.
+Where the player is to move, a move which wins immediately (exploding the enemy king or checkmate) that isn't one of
+the correct moves is a warning, as a player finding it would be told it is incorrect.
+"""
+import concurrent.futures
+import itertools
+import os
+
+from app.engine import Position, move_from_dict, move_to_string, WHITE, WHITE_WIN, BLACK_WIN
+
+ISSUE_ERROR = "error"
+ISSUE_WARNING = "warning"
+
+def describe_line(line):
+    return "after " + " ".join(move_to_string(move) for move in line) if line else "in the puzzle position"
+
+def verify_puzzle(fen, move_tree, is_atomic):
+    """ Returns the issues of a puzzle as a list of (ISSUE_ERROR or ISSUE_WARNING, message)
+    The move tree must have a valid structure (see validate_move_tree).
+    """
+    try:
+        position = Position.from_fen(fen, atomic=is_atomic)
+    except ValueError as error:
+        return [(ISSUE_ERROR, str(error))]
+    player = position.color ^ 1
+    player_win = WHITE_WIN if player == WHITE else BLACK_WIN
+    issues = []
+
+    def verify_nodes(nodes, line):
+        legal_moves = position.legal_moves()
+        tree_moves = set()
+        for node in nodes:
+            move = move_from_dict(node["move"])
+            if move not in legal_moves:
+                issues.append((ISSUE_ERROR, "Illegal move {} {}".format(move_to_string(move), describe_line(line))))
+                continue
+            tree_moves.add(move)
+            if "continuation" in node:
+                position.make_move(move)
+                verify_nodes(node["continuation"], line + [move])
+                position.unmake_move()
+        if position.color == player:
+            for move in legal_moves:
+                if move in tree_moves:
+                    continue
+                position.make_move(move)
+                wins = position.result() == player_win
+                position.unmake_move()
+                if wins:
+                    issues.append((ISSUE_WARNING, "Winning move {} is missing {}".format(move_to_string(move), describe_line(line))))
+
+    verify_nodes(move_tree, [])
+    return issues
+
+def has_errors(issues):
+    return any(level == ISSUE_ERROR for level, _ in issues)
+
+def verify_puzzle_record(puzzle):
+    return verify_puzzle(puzzle["fen"], puzzle["move_tree"], puzzle["is_atomic"])
+
+def verify_puzzles(records, processes=None, batch_size=2000):
+    """ Yields (key, puzzle, issues) for every (key, puzzle) pair of an iterable in order, verifying them in a pool of `processes` processes
+    The key identifies the puzzle to the caller (e.g. a line number or id).
+    Records are read `batch_size` at a time so that a large import isn't held in memory at once.
+    With one process (or `processes` None on a single core machine) the puzzles are verified in this process.
+    """
+    processes = processes or os.cpu_count() or 1
+    records = iter(records)
+    if processes == 1:
+        for key, puzzle in records:
+            yield key, puzzle, verify_puzzle_record(puzzle)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                return
+            # Several puzzles are sent to a worker at a time to reduce the pickling overhead
+            chunk_size = max(1, len(batch) // (processes * 4))
+            results = executor.map(verify_puzzle_record, [puzzle for _, puzzle in batch], chunksize=chunk_size)
+            for (key, puzzle), issues in zip(batch, results):
+                yield key, puzzle, issues
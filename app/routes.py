@@ -2,6 +2,7 @@ import math
 import datetime
 
 from app.api.lessons_api import get_lesson_progression
+from app.api.puzzles_api import PUZZLES_PER_TEST
 from app.auth import admin_login_required
 from flask import render_template, abort, redirect, request, url_for, g
 from app import app, db
@@ -9,6 +10,13 @@ from app.models import Test, User, LessonCompletion, PuzzleCompletion
 from app.auth import login_required
 
 from app.lessons import get_all_lessons, get_lesson_by_name, LESSONS_BY_ID
+from app.puzzle_selection import create_test_plan
+from app.leaderboard import leaderboard
+from app.completion_writer import completion_writer
+from app.profiling import get_hot_functions
+
+# Most functions shown on the profiles page
+MAX_HOT_FUNCTIONS = 500
 
 @app.route("/index")
 @app.route("/")
@@ -51,12 +59,15 @@ def stats():
     num_users = User.get_num_users()
     percentage_beginners = User.get_percentage_chess_beginners()
     num_completed_lessons = g.user.get_num_completed_lessons()
+    completion_writer.flush_user(g.user.id)
     time_performance, num_completed_puzzles, total_num_completed_puzzles, accuracy = g.user.get_performance()
-    best_users = Test.get_best_times()
+    best_users = leaderboard.get_best_times()
+    placement = leaderboard.get_placement(g.user.id)
     
     return render_template("stats.html", user=g.user, num_users=num_users, percentage_beginners=percentage_beginners,
     num_lessons=num_completed_lessons, time_performance=time_performance, lessons_by_id=LESSONS_BY_ID, 
-    num_puzzles=num_completed_puzzles, total_num_completed_puzzles=total_num_completed_puzzles, accuracy=accuracy, best_users=best_users)
+    num_puzzles=num_completed_puzzles, total_num_completed_puzzles=total_num_completed_puzzles, accuracy=accuracy, best_users=best_users,
+    placement=placement)
 
 @app.route("/settings")
 @login_required
@@ -87,6 +98,9 @@ def puzzle():
             user=g.user.id,
             start_time=datetime.datetime.now(),
             end_time=None,
+            # Choose the puzzles up front so serving them doesn't need to scan the completions
+            puzzle_plan=create_test_plan(PUZZLES_PER_TEST),
+            completed_puzzles=0,
         )
         db.session.add(test)
         db.session.commit()
@@ -115,3 +129,15 @@ def test():
 def create_puzzle():
     """ Serves admin only create puzzle page """
     return render_template("create_puzzle.html", user=g.user, lessons=get_all_lessons())
+
+@app.route("/profiles")
+@admin_login_required
+@login_required
+def profiles():
+    """ Serves admin only page which shows the hottest functions of the saved request profiles """
+    sort_by = request.args.get("sort", "tottime")
+    if sort_by not in ("tottime", "cumtime"):
+        sort_by = "tottime"
+    limit = min(max(request.args.get("limit", 30, type=int), 1), MAX_HOT_FUNCTIONS)
+    num_profiles, hot_functions = get_hot_functions(limit=limit, sort_by=sort_by)
+    return render_template("profiles.html", user=g.user, num_profiles=num_profiles, hot_functions=hot_functions, sort_by=sort_by)
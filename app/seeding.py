@@ -0,0 +1,212 @@
+""" Module that seeds the database: the puzzle corpus (see `flask init-db`) and large volumes of synthetic users, lesson progress and final tests for scale testing (see `flask seed-load`) """
+import datetime
+import json
+import math
+import os
+import random
+
+from werkzeug.security import generate_password_hash
+from app import db
+from app.lessons import get_all_lessons, LESSON_INTRO
+from app.models import User, LessonCompletion, Test, PuzzleCompletion, Puzzle, LessonPerformance, StatsCounter, STAT_NUM_USERS, STAT_NUM_CHESS_BEGINNERS
+from app.api.puzzles_api import PUZZLES_PER_TEST
+from app.move_trees import encode_move_tree
+
+# Versioned puzzle corpus loaded by `flask init-db`
+PUZZLE_CORPUS_PATH = os.path.join(os.path.dirname(__file__), "data", "puzzles.json")
+
+# Password of every generated user
+SEED_PASSWORD = "password1"
+# Generated users signed up over this many days before now
+SIGNUP_PERIOD_DAYS = 365
+
+class ChunkedInserter:
+    """ Buffers rows for several tables and inserts them with executemany once any table has `chunk_size` rows
+    Tables are inserted in the order given so that foreign keys are satisfied, each chunk is committed.
+    """
+    def __init__(self, tables, chunk_size):
+        self.tables = tables
+        self.chunk_size = chunk_size
+        self.rows = { table: [] for table in tables }
+        self.num_inserted = { table.name: 0 for table in tables }
+
+    def add(self, table, row):
+        self.rows[table].append(row)
+        if len(self.rows[table]) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        for table in self.tables:
+            if self.rows[table]:
+                db.session.execute(table.insert(), self.rows[table])
+                self.num_inserted[table.name] += len(self.rows[table])
+                self.rows[table] = []
+        db.session.commit()
+
+def load_puzzle_corpus(path=PUZZLE_CORPUS_PATH):
+    """ Returns the version and the list of puzzles of a corpus file """
+    with open(path) as file:
+        corpus = json.load(file)
+    return corpus["version"], corpus["puzzles"]
+
+def write_puzzle_chunk(new_rows, updated_rows):
+    if new_rows:
+        db.session.execute(Puzzle.__table__.insert(), new_rows)
+    if updated_rows:
+        db.session.bulk_update_mappings(Puzzle, updated_rows)
+    db.session.commit()
+
+def seed_puzzles(puzzles, chunk_size=5000):
+    """ Adds the puzzles which aren't in the database yet, matched on their content hash
+    Puzzles which already exist have their lesson_id and is_atomic updated if they changed.
+    Puzzles missing from `puzzles` are kept since completions refer to them.
+    `puzzles` can be any iterable, the changes are committed every `chunk_size` puzzles so a failed run can be resumed by running it again.
+    Returns the number of (added, updated, unchanged) puzzles.
+    """
+    # Puzzles added more than once (e.g. through the create puzzle page) are matched with the first copy
+    existing = {}
+    for content_hash, puzzle_id, lesson_id, is_atomic in db.session.query(Puzzle.content_hash, Puzzle.id, Puzzle.lesson_id, Puzzle.is_atomic).order_by(Puzzle.id):
+        existing.setdefault(content_hash, (puzzle_id, lesson_id, is_atomic))
+    new_rows = []
+    updated_rows = []
+    num_added = num_updated = num_unchanged = 0
+    for puzzle in puzzles:
+        content_hash = Puzzle.compute_content_hash(puzzle["fen"], puzzle["move_tree"])
+        row = existing.get(content_hash)
+        if row is None:
+            new_rows.append({
+                "fen": puzzle["fen"],
+                "move_tree": encode_move_tree(puzzle["move_tree"]),
+                "is_atomic": puzzle["is_atomic"],
+                "lesson_id": puzzle["lesson_id"],
+                "content_hash": content_hash,
+            })
+            num_added += 1
+            # Duplicates within the puzzles are only added once
+            existing[content_hash] = (None, puzzle["lesson_id"], puzzle["is_atomic"])
+        elif row[0] is not None and (row[1], row[2]) != (puzzle["lesson_id"], puzzle["is_atomic"]):
+            updated_rows.append({ "id": row[0], "lesson_id": puzzle["lesson_id"], "is_atomic": puzzle["is_atomic"] })
+            num_updated += 1
+            existing[content_hash] = (row[0], puzzle["lesson_id"], puzzle["is_atomic"])
+        else:
+            num_unchanged += 1
+
+        if len(new_rows) + len(updated_rows) >= chunk_size:
+            write_puzzle_chunk(new_rows, updated_rows)
+            new_rows = []
+            updated_rows = []
+    write_puzzle_chunk(new_rows, updated_rows)
+    return num_added, num_updated, num_unchanged
+
+def get_next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+def generate_puzzle_time(rng, lesson_id):
+    """ Seconds taken to solve a puzzle, log-normal with harder (later) lessons taking longer """
+    return round(rng.lognormvariate(math.log(10 + 4 * lesson_id), 0.6), 1)
+
+def generate_attempts(rng):
+    return rng.choices([1, 2, 3, 4], weights=[70, 18, 8, 4])[0]
+
+def seed_load(num_users, num_completions, seed=None, chunk_size=10000):
+    """ Generates `num_users` users and enough final tests for about `num_completions` puzzle completions
+    Most users progress through only some of the lessons, tests are taken by a small number of very active users (Zipf distributed).
+    Returns the number of rows inserted for each table.
+    """
+    rng = random.Random(seed)
+    puzzles = db.session.query(Puzzle.id, Puzzle.lesson_id).order_by(Puzzle.id).all()
+    if len(puzzles) < PUZZLES_PER_TEST:
+        raise ValueError("At least {} puzzles are needed to generate tests, run flask init-db first".format(PUZZLES_PER_TEST))
+    lesson_by_puzzle_id = dict(puzzles)
+    puzzle_ids = [puzzle_id for puzzle_id, _ in puzzles]
+    lessons = get_all_lessons()
+
+    # Number of tests of each user, test takers are Zipf distributed over a shuffled order of the users
+    num_tests = num_completions // PUZZLES_PER_TEST
+    ranks = list(range(num_users))
+    rng.shuffle(ranks)
+    weights = [1 / (rank + 1) for rank in ranks]
+    tests_by_user = [0] * num_users
+    for user_index in rng.choices(range(num_users), weights=weights, k=num_tests) if num_users else []:
+        tests_by_user[user_index] += 1
+
+    # Hashing is slow so every user shares one hash
+    pwd_hash = generate_password_hash(SEED_PASSWORD)
+    now = datetime.datetime.now()
+    user_id = get_next_id(User)
+    test_id = get_next_id(Test)
+    completion_id = get_next_id(PuzzleCompletion)
+    inserter = ChunkedInserter([User.__table__, LessonCompletion.__table__, Test.__table__, PuzzleCompletion.__table__], chunk_size)
+    num_beginners = 0
+
+    for user_index in range(num_users):
+        created_at = now - datetime.timedelta(seconds=rng.uniform(0, SIGNUP_PERIOD_DAYS * 86400))
+        chess_beginner = rng.random() < 0.4
+        num_beginners += chess_beginner
+
+        # Users who take a test have finished the lessons, other users stop part way through
+        tests = []
+        completions = []
+        for _ in range(tests_by_user[user_index]):
+            start_time = created_at + datetime.timedelta(seconds=rng.uniform(0, (now - created_at).total_seconds()))
+            plan = rng.sample(puzzle_ids, PUZZLES_PER_TEST)
+            completion_time = start_time
+            for puzzle_id in plan:
+                puzzle_start_time = completion_time
+                completion_time = puzzle_start_time + datetime.timedelta(seconds=generate_puzzle_time(rng, lesson_by_puzzle_id[puzzle_id]))
+                completions.append({
+                    "id": completion_id,
+                    "user": user_id,
+                    "puzzle_id": puzzle_id,
+                    "attempts": generate_attempts(rng),
+                    "start_time": puzzle_start_time,
+                    "end_time": completion_time,
+                    "test_number": test_id,
+                })
+                completion_id += 1
+            tests.append({
+                "id": test_id,
+                "user": user_id,
+                "start_time": start_time,
+                "end_time": completion_time,
+                "puzzle_plan": plan,
+                "completed_puzzles": PUZZLES_PER_TEST,
+            })
+            test_id += 1
+
+        best_test_time = min((round(test["end_time"].timestamp() - test["start_time"].timestamp(), 1) for test in tests), default=None)
+        inserter.add(User.__table__, {
+            "id": user_id,
+            "username": "seed{}-{}".format(seed if seed is not None else "", user_id),
+            "pwd_hash": pwd_hash,
+            "created_at": created_at,
+            "chess_beginner": chess_beginner,
+            "is_admin": False,
+            "settings": {},
+            "best_test_time": best_test_time,
+        })
+
+        num_lessons = len(lessons) if tests else rng.randint(0, len(lessons))
+        for lesson in lessons[:num_lessons]:
+            completed = lesson is not lessons[num_lessons - 1] or bool(tests) or rng.random() < 0.5
+            inserter.add(LessonCompletion.__table__, {
+                "user": user_id,
+                "lesson_id": lesson.id,
+                "progression": lesson.max_progression - 1 if completed else rng.randrange(lesson.max_progression),
+                "completed_lesson": completed,
+                "completed_test": completed and lesson.id != LESSON_INTRO.id,
+            })
+        # Rows are added after the rows they reference
+        for test in tests:
+            inserter.add(Test.__table__, test)
+        for completion in completions:
+            inserter.add(PuzzleCompletion.__table__, completion)
+        user_id += 1
+    inserter.flush()
+
+    # Derived data which is normally kept up to date by the request handlers
+    StatsCounter.increment(STAT_NUM_USERS, num_users)
+    StatsCounter.increment(STAT_NUM_CHESS_BEGINNERS, num_beginners)
+    LessonPerformance.rebuild()
+    db.session.commit()
+    return inserter.num_inserted
@@ -1,3 +1,5 @@
+// no-bitwise is disabled for this file (castling rights and the undo stack entries are bit fields) and enabled again at its end, as the chess library is linted as one bundle
+/* eslint-disable no-bitwise */
 const DEFAULT_CHESS_BOARD_OPTIONS = {
     target: "body",
     lightSquareColor: "#EEEEEE",
@@ -35,8 +37,37 @@ const MOVE_MARKER_CAPTURE_SCALE = 0.4;
 const MOVING_PIECE_Z_INDEX_STRING = "20";
 const DEFAULT_PIECE_Z_INDEX_STRING = "";
 
-// Format: [[files, ranks], ...]
-const ATOMIC_EXPLOSION_VECTORS = [[-1, 0], [-1, 1], [0, 1], [1, 1], [1, 0], [1, -1], [0, -1], [-1, -1]];
+// Castling rights are stored as the bits of Position._castlingRights
+/* eslint-disable-next-line object-curly-newline */
+const CASTLING_RIGHTS = Object.freeze({ WHITE_KINGSIDE: 1, WHITE_QUEENSIDE: 2, BLACK_KINGSIDE: 4, BLACK_QUEENSIDE: 8, ALL: 15 });
+
+function kingsideCastlingRight(color) {
+    return color === COLORS.WHITE ? CASTLING_RIGHTS.WHITE_KINGSIDE : CASTLING_RIGHTS.BLACK_KINGSIDE;
+}
+
+function queensideCastlingRight(color) {
+    return color === COLORS.WHITE ? CASTLING_RIGHTS.WHITE_QUEENSIDE : CASTLING_RIGHTS.BLACK_QUEENSIDE;
+}
+
+// Files of the squares the king passes over when castling, which must not be attacked
+const KINGSIDE_CASTLING_FILES = [FILES.FILE_F, FILES.FILE_G];
+const QUEENSIDE_CASTLING_FILES = [FILES.FILE_D, FILES.FILE_C];
+// Files of the squares where an enemy pawn one rank ahead of the king prevents castling
+const KINGSIDE_CASTLING_PAWN_FILES = [FILES.FILE_E, FILES.FILE_F, FILES.FILE_G, FILES.FILE_H];
+const QUEENSIDE_CASTLING_PAWN_FILES = [FILES.FILE_E, FILES.FILE_D, FILES.FILE_C, FILES.FILE_B];
+
+// Values of Position._attackOverrides, which let attack detection see the board as it would be after a move without applying it
+/* eslint-disable-next-line object-curly-newline */
+const ATTACK_OVERRIDES = Object.freeze({ NONE: 0, EMPTY: 1, BLOCKER: 2 });
+// Stands in for a piece on a square overridden with ATTACK_OVERRIDES.BLOCKER, it blocks attacks but is never an attacker (there is no piece type 6)
+const BLOCKING_PIECE_CODE = 7;
+
+// Number of moves applied with makePackedMove that can be reverted with unmakePackedMove
+const MAX_UNDO_PLY = 128;
+// Values saved by makePackedMove for every move: castling rights, enpassant square, check, both king squares and the number of changed squares before the move
+const UNDO_STATE_SIZE = 6;
+// Most squares a move can change: the moving piece, a captured pawn, the explosion, the rook when castling and the promotion
+const MAX_CHANGED_SQUARES_PER_MOVE = 16;
 
 // Constants that represent the current state of the board
 /* eslint-disable-next-line object-curly-newline */
@@ -63,9 +94,11 @@ class EventEmitter {
         }
     }
 }
-
 // Class that represents the state of the chess game (piece positions, castling rights, etc.)
 // Does not handle any graphics/user interaction
+// The board is an Int8Array of piece codes (see createPieceCode in chess.js)
+// Moves are applied with applyMove/undoMove, which take move objects and send events,
+// or with makePackedMove/unmakePackedMove, which take packed moves and don't allocate any memory (used by perft and getResult)
 class Position {
     constructor() {
         this.ready = new EventEmitter();
@@ -75,6 +108,23 @@ class Position {
 
         this._isAtomic = false;
         this._sandbox = false;
+        this._board = new Int8Array(SQUARE_COUNT);
+        this._kingSquares = new Int8Array(COLOR_COUNT);
+        this._moveBuffer = createMoveBuffer();
+
+        // Checks and pins of the position, see _updateLegalityInfo
+        this._legalityValid = false;
+        this._checkerCount = 0;
+        this._checkMask = new Uint8Array(SQUARE_COUNT);
+        this._pinDirections = new Int8Array(SQUARE_COUNT);
+
+        this._attackOverrides = new Int8Array(SQUARE_COUNT);
+        this._overriddenSquares = new Int8Array(MAX_CHANGED_SQUARES_PER_MOVE);
+        this._overriddenSquareCount = 0;
+
+        // State saved by makePackedMove, and the squares it changed with their previous piece codes (square | code << 6)
+        this._undoState = new Int32Array(MAX_UNDO_PLY * UNDO_STATE_SIZE);
+        this._undoSquares = new Int16Array(MAX_UNDO_PLY * MAX_CHANGED_SQUARES_PER_MOVE);
         this.reset();
     }
 
@@ -100,6 +150,7 @@ class Position {
 
     set colorToMove(color) {
         this._colorToMove = color;
+        this._legalityValid = false;
     }
 
     get enpassantSquare() {
@@ -110,21 +161,26 @@ class Position {
         return this._inCheck;
     }
 
+    // The piece code on every square, must not be modified
+    get board() {
+        return this._board;
+    }
+
     isSquareOccupied(square) {
         return this.getPieceOnSquare(square) !== null;
     }
 
     getPieceOnSquare(square) {
-        assert(square >= 0 && square < this._squares.length, "Invalid square");
-        return this._squares[square];
+        assert(square >= 0 && square < SQUARE_COUNT, "Invalid square");
+        return PIECE_OBJECTS[this._board[square]];
     }
 
     canCastleKingside(color) {
-        return color === COLORS.WHITE ? this._castlingRights.whiteKingside : this._castlingRights.blackKingside;
+        return (this._castlingRights & kingsideCastlingRight(color)) !== 0;
     }
 
     canCastleQueenside(color) {
-        return color === COLORS.WHITE ? this._castlingRights.whiteQueenside : this._castlingRights.blackQueenside;
+        return (this._castlingRights & queensideCastlingRight(color)) !== 0;
     }
 
     getKingSquare(color) {
@@ -132,87 +188,68 @@ class Position {
     }
 
     isKingsideCastle(move) {
-        const piece = this.getPieceOnSquare(move.from);
-        return Boolean(piece) && piece.piece === PIECES.KING && fileOfSquare(move.from) === FILES.FILE_E && fileOfSquare(move.to) === FILES.FILE_G;
+        return this._isCastle(move.from, move.to, FILES.FILE_G);
     }
 
     isQueensideCastle(move) {
-        const piece = this.getPieceOnSquare(move.from);
-        return Boolean(piece) && piece.piece === PIECES.KING && fileOfSquare(move.from) === FILES.FILE_E && fileOfSquare(move.to) === FILES.FILE_C;
+        return this._isCastle(move.from, move.to, FILES.FILE_C);
     }
 
     isCapture(move) {
-        const pieceOnSquare = this.getPieceOnSquare(move.to);
-        if (pieceOnSquare) {
-            return true;
-        }
-        const movingPiece = this.getPieceOnSquare(move.from);
-        return movingPiece && movingPiece.piece === PIECES.PAWN && move.to === this.enpassantSquare;
+        return this._isCapture(move.from, move.to);
     }
 
     // Takes a pseudo-legal move and determines whether it is a legal move
     isLegal(move) {
+        return this.isPackedMoveLegal(packMoveObject(move));
+    }
+
+    // Same as isLegal for a packed move
+    // The move is never applied: quiet moves are checked against the checks and pins of the position (see _updateLegalityInfo)
+    // and other moves look for attacks on the king on the board as it would be after the move (see _isSquareAttacked)
+    isPackedMoveLegal(move) {
         const ctm = this.colorToMove;
+        const enemy = otherColor(ctm);
+        const fromSquare = packedMoveFrom(move);
+        const toSquare = packedMoveTo(move);
 
         if (this._kingSquares[ctm] === SQUARES.INVALID && !this.sandbox) {
             return false;
         }
 
-        const kingsideCastle = this.isKingsideCastle(move);
-        const queensideCastle = this.isQueensideCastle(move);
+        const kingsideCastle = this._isCastle(fromSquare, toSquare, FILES.FILE_G);
+        const queensideCastle = this._isCastle(fromSquare, toSquare, FILES.FILE_C);
         if (kingsideCastle || queensideCastle) {
             // Can't castle when in check
             if (this.inCheck) {
                 return false;
             }
+            const rank = rankOfSquare(fromSquare);
             // Ensure that we are not castling through check
-            const rank = rankOfSquare(move.from);
-            const squares = [];
-            const pawnSquares = [];
-            const squareShift = this.colorToMove === COLORS.WHITE ? FILE_COUNT : -FILE_COUNT;
-            // Find squares that if attacked by an enemy piece would prevent us castling
-            // Also find squares that if an enemy pawn was on would prevent us castling (the squares needs to be shifted by squareShift later)
-            if (kingsideCastle) {
-                squares.push(createSquare(FILES.FILE_F, rank), createSquare(FILES.FILE_G, rank));
-                pawnSquares.push(createSquare(FILES.FILE_E, rank), createSquare(FILES.FILE_F, rank), createSquare(FILES.FILE_G, rank), createSquare(FILES.FILE_H, rank));
-            } else {
-                squares.push(createSquare(FILES.FILE_D, rank), createSquare(FILES.FILE_C, rank));
-                pawnSquares.push(createSquare(FILES.FILE_E, rank), createSquare(FILES.FILE_D, rank), createSquare(FILES.FILE_C, rank), createSquare(FILES.FILE_B, rank));
-            }
-            // Pretend that it's the other colors turn to move
-            this._colorToMove = otherColor(ctm);
-            // Find all of their moves
-            const attackingMoves = generatePseudoLegalMoves(this);
-            // Ensure none of the moves attack the squares which would prevent us castling
-            for (const mv of attackingMoves) {
-                if (squares.indexOf(mv.to) >= 0) {
-                    this._colorToMove = ctm;
+            for (const file of kingsideCastle ? KINGSIDE_CASTLING_FILES : QUEENSIDE_CASTLING_FILES) {
+                if (this._isSquareAttacked(createSquare(file, rank), enemy)) {
                     return false;
                 }
             }
-            // Revert color to move
-            this._colorToMove = ctm;
-            // Ensure there are no pawns which attack the path of the king
-            for (const square of pawnSquares) {
-                // pawnSquares are on the same rank as our king
-                // shift them up 1 rank using squareShift
-                const pawnSquare = square + squareShift;
-                const pieceOnSquare = this.getPieceOnSquare(pawnSquare);
-                // If there is an enemy pawn on any of these squares the move is illegal
-                if (pieceOnSquare && pieceOnSquare.piece === PIECES.PAWN && pieceOnSquare.color === otherColor(ctm)) {
+            // Ensure there are no pawns which attack the path of the king (on the rank in front of our king)
+            const pawnRank = ctm === COLORS.WHITE ? rank + 1 : rank - 1;
+            const enemyPawnCode = createPieceCode(PIECES.PAWN, enemy);
+            for (const file of kingsideCastle ? KINGSIDE_CASTLING_PAWN_FILES : QUEENSIDE_CASTLING_PAWN_FILES) {
+                if (this._board[createSquare(file, pawnRank)] === enemyPawnCode) {
                     return false;
                 }
             }
         }
 
+        const movingPiece = pieceTypeOfCode(this._board[fromSquare]);
+        const isCapture = this._isCapture(fromSquare, toSquare);
+
         // Some atomic specific rules
         if (this.isAtomic) {
-            const movingPiece = this.getPieceOnSquare(move.from);
-            const isCapture = this.isCapture(move);
             const ourKingSquare = this.getKingSquare(ctm);
-            const otherKingSquare = this.getKingSquare(otherColor(ctm));
+            const otherKingSquare = this.getKingSquare(enemy);
             // King can never capture anything
-            if (movingPiece && movingPiece.piece === PIECES.KING && isCapture) {
+            if (movingPiece === PIECES.KING && isCapture) {
                 return false;
             }
             // In sandbox mode, there may not be kings at all
@@ -220,41 +257,222 @@ class Position {
                 return this.sandbox;
             }
             // Cannot capture anything next to our own king
-            if (isCapture && isNextToSquare(move.to, ourKingSquare)) {
+            if (isCapture && isNextToSquare(toSquare, ourKingSquare)) {
                 return false;
             }
             // Any capture that explodes enemy king is legal (even if in check)
             // as long as it does not capture next to our king (handled by above case)
-            if (isCapture && isNextToSquare(move.to, otherKingSquare)) {
+            if (isCapture && isNextToSquare(toSquare, otherKingSquare)) {
                 return true;
             }
             // Our king can always move next to the opposition king
-            if (movingPiece.piece === PIECES.KING && isNextToSquare(move.to, otherKingSquare)) {
+            if (movingPiece === PIECES.KING && isNextToSquare(toSquare, otherKingSquare)) {
                 return true;
             }
             // If our king is already next to the opposition king any non-king move is legal
-            if (movingPiece && movingPiece.piece !== PIECES.KING && isNextToSquare(ourKingSquare, otherKingSquare)) {
+            if (movingPiece !== PIECES.KING && isNextToSquare(ourKingSquare, otherKingSquare)) {
                 return true;
             }
         }
 
         // We need to check that the move we played didn't cause us to be in check
-        // Apply the move then check the enemy's moves - if any attack our king then the move is illegal
-
-        const undoInfo = this.applyMove(move, false, false);
-        // Need to use the king square from after applying the move (can't move into check)
         const kingSquare = this.getKingSquare(ctm);
-        const moves = generatePseudoLegalMoves(this);
-        let isLegal = true;
-        for (const mv of moves) {
-            if (mv.to === kingSquare) {
-                isLegal = false;
-                break;
+        // In sandbox mode, there may not be a king to attack
+        if (kingSquare === SQUARES.INVALID) {
+            return true;
+        }
+        const isEnpassant = movingPiece === PIECES.PAWN && toSquare === this.enpassantSquare;
+
+        // The king can't move onto an attacked square, it no longer blocks attacks along the line it moves on
+        if (movingPiece === PIECES.KING) {
+            this._overrideSquare(fromSquare, ATTACK_OVERRIDES.EMPTY);
+            if (kingsideCastle || queensideCastle) {
+                // The rook moves next to the king
+                const rank = rankOfSquare(fromSquare);
+                this._overrideSquare(createSquare(kingsideCastle ? FILES.FILE_H : FILES.FILE_A, rank), ATTACK_OVERRIDES.EMPTY);
+                this._overrideSquare(createSquare(kingsideCastle ? FILES.FILE_F : FILES.FILE_D, rank), ATTACK_OVERRIDES.BLOCKER);
             }
+            return !this._isSquareAttackedWithOverrides(toSquare, enemy);
         }
-        // UNDO MOVE
-        this.undoMove(move, undoInfo, false, false);
-        return isLegal;
+
+        // In atomic chess a capture removes the captured piece, the capturing piece and the non-pawn pieces around the capture square
+        // Our king is never one of them (a capture next to it is illegal) but the explosion can open lines onto it
+        if (this.isAtomic && isCapture) {
+            this._overrideSquare(fromSquare, ATTACK_OVERRIDES.EMPTY);
+            this._overrideSquare(toSquare, ATTACK_OVERRIDES.EMPTY);
+            if (isEnpassant) {
+                this._overrideSquare(getBackwardSquare(toSquare, ctm), ATTACK_OVERRIDES.EMPTY);
+            }
+            for (const square of KING_SQUARES[toSquare]) {
+                const code = this._board[square];
+                if (code !== EMPTY_SQUARE && pieceTypeOfCode(code) !== PIECES.PAWN) {
+                    this._overrideSquare(square, ATTACK_OVERRIDES.EMPTY);
+                }
+            }
+            return !this._isSquareAttackedWithOverrides(kingSquare, enemy);
+        }
+
+        // En passant removes 2 pieces from the rank of the captured pawn, which can reveal an attack a pin doesn't account for
+        if (isEnpassant) {
+            this._overrideSquare(fromSquare, ATTACK_OVERRIDES.EMPTY);
+            this._overrideSquare(getBackwardSquare(toSquare, ctm), ATTACK_OVERRIDES.EMPTY);
+            this._overrideSquare(toSquare, ATTACK_OVERRIDES.BLOCKER);
+            return !this._isSquareAttackedWithOverrides(kingSquare, enemy);
+        }
+
+        // Any other move must block or capture the piece giving check and must stay on the line of a pin
+        this._updateLegalityInfo();
+        if (this._checkerCount > 1 || (this._checkerCount === 1 && this._checkMask[toSquare] === 0)) {
+            return false;
+        }
+        const pinDirection = this._pinDirections[fromSquare];
+        return pinDirection < 0 || SQUARE_DIRECTIONS[kingSquare * SQUARE_COUNT + toSquare] === pinDirection;
+    }
+
+    // Writes the legal moves of the position to a move buffer starting at index count and returns the new number of moves in the buffer
+    generateLegalPackedMoves(moves, count = 0) {
+        const end = generatePseudoLegalPackedMoves(this, moves, count);
+        for (let i = count; i < end; i++) {
+            if (this.isPackedMoveLegal(moves[i])) {
+                moves[count++] = moves[i];
+            }
+        }
+        return count;
+    }
+
+    // Returns true if a piece of the given color attacks the square (a pawn attacks diagonally even if the square is empty)
+    // Squares in _attackOverrides are treated as empty or as holding a piece that can't attack
+    _isSquareAttacked(square, color) {
+        const pawnCode = createPieceCode(PIECES.PAWN, color);
+        for (const sq of PAWN_CAPTURE_SQUARES[otherColor(color)][square]) {
+            if (this._getAttackerCode(sq) === pawnCode) {
+                return true;
+            }
+        }
+        const knightCode = createPieceCode(PIECES.KNIGHT, color);
+        for (const sq of KNIGHT_SQUARES[square]) {
+            if (this._getAttackerCode(sq) === knightCode) {
+                return true;
+            }
+        }
+        const kingCode = createPieceCode(PIECES.KING, color);
+        for (const sq of KING_SQUARES[square]) {
+            if (this._getAttackerCode(sq) === kingCode) {
+                return true;
+            }
+        }
+        const queenCode = createPieceCode(PIECES.QUEEN, color);
+        return this._isSquareAttackedAlongRays(BISHOP_RAYS[square], createPieceCode(PIECES.BISHOP, color), queenCode)
+            || this._isSquareAttackedAlongRays(ROOK_RAYS[square], createPieceCode(PIECES.ROOK, color), queenCode);
+    }
+
+    _isSquareAttackedAlongRays(rays, sliderCode, queenCode) {
+        for (const ray of rays) {
+            for (const sq of ray) {
+                const code = this._getAttackerCode(sq);
+                if (code !== EMPTY_SQUARE) {
+                    if (code === sliderCode || code === queenCode) {
+                        return true;
+                    }
+                    // We can't x-ray through pieces
+                    break;
+                }
+            }
+        }
+        return false;
+    }
+
+    _getAttackerCode(square) {
+        switch (this._attackOverrides[square]) {
+        case ATTACK_OVERRIDES.EMPTY:
+            return EMPTY_SQUARE;
+        case ATTACK_OVERRIDES.BLOCKER:
+            return BLOCKING_PIECE_CODE;
+        }
+        return this._board[square];
+    }
+
+    _overrideSquare(square, override) {
+        this._attackOverrides[square] = override;
+        this._overriddenSquares[this._overriddenSquareCount++] = square;
+    }
+
+    // Same as _isSquareAttacked, then removes the overrides
+    _isSquareAttackedWithOverrides(square, color) {
+        const attacked = this._isSquareAttacked(square, color);
+        while (this._overriddenSquareCount > 0) {
+            this._attackOverrides[this._overriddenSquares[--this._overriddenSquareCount]] = ATTACK_OVERRIDES.NONE;
+        }
+        return attacked;
+    }
+
+    // Finds the checks and pins against the king of the color to move, once per position
+    // _checkMask marks the squares a piece can move to to capture or block the piece giving check
+    // _pinDirections holds the direction (see SQUARE_DIRECTIONS) from the king to the piece pinning each pinned piece, -1 if the piece isn't pinned
+    _updateLegalityInfo() {
+        if (this._legalityValid) {
+            return;
+        }
+        this._legalityValid = true;
+        this._checkerCount = 0;
+        this._checkMask.fill(0);
+        this._pinDirections.fill(-1);
+        const color = this.colorToMove;
+        const enemy = otherColor(color);
+        const kingSquare = this.getKingSquare(color);
+        if (kingSquare === SQUARES.INVALID) {
+            return;
+        }
+        this._addCheckers(PAWN_CAPTURE_SQUARES[color][kingSquare], createPieceCode(PIECES.PAWN, enemy));
+        this._addCheckers(KNIGHT_SQUARES[kingSquare], createPieceCode(PIECES.KNIGHT, enemy));
+        this._addCheckers(KING_SQUARES[kingSquare], createPieceCode(PIECES.KING, enemy));
+        const queenCode = createPieceCode(PIECES.QUEEN, enemy);
+        this._addSliderChecksAndPins(BISHOP_RAYS[kingSquare], 0, createPieceCode(PIECES.BISHOP, enemy), queenCode);
+        this._addSliderChecksAndPins(ROOK_RAYS[kingSquare], BISHOP_RAYS[kingSquare].length, createPieceCode(PIECES.ROOK, enemy), queenCode);
+    }
+
+    _addCheckers(squares, checkerCode) {
+        for (const square of squares) {
+            if (this._board[square] === checkerCode) {
+                this._checkerCount++;
+                this._checkMask[square] = 1;
+            }
+        }
+    }
+
+    // The first enemy slider along a ray from the king gives check, or pins our piece if it is the only piece in between
+    _addSliderChecksAndPins(rays, firstDirection, sliderCode, queenCode) {
+        const color = this.colorToMove;
+        for (let direction = 0; direction < rays.length; direction++) {
+            const ray = rays[direction];
+            let pinnedSquare = SQUARES.INVALID;
+            for (let i = 0; i < ray.length; i++) {
+                const code = this._board[ray[i]];
+                if (code !== EMPTY_SQUARE && colorOfCode(code) === color && pinnedSquare === SQUARES.INVALID) {
+                    pinnedSquare = ray[i];
+                } else if (code !== EMPTY_SQUARE) {
+                    if (code === sliderCode || code === queenCode) {
+                        if (pinnedSquare === SQUARES.INVALID) {
+                            this._checkerCount++;
+                            for (let j = 0; j <= i; j++) {
+                                this._checkMask[ray[j]] = 1;
+                            }
+                        } else {
+                            this._pinDirections[pinnedSquare] = firstDirection + direction;
+                        }
+                    }
+                    break;
+                }
+            }
+        }
+    }
+
+    _isCastle(fromSquare, toSquare, toFile) {
+        return pieceTypeOfCode(this._board[fromSquare]) === PIECES.KING && fileOfSquare(fromSquare) === FILES.FILE_E && fileOfSquare(toSquare) === toFile;
+    }
+
+    _isCapture(fromSquare, toSquare) {
+        return this._board[toSquare] !== EMPTY_SQUARE || (pieceTypeOfCode(this._board[fromSquare]) === PIECES.PAWN && toSquare === this.enpassantSquare);
     }
 
     // Set the piece positions from a Forsyth–Edwards Notation (FEN) string
@@ -278,40 +496,40 @@ class Position {
             }
             switch (c) {
             case "P":
-                this._squares[createSquare(currentFile++, currentRank)] = { piece: PIECES.PAWN, color: COLORS.WHITE };
+                this._board[createSquare(currentFile++, currentRank)] = createPieceCode(PIECES.PAWN, COLORS.WHITE);
                 break;
             case "N":
-                this._squares[createSquare(currentFile++, currentRank)] = { piece: PIECES.KNIGHT, color: COLORS.WHITE };
+                this._board[createSquare(currentFile++, currentRank)] = createPieceCode(PIECES.KNIGHT, COLORS.WHITE);
                 break;
             case "B":
-                this._squares[createSquare(currentFile++, currentRank)] = { piece: PIECES.BISHOP, color: COLORS.WHITE };
+                this._board[createSquare(currentFile++, currentRank)] = createPieceCode(PIECES.BISHOP, COLORS.WHITE);
                 break;
             case "R":
-                this._squares[createSquare(currentFile++, currentRank)] = { piece: PIECES.ROOK, color: COLORS.WHITE };
+                this._board[createSquare(currentFile++, currentRank)] = createPieceCode(PIECES.ROOK, COLORS.WHITE);
                 break;
             case "Q":
-                this._squares[createSquare(currentFile++, currentRank)] = { piece: PIECES.QUEEN, color: COLORS.WHITE };
+                this._board[createSquare(currentFile++, currentRank)] = createPieceCode(PIECES.QUEEN, COLORS.WHITE);
                 break;
             case "K":
-                this._squares[createSquare(currentFile++, currentRank)] = { piece: PIECES.KING, color: COLORS.WHITE };
+                this._board[createSquare(currentFile++, currentRank)] = createPieceCode(PIECES.KING, COLORS.WHITE);
                 break;
             case "p":
-                this._squares[createSquare(currentFile++, currentRank)] = { piece: PIECES.PAWN, color: COLORS.BLACK };
+                this._board[createSquare(currentFile++, currentRank)] = createPieceCode(PIECES.PAWN, COLORS.BLACK);
                 break;
             case "n":
-                this._squares[createSquare(currentFile++, currentRank)] = { piece: PIECES.KNIGHT, color: COLORS.BLACK };
+                this._board[createSquare(currentFile++, currentRank)] = createPieceCode(PIECES.KNIGHT, COLORS.BLACK);
                 break;
             case "b":
-                this._squares[createSquare(currentFile++, currentRank)] = { piece: PIECES.BISHOP, color: COLORS.BLACK };
+                this._board[createSquare(currentFile++, currentRank)] = createPieceCode(PIECES.BISHOP, COLORS.BLACK);
                 break;
             case "r":
-                this._squares[createSquare(currentFile++, currentRank)] = { piece: PIECES.ROOK, color: COLORS.BLACK };
+                this._board[createSquare(currentFile++, currentRank)] = createPieceCode(PIECES.ROOK, COLORS.BLACK);
                 break;
             case "q":
-                this._squares[createSquare(currentFile++, currentRank)] = { piece: PIECES.QUEEN, color: COLORS.BLACK };
+                this._board[createSquare(currentFile++, currentRank)] = createPieceCode(PIECES.QUEEN, COLORS.BLACK);
                 break;
             case "k":
-                this._squares[createSquare(currentFile++, currentRank)] = { piece: PIECES.KING, color: COLORS.BLACK };
+                this._board[createSquare(currentFile++, currentRank)] = createPieceCode(PIECES.KING, COLORS.BLACK);
                 break;
             }
         }
@@ -319,24 +537,21 @@ class Position {
         this._colorToMove = (fen[index] === "w") ? COLORS.WHITE : COLORS.BLACK;
         index += 2;
 
-        this._castlingRights.whiteKingside = false;
-        this._castlingRights.whiteQueenside = false;
-        this._castlingRights.blackKingside = false;
-        this._castlingRights.blackQueenside = false;
+        this._castlingRights = 0;
 
         while (index < fen.length && fen[index] !== " ") {
             switch (fen[index]) {
             case "K":
-                this._castlingRights.whiteKingside = true;
+                this._castlingRights |= CASTLING_RIGHTS.WHITE_KINGSIDE;
                 break;
             case "Q":
-                this._castlingRights.whiteQueenside = true;
+                this._castlingRights |= CASTLING_RIGHTS.WHITE_QUEENSIDE;
                 break;
             case "k":
-                this._castlingRights.blackKingside = true;
+                this._castlingRights |= CASTLING_RIGHTS.BLACK_KINGSIDE;
                 break;
             case "q":
-                this._castlingRights.blackQueenside = true;
+                this._castlingRights |= CASTLING_RIGHTS.BLACK_QUEENSIDE;
                 break;
             }
             index++;
@@ -358,23 +573,41 @@ class Position {
 
     // Clears pieces and resets castling rights
     reset() {
-        this._squares = [];
-        for (let i = 0; i < SQUARE_COUNT; i++) {
-            this._squares.push(null);
-        }
-        this._castlingRights = {
-            whiteKingside: true,
-            whiteQueenside: true,
-            blackKingside: true,
-            blackQueenside: true,
-        };
+        this._board.fill(EMPTY_SQUARE);
+        this._castlingRights = CASTLING_RIGHTS.ALL;
         this._enpassantSquare = SQUARES.INVALID;
         this._colorToMove = COLORS.WHITE;
-        this._kingSquares = [SQUARES.INVALID, SQUARES.INVALID];
+        this._kingSquares.fill(SQUARES.INVALID);
         this._inCheck = false;
+        this._legalityValid = false;
+        this._undoPly = 0;
+        this._undoSquareCount = 0;
         this.cleared.trigger();
     }
 
+    // Applies a packed move without sending events or allocating memory, revert it with unmakePackedMove
+    // Like applyMove, does not check that the move is legal
+    makePackedMove(move) {
+        this._makeMove(move, null, null);
+    }
+
+    // Reverts the last move applied with makePackedMove
+    unmakePackedMove() {
+        assert(this._undoPly > 0, "No move to undo");
+        const state = --this._undoPly * UNDO_STATE_SIZE;
+        const squareCount = this._undoState[state + 5];
+        while (this._undoSquareCount > squareCount) {
+            const change = this._undoSquares[--this._undoSquareCount];
+            this._board[change & 63] = change >> 6;
+        }
+        this._castlingRights = this._undoState[state];
+        this._enpassantSquare = this._undoState[state + 1];
+        this._inCheck = this._undoState[state + 2] === 1;
+        this._kingSquares[COLORS.WHITE] = this._undoState[state + 3];
+        this._kingSquares[COLORS.BLACK] = this._undoState[state + 4];
+        this.colorToMove = otherColor(this.colorToMove);
+    }
+
     // Applies a move to the position - does not check that the move is legal or even pseudo-legal
     // also does not check if the game has already ended (someone got mated)
     applyMove(move, animate = false, sendEvents = true) {
@@ -382,10 +615,10 @@ class Position {
         // Save the current board state
         const undoInfo = {
             inCheck: this.inCheck,
-            squares: [...this._squares],
-            castlingRights: { ...this._castlingRights },
+            squares: this._board.slice(),
+            castlingRights: this._castlingRights,
             enpassantSquare: this._enpassantSquare,
-            kingSquares: [...this._kingSquares],
+            kingSquares: this._kingSquares.slice(),
             capturedPieces: [],
             isPromotion: false,
             isKingsideCastle: false,
@@ -393,7 +626,7 @@ class Position {
             movingPiece: null,
         };
         if (movesEqual(move, MOVE_NONE)) {
-            this._colorToMove = otherColor(this._colorToMove);
+            this.colorToMove = otherColor(this._colorToMove);
             if (sendEvents) {
                 this.movePlayed.trigger(null);
             }
@@ -407,180 +640,15 @@ class Position {
             promotedPieces: [],
             movingPieceCaptured: false,
         };
-        const fromSquare = move.from;
-        const toSquare = move.to;
-        const promotion = move.promotion;
-        const enpassantSquare = this.enpassantSquare;
-        const movingPiece = this.getPieceOnSquare(fromSquare);
+        const movingPiece = this.getPieceOnSquare(move.from);
         undoInfo.movingPiece = movingPiece;
         assert(Boolean(movingPiece) && movingPiece.piece !== PIECES.NONE && movingPiece.color === this.colorToMove, "Invalid move");
-        const capturedPiece = this.getPieceOnSquare(toSquare);
+        const capturedPiece = this.getPieceOnSquare(move.to);
         assert(!capturedPiece || capturedPiece.color !== this.colorToMove, "Invalid capture");
 
-        // If we have captured someone's rook and it was on its original square - prevent castling
-        const updateCastlingFromCapturedPiece = (capPiece, square) => {
-            if (capPiece && capPiece.piece === PIECES.ROOK) {
-                const requiredRank = capPiece.color === COLORS.WHITE ? RANKS.RANK_1 : RANKS.RANK_8;
-                const fromFile = fileOfSquare(square);
-                const fromRank = rankOfSquare(square);
-                if (fromFile === FILES.FILE_H && requiredRank === fromRank) {
-                    if (capPiece.color === COLORS.WHITE) {
-                        this._castlingRights.whiteKingside = false;
-                    } else {
-                        this._castlingRights.blackKingside = false;
-                    }
-                } else if (fromFile === FILES.FILE_A && requiredRank === fromRank) {
-                    if (capPiece.color === COLORS.WHITE) {
-                        this._castlingRights.whiteQueenside = false;
-                    } else {
-                        this._castlingRights.blackQueenside = false;
-                    }
-                }
-            }
-        };
-
-        // Utility function called whenever a piece is captured
-        // Handles atomic chess explosion
-        const explode = (capturingPiece, captureFrom, explosionSquare) => {
-            if (this.isAtomic) {
-                const file = fileOfSquare(explosionSquare);
-                const rank = rankOfSquare(explosionSquare);
-                for (const vector of ATOMIC_EXPLOSION_VECTORS) {
-                    const newFile = file + vector[0];
-                    const newRank = rank + vector[1];
-                    if (validFileAndRank(newFile, newRank)) {
-                        const newSquare = createSquare(newFile, newRank);
-                        const pieceOnSquare = this.getPieceOnSquare(newSquare);
-                        // Only explode non-pawn pieces
-                        if (pieceOnSquare && pieceOnSquare.piece !== PIECES.PAWN) {
-                            updateCastlingFromCapturedPiece(pieceOnSquare, newSquare);
-                            // Check if the enemy king got blown up
-                            if (pieceOnSquare.piece === PIECES.KING) {
-                                this._kingSquares[otherColor(this.colorToMove)] = SQUARES.INVALID;
-                            }
-                            undoInfo.capturedPieces.push({ square: newSquare, piece: pieceOnSquare });
-                            eventData.capturedPieces.push({ square: newSquare, piece: pieceOnSquare });
-                            this._squares[newSquare] = null;
-                        }
-                    }
-                }
-                // Explode the moving piece
-                this._squares[explosionSquare] = null;
-                undoInfo.capturedPieces.push({ square: captureFrom, piece: capturingPiece, isMovingPiece: true });
-                eventData.movingPieceCaptured = true;
-            }
-        };
-
-        // Reset enpassant square
-        this._enpassantSquare = SQUARES.INVALID;
-
-        // Clear the from square
-        this._squares[fromSquare] = null;
-        // Move to the new square (copy piece data)
-        this._squares[toSquare] = { ...movingPiece };
-
-        if (capturedPiece) {
-            undoInfo.capturedPieces.push({ square: toSquare, piece: capturedPiece });
-            eventData.capturedPieces.push({ square: toSquare, piece: capturedPiece });
-            explode(movingPiece, fromSquare, toSquare);
-        }
-
-        // Enpassant
-        if (toSquare === enpassantSquare && movingPiece.piece === PIECES.PAWN) {
-            const captureSquare = getBackwardSquare(toSquare, this.colorToMove);
-            const capturedPawn = { piece: PIECES.PAWN, color: otherColor(this.colorToMove) };
-            undoInfo.capturedPieces.push({ square: captureSquare, piece: capturedPawn });
-            eventData.capturedPieces.push({ square: captureSquare, piece: capturedPawn });
-            this._squares[captureSquare] = null;
-            explode(movingPiece, fromSquare, toSquare);
-        }
-
-        // Update promotion
-        if (promotion !== PIECES.NONE && movingPiece.piece === PIECES.PAWN && (!this.isAtomic || !capturedPiece)) {
-            this._squares[toSquare] = { piece: promotion, color: this.colorToMove };
-            undoInfo.isPromotion = true;
-            eventData.promotedPieces.push({ square: toSquare, piece: this._squares[toSquare] });
-        }
-
-        // If we double push a pawn - set the enpassant square
-        if (movingPiece.piece === PIECES.PAWN && Math.abs(rankOfSquare(fromSquare) - rankOfSquare(toSquare)) === 2) {
-            this._enpassantSquare = getBackwardSquare(toSquare, this.colorToMove);
-        }
-
-        // If the king has moved then revoke castling rights
-        if (movingPiece.piece === PIECES.KING) {
-            if (this.colorToMove === COLORS.WHITE) {
-                this._castlingRights.whiteKingside = false;
-                this._castlingRights.whiteQueenside = false;
-            } else {
-                this._castlingRights.blackKingside = false;
-                this._castlingRights.blackQueenside = false;
-            }
-            this._kingSquares[this.colorToMove] = toSquare;
-        }
-
-        // If we are moving a rook from its initial square revoke castling rights
-        if (movingPiece.piece === PIECES.ROOK) {
-            const requiredRank = this.colorToMove === COLORS.WHITE ? RANKS.RANK_1 : RANKS.RANK_8;
-            const fromFile = fileOfSquare(fromSquare);
-            const fromRank = rankOfSquare(fromSquare);
-            if (fromFile === FILES.FILE_H && requiredRank === fromRank) {
-                if (this.colorToMove === COLORS.WHITE) {
-                    this._castlingRights.whiteKingside = false;
-                } else {
-                    this._castlingRights.blackKingside = false;
-                }
-            } else if (fromFile === FILES.FILE_A && requiredRank === fromRank) {
-                if (this.colorToMove === COLORS.WHITE) {
-                    this._castlingRights.whiteQueenside = false;
-                } else {
-                    this._castlingRights.blackQueenside = false;
-                }
-            }
-        }
-
-        // If we capture the opponent's rook on its initial square revoke their castling rights
-        updateCastlingFromCapturedPiece(capturedPiece, toSquare);
-
-        // Castling
-        if (movingPiece.piece === PIECES.KING) {
-            const rank = rankOfSquare(fromSquare);
-            const fromFile = fileOfSquare(fromSquare);
-            const toFile = fileOfSquare(toSquare);
-            if (fromFile === FILES.FILE_E && toFile === FILES.FILE_G) {
-                // Kingside castling
-                // Move the rook
-                undoInfo.isKingsideCastle = true;
-                const fromRookSquare = createSquare(FILES.FILE_H, rank);
-                const toRookSquare = createSquare(FILES.FILE_F, rank);
-                this._squares[fromRookSquare] = null;
-                this._squares[toRookSquare] = { piece: PIECES.ROOK, color: this.colorToMove };
-                eventData.movingPieces.push({ from: fromRookSquare, to: toRookSquare, piece: this._squares[toRookSquare] });
-            } else if (fromFile === FILES.FILE_E && toFile === FILES.FILE_C) {
-                // Queenside castling
-                // Move the rook
-                undoInfo.isQueensideCastle = true;
-                const fromRookSquare = createSquare(FILES.FILE_A, rank);
-                const toRookSquare = createSquare(FILES.FILE_D, rank);
-                this._squares[fromRookSquare] = null;
-                this._squares[toRookSquare] = { piece: PIECES.ROOK, color: this.colorToMove };
-                eventData.movingPieces.push({ from: fromRookSquare, to: toRookSquare, piece: this._squares[toRookSquare] });
-            }
-        }
-
-        // Check if our move created an attack on the king
-        // Generate all moves and determine if the king is attacked
-        const oppositionKingSquare = this.getKingSquare(otherColor(this.colorToMove));
-        this._inCheck = false;
-        for (const mv of generatePseudoLegalMoves(this)) {
-            if (mv.to === oppositionKingSquare) {
-                this._inCheck = true;
-                break;
-            }
-        }
-
-        // Swap moving color
-        this._colorToMove = otherColor(this.colorToMove);
+        this._makeMove(packMoveObject(move), eventData, undoInfo);
+        // The move is undone from undoInfo (see undoMove) so it doesn't stay on the undo stack of makePackedMove
+        this._undoSquareCount = this._undoState[(--this._undoPly * UNDO_STATE_SIZE) + 5];
 
         if (sendEvents) {
             this.movePlayed.trigger(eventData);
@@ -633,15 +701,14 @@ class Position {
                 this.moveUndone.trigger(eventData);
             }
         }
-
         // Restore board state from undoInfo
-        this._squares = [...undoInfo.squares];
-        this._castlingRights = { ...undoInfo.castlingRights };
+        this._board.set(undoInfo.squares);
+        this._castlingRights = undoInfo.castlingRights;
         this._inCheck = undoInfo.inCheck;
         this._enpassantSquare = undoInfo.enpassantSquare;
-        this._kingSquares = [...undoInfo.kingSquares];
+        this._kingSquares.set(undoInfo.kingSquares);
 
-        this._colorToMove = otherColor(this.colorToMove);
+        this.colorToMove = otherColor(this.colorToMove);
     }
 
     // Determine whether the position is a draw or checkmate or still valid
@@ -655,8 +722,8 @@ class Position {
 
         // If only kings remain it is a draw
         let valid = false;
-        for (const piece of this._squares) {
-            if (piece && piece.piece !== PIECES.KING) {
+        for (const code of this._board) {
+            if (code !== EMPTY_SQUARE && pieceTypeOfCode(code) !== PIECES.KING) {
                 valid = true;
                 break;
             }
@@ -665,10 +732,10 @@ class Position {
             return POSITION_STATE.DRAW;
         }
 
-        const moves = generatePseudoLegalMoves(this);
+        const moveCount = generatePseudoLegalPackedMoves(this, this._moveBuffer);
         let hasLegalMove = false;
-        for (const mv of moves) {
-            if (this.isLegal(mv)) {
+        for (let i = 0; i < moveCount; i++) {
+            if (this.isPackedMoveLegal(this._moveBuffer[i])) {
                 hasLegalMove = true;
                 break;
             }
@@ -687,24 +754,184 @@ class Position {
 
     _initialize() {
         // Find the king squares
-        for (let square = 0; square < this._squares.length; square++) {
-            const piece = this._squares[square];
-            if (piece && piece.piece === PIECES.KING) {
-                this._kingSquares[piece.color] = square;
+        for (let square = 0; square < SQUARE_COUNT; square++) {
+            const code = this._board[square];
+            if (code !== EMPTY_SQUARE && pieceTypeOfCode(code) === PIECES.KING) {
+                this._kingSquares[colorOfCode(code)] = square;
             }
         }
         // Detect check
         this._inCheck = false;
         const kingSquare = this.getKingSquare(this.colorToMove);
-        this._colorToMove = otherColor(this.colorToMove);
-        const moves = generatePseudoLegalMoves(this);
-        for (const move of moves) {
-            if (move.to === kingSquare && this.isLegal(move)) {
+        this.colorToMove = otherColor(this.colorToMove);
+        const moveCount = generatePseudoLegalPackedMoves(this, this._moveBuffer);
+        for (let i = 0; i < moveCount; i++) {
+            const move = this._moveBuffer[i];
+            if (packedMoveTo(move) === kingSquare && this.isPackedMoveLegal(move)) {
                 this._inCheck = true;
                 break;
             }
         }
-        this._colorToMove = otherColor(this.colorToMove);
+        this.colorToMove = otherColor(this.colorToMove);
+    }
+
+    // Applies a packed move, saving the state needed by unmakePackedMove on the undo stack
+    // eventData and undoInfo are filled in for applyMove, they are null for makePackedMove
+    _makeMove(move, eventData, undoInfo) {
+        assert(this._undoPly < MAX_UNDO_PLY, "Too many moves to undo");
+        const color = this.colorToMove;
+        const fromSquare = packedMoveFrom(move);
+        const toSquare = packedMoveTo(move);
+        const promotion = packedMovePromotion(move);
+        const enpassantSquare = this.enpassantSquare;
+        const movingCode = this._board[fromSquare];
+        const movingPiece = pieceTypeOfCode(movingCode);
+        const capturedCode = this._board[toSquare];
+
+        // Save the current board state
+        const state = this._undoPly++ * UNDO_STATE_SIZE;
+        this._undoState[state] = this._castlingRights;
+        this._undoState[state + 1] = this._enpassantSquare;
+        this._undoState[state + 2] = this._inCheck ? 1 : 0;
+        this._undoState[state + 3] = this._kingSquares[COLORS.WHITE];
+        this._undoState[state + 4] = this._kingSquares[COLORS.BLACK];
+        this._undoState[state + 5] = this._undoSquareCount;
+
+        // Reset enpassant square
+        this._enpassantSquare = SQUARES.INVALID;
+
+        // Move the piece
+        this._setSquare(fromSquare, EMPTY_SQUARE);
+        this._setSquare(toSquare, movingCode);
+
+        if (capturedCode !== EMPTY_SQUARE) {
+            this._recordCapture(toSquare, capturedCode, eventData, undoInfo);
+            this._explode(movingCode, fromSquare, toSquare, eventData, undoInfo);
+        }
+
+        // Enpassant
+        if (toSquare === enpassantSquare && movingPiece === PIECES.PAWN) {
+            const captureSquare = getBackwardSquare(toSquare, color);
+            this._recordCapture(captureSquare, createPieceCode(PIECES.PAWN, otherColor(color)), eventData, undoInfo);
+            this._setSquare(captureSquare, EMPTY_SQUARE);
+            this._explode(movingCode, fromSquare, toSquare, eventData, undoInfo);
+        }
+
+        // Update promotion
+        if (promotion !== PIECES.NONE && movingPiece === PIECES.PAWN && (!this.isAtomic || capturedCode === EMPTY_SQUARE)) {
+            const promotedCode = createPieceCode(promotion, color);
+            this._setSquare(toSquare, promotedCode);
+            if (undoInfo) {
+                undoInfo.isPromotion = true;
+            }
+            if (eventData) {
+                eventData.promotedPieces.push({ square: toSquare, piece: PIECE_OBJECTS[promotedCode] });
+            }
+        }
+
+        // If we double push a pawn - set the enpassant square
+        if (movingPiece === PIECES.PAWN && Math.abs(rankOfSquare(fromSquare) - rankOfSquare(toSquare)) === 2) {
+            this._enpassantSquare = getBackwardSquare(toSquare, color);
+        }
+
+        if (movingPiece === PIECES.KING) {
+            // If the king has moved then revoke castling rights
+            this._castlingRights &= ~(kingsideCastlingRight(color) | queensideCastlingRight(color));
+            this._kingSquares[color] = toSquare;
+
+            // Castling, move the rook
+            // (the king has already left the from square so _isCastle can't be used)
+            const rank = rankOfSquare(fromSquare);
+            const fromFile = fileOfSquare(fromSquare);
+            const toFile = fileOfSquare(toSquare);
+            const kingsideCastle = fromFile === FILES.FILE_E && toFile === FILES.FILE_G;
+            if (kingsideCastle || (fromFile === FILES.FILE_E && toFile === FILES.FILE_C)) {
+                const fromRookSquare = createSquare(kingsideCastle ? FILES.FILE_H : FILES.FILE_A, rank);
+                const toRookSquare = createSquare(kingsideCastle ? FILES.FILE_F : FILES.FILE_D, rank);
+                const rookCode = createPieceCode(PIECES.ROOK, color);
+                this._setSquare(fromRookSquare, EMPTY_SQUARE);
+                this._setSquare(toRookSquare, rookCode);
+                if (undoInfo) {
+                    undoInfo.isKingsideCastle = kingsideCastle;
+                    undoInfo.isQueensideCastle = !kingsideCastle;
+                }
+                if (eventData) {
+                    eventData.movingPieces.push({ from: fromRookSquare, to: toRookSquare, piece: PIECE_OBJECTS[rookCode] });
+                }
+            }
+        }
+
+        // If we are moving a rook from its initial square revoke castling rights
+        this._revokeRookCastlingRights(movingCode, fromSquare);
+        // If we capture the opponent's rook on its initial square revoke their castling rights
+        this._revokeRookCastlingRights(capturedCode, toSquare);
+
+        // Check if our move created an attack on the king
+        const oppositionKingSquare = this.getKingSquare(otherColor(color));
+        this._inCheck = oppositionKingSquare !== SQUARES.INVALID && this._isSquareAttacked(oppositionKingSquare, color);
+
+        // Swap moving color
+        this.colorToMove = otherColor(color);
+    }
+
+    // Changes the piece on a square, saving the previous piece for unmakePackedMove
+    _setSquare(square, code) {
+        this._undoSquares[this._undoSquareCount++] = square | (this._board[square] << 6);
+        this._board[square] = code;
+    }
+
+    _recordCapture(square, code, eventData, undoInfo) {
+        if (undoInfo) {
+            undoInfo.capturedPieces.push({ square, piece: PIECE_OBJECTS[code] });
+        }
+        if (eventData) {
+            eventData.capturedPieces.push({ square, piece: PIECE_OBJECTS[code] });
+        }
+    }
+
+    // Called whenever a piece is captured
+    // Handles atomic chess explosion
+    _explode(movingCode, fromSquare, explosionSquare, eventData, undoInfo) {
+        if (!this.isAtomic) {
+            return;
+        }
+        for (const square of KING_SQUARES[explosionSquare]) {
+            const code = this._board[square];
+            // Only explode non-pawn pieces
+            if (code !== EMPTY_SQUARE && pieceTypeOfCode(code) !== PIECES.PAWN) {
+                this._revokeRookCastlingRights(code, square);
+                // Check if the enemy king got blown up
+                if (pieceTypeOfCode(code) === PIECES.KING) {
+                    this._kingSquares[otherColor(this.colorToMove)] = SQUARES.INVALID;
+                }
+                this._recordCapture(square, code, eventData, undoInfo);
+                this._setSquare(square, EMPTY_SQUARE);
+            }
+        }
+        // Explode the moving piece
+        this._setSquare(explosionSquare, EMPTY_SQUARE);
+        if (undoInfo) {
+            undoInfo.capturedPieces.push({ square: fromSquare, piece: PIECE_OBJECTS[movingCode], isMovingPiece: true });
+        }
+        if (eventData) {
+            eventData.movingPieceCaptured = true;
+        }
+    }
+
+    // Revokes the castling right of a rook that moves or is captured on its initial square
+    _revokeRookCastlingRights(code, square) {
+        if (code === EMPTY_SQUARE || pieceTypeOfCode(code) !== PIECES.ROOK) {
+            return;
+        }
+        const color = colorOfCode(code);
+        if (rankOfSquare(square) !== (color === COLORS.WHITE ? RANKS.RANK_1 : RANKS.RANK_8)) {
+            return;
+        }
+        if (fileOfSquare(square) === FILES.FILE_H) {
+            this._castlingRights &= ~kingsideCastlingRight(color);
+        } else if (fileOfSquare(square) === FILES.FILE_A) {
+            this._castlingRights &= ~queensideCastlingRight(color);
+        }
     }
 }
 
@@ -863,6 +1090,8 @@ class ChessBoard {
         // If flipped then we are seeing the board from Black's perspective
         this._flipped = false;
         this._moveMarkerDivs = [];
+        // Used to check that moves are legal and to find the moves of a piece for the move markers
+        this._moveBuffer = createMoveBuffer();
 
         this._moveHistory = [];
         this._historyIndex = -1;
@@ -1242,10 +1471,8 @@ class ChessBoard {
             enpassantSquare: SQUARES.INVALID,
         });
         this.position._colorToMove = opts.colorToMove;
-        this.position._castlingRights.whiteKingside = opts.whiteKingside;
-        this.position._castlingRights.whiteQueenside = opts.whiteQueenside;
-        this.position._castlingRights.blackKingside = opts.blackKingside;
-        this.position._castlingRights.blackQueenside = opts.blackQueenside;
+        this.position._castlingRights = (opts.whiteKingside ? CASTLING_RIGHTS.WHITE_KINGSIDE : 0) | (opts.whiteQueenside ? CASTLING_RIGHTS.WHITE_QUEENSIDE : 0)
+            | (opts.blackKingside ? CASTLING_RIGHTS.BLACK_KINGSIDE : 0) | (opts.blackQueenside ? CASTLING_RIGHTS.BLACK_QUEENSIDE : 0);
         this.position._enpassantSquare = opts.enpassantSquare;
         this.position.setFromFen(this.fen);
     }
@@ -1305,9 +1532,10 @@ class ChessBoard {
         let isLegal = movesEqual(move, MOVE_NONE);
         this._squareEmphasizer.clear();
         if (!isLegal) {
-            const pseudoLegalMoves = generatePseudoLegalMoves(this.position);
-            for (const mv of pseudoLegalMoves) {
-                if (movesEqual(mv, move) && this.position.isLegal(move)) {
+            const packedMove = packMoveObject(move);
+            const moveCount = generatePseudoLegalPackedMoves(this.position, this._moveBuffer);
+            for (let i = 0; i < moveCount; i++) {
+                if (this._moveBuffer[i] === packedMove && this.position.isPackedMoveLegal(packedMove)) {
                     isLegal = true;
                     break;
                 }
@@ -1363,10 +1591,10 @@ class ChessBoard {
         if (this._options.showMoveMarkers) {
             const pieceOnSquare = this.position.getPieceOnSquare(square);
             if (pieceOnSquare && pieceOnSquare.color === this.position.colorToMove) {
-                const moves = generateMoves(pieceOnSquare.piece, square, pieceOnSquare.color, this.position);
-                for (const move of moves) {
-                    if (this.position.isLegal(move)) {
-                        this._createMoveMarker(move);
+                const moveCount = generatePieceMoves(pieceOnSquare.piece, square, pieceOnSquare.color, this.position, this._moveBuffer, 0);
+                for (let i = 0; i < moveCount; i++) {
+                    if (this.position.isPackedMoveLegal(this._moveBuffer[i])) {
+                        this._createMoveMarker(unpackMove(this._moveBuffer[i]));
                     }
                 }
             }
@@ -1781,3 +2009,4 @@ class ChessBoard {
         return "";
     }
 }
+/* eslint-enable no-bitwise */
@@ -1,3 +1,5 @@
+// no-bitwise is disabled for this file (piece codes and packed moves are bit fields) and enabled again at its end, as the chess library is linted as one bundle
+/* eslint-disable no-bitwise */
 // Defines constants that represent the 64 squares of the chess board
 const SQUARES = Object.freeze({
     A1:  0, B1:  1, C1:  2, D1:  3, E1:  4, F1:  5, G1:  6, H1:  7, /* eslint-disable-line key-spacing, object-property-newline */
@@ -41,6 +43,30 @@ const MOVE_NONE = {
     promotion: PIECES.NONE,
 };
 
+// Pieces are stored on the board of a Position as small integer codes
+// 0 is an empty square, otherwise the low 3 bits hold the piece type + 1 and bit 3 holds the color
+const EMPTY_SQUARE = 0;
+
+function createPieceCode(piece, color) {
+    return (color << 3) | (piece + 1);
+}
+
+function pieceTypeOfCode(code) {
+    return (code & 7) - 1;
+}
+
+function colorOfCode(code) {
+    return code >> 3;
+}
+
+// The piece objects ({ piece, color }) returned by Position.getPieceOnSquare, indexed by piece code
+// They are shared so must not be modified
+const PIECE_OBJECTS = [];
+for (let code = 0; code < 16; code++) {
+    const piece = pieceTypeOfCode(code);
+    PIECE_OBJECTS.push(code !== EMPTY_SQUARE && piece < PIECE_COUNT ? Object.freeze({ piece, color: colorOfCode(code) }) : null);
+}
+
 // Utility function to create a square from a given file and rank
 function createSquare(file, rank) {
     if (file < 0 || file >= FILE_COUNT || rank < 0 || rank >= RANK_COUNT) {
@@ -109,6 +135,59 @@ function isNextToSquare(square0, square1) {
     return Math.abs(df) <= 1 && Math.abs(dr) <= 1;
 }
 
+// Returns, for every square, the squares reached by each vector that stay on the board
+// If sliding is true each vector is followed until the edge of the board, giving one list of squares per vector (nearest first)
+function createSquareTable(vectors, sliding) {
+    const table = [];
+    for (let square = 0; square < SQUARE_COUNT; square++) {
+        const file = fileOfSquare(square);
+        const rank = rankOfSquare(square);
+        const squares = [];
+        for (const vector of vectors) {
+            const ray = [];
+            let newFile = file + vector[0];
+            let newRank = rank + vector[1];
+            while (validFileAndRank(newFile, newRank)) {
+                ray.push(createSquare(newFile, newRank));
+                if (!sliding) {
+                    break;
+                }
+                newFile += vector[0];
+                newRank += vector[1];
+            }
+            if (sliding) {
+                squares.push(ray);
+            } else {
+                squares.push(...ray);
+            }
+        }
+        table.push(squares);
+    }
+    return table;
+}
+
+// Precomputed squares used for move generation and attack detection
+// KNIGHT_SQUARES[square] and KING_SQUARES[square] are the squares a knight or king on the square moves to
+// PAWN_CAPTURE_SQUARES[color][square] are the squares a pawn of the color on the square captures on,
+// which are also the squares that a pawn of the other color attacks the square from
+// BISHOP_RAYS[square] and ROOK_RAYS[square] hold the squares along each direction from the square, nearest first
+const KNIGHT_SQUARES = createSquareTable(KNIGHT_MOVE_VECTORS, false);
+const KING_SQUARES = createSquareTable(KING_MOVE_VECTORS, false);
+const PAWN_CAPTURE_SQUARES = [createSquareTable([[-1, 1], [1, 1]], false), createSquareTable([[-1, -1], [1, -1]], false)];
+const BISHOP_RAYS = createSquareTable(BISHOP_MOVE_VECTORS, true);
+const ROOK_RAYS = createSquareTable(ROOK_MOVE_VECTORS, true);
+
+// SQUARE_DIRECTIONS[from * SQUARE_COUNT + to] is the index of the direction from one square to another along a line,
+// 0 to 3 for the directions of BISHOP_RAYS and 4 to 7 for ROOK_RAYS, or -1 if the squares aren't on a line
+const SQUARE_DIRECTIONS = new Int8Array(SQUARE_COUNT * SQUARE_COUNT).fill(-1);
+for (let square = 0; square < SQUARE_COUNT; square++) {
+    [...BISHOP_RAYS[square], ...ROOK_RAYS[square]].forEach((ray, direction) => {
+        for (const target of ray) {
+            SQUARE_DIRECTIONS[square * SQUARE_COUNT + target] = direction;
+        }
+    });
+}
+
 // Utility function to create a move from 2 squares
 function createMove(fromSquare, toSquare, promotion = PIECES.NONE) {
     assert(fromSquare !== toSquare, "Invalid move");
@@ -128,171 +207,190 @@ function movesEqual(move1, move2) {
     return move1.from === move2.from && move1.to === move2.to && move1.promotion === move2.promotion;
 }
 
+// Move generation writes moves packed into integers to a move buffer (a Uint16Array) instead of creating move objects
+// Bits 0-5 hold the from square, bits 6-11 the to square and bits 12-14 the promotion piece type + 1
+// A position has at most 64 pieces, each with at most 27 moves (a queen in the center of an empty board)
+const MAX_MOVES_PER_POSITION = SQUARE_COUNT * 27;
+
+function createMoveBuffer(positionCount = 1) {
+    return new Uint16Array(positionCount * MAX_MOVES_PER_POSITION);
+}
+
+function packMove(fromSquare, toSquare, promotion = PIECES.NONE) {
+    return fromSquare | (toSquare << 6) | ((promotion + 1) << 12);
+}
+
+function packedMoveFrom(move) {
+    return move & 63;
+}
+
+function packedMoveTo(move) {
+    return (move >> 6) & 63;
+}
+
+function packedMovePromotion(move) {
+    return (move >> 12) - 1;
+}
+
+// Converts between move objects and packed moves
+function packMoveObject(move) {
+    return packMove(move.from, move.to, move.promotion);
+}
+
+function unpackMove(move) {
+    return createMove(packedMoveFrom(move), packedMoveTo(move), packedMovePromotion(move));
+}
+
+// The move generation functions below write the pseudo-legal moves they find to a move buffer starting at index count,
+// and return the new number of moves in the buffer
+
+// Writes a move to a move buffer for every promotion piece if the move promotes, otherwise a single move
+function addPawnMove(fromSquare, toSquare, isPromotion, moves, count) {
+    if (isPromotion) {
+        for (const promotion of PROMOTION_PIECE_TYPES) {
+            moves[count++] = packMove(fromSquare, toSquare, promotion);
+        }
+        return count;
+    }
+    moves[count++] = packMove(fromSquare, toSquare);
+    return count;
+}
+
 // Generates all pseudo-legal pawn moves from a given square
-function generatePawnMoves(square, color, position) {
-    const moves = [];
+function generatePawnMoves(square, color, position, moves, count) {
+    const board = position.board;
     // Detect if we are making a move resulting in a promotion
     const promotionRank = color === COLORS.WHITE ? RANKS.RANK_8 : RANKS.RANK_1;
     // Detect if we can push 2 squares forward
     const doublePushRank = color === COLORS.WHITE ? RANKS.RANK_2 : RANKS.RANK_7;
     const forwardSquare = getForwardSquare(square, color);
-    const toRank = rankOfSquare(forwardSquare);
-    const isPromotion = toRank === promotionRank;
+    const isPromotion = rankOfSquare(forwardSquare) === promotionRank;
     // If there is no piece directly in front of us then we can move forward
-    if (!position.isSquareOccupied(forwardSquare)) {
-        // Handle pushing to promote
-        if (isPromotion) {
-            for (const promotion of PROMOTION_PIECE_TYPES) {
-                moves.push(createMove(square, forwardSquare, promotion));
-            }
-        } else {
-            moves.push(createMove(square, forwardSquare));
-            const fromRank = rankOfSquare(square);
-            // If we can push 2 squares forward
-            if (fromRank === doublePushRank) {
-                const doubleForwardSquare = getForwardSquare(forwardSquare, color);
-                // Check the square is not occupied
-                if (!position.isSquareOccupied(doubleForwardSquare)) {
-                    moves.push(createMove(square, doubleForwardSquare));
-                }
+    if (board[forwardSquare] === EMPTY_SQUARE) {
+        count = addPawnMove(square, forwardSquare, isPromotion, moves, count);
+        // If we can push 2 squares forward and the square is not occupied
+        if (rankOfSquare(square) === doublePushRank) {
+            const doubleForwardSquare = getForwardSquare(forwardSquare, color);
+            if (board[doubleForwardSquare] === EMPTY_SQUARE) {
+                moves[count++] = packMove(square, doubleForwardSquare);
             }
         }
     }
     // Pawns capture forward and to the left or right
-    const captureSquares = [getLeftSquare(forwardSquare), getRightSquare(forwardSquare)];
-    for (const capSquare of captureSquares) {
-        if (capSquare !== SQUARES.INVALID) {
-            // Can only move if there is a piece on the capture square or the capture square is the enpassant square
-            const pieceOnSquare = position.getPieceOnSquare(capSquare);
-            if ((pieceOnSquare && pieceOnSquare.color !== color) || capSquare === position.enpassantSquare) {
-                if (isPromotion) {
-                    for (const promotion of PROMOTION_PIECE_TYPES) {
-                        moves.push(createMove(square, capSquare, promotion));
-                    }
-                } else {
-                    moves.push(createMove(square, capSquare));
-                }
-            }
+    // Can only move if there is a piece on the capture square or the capture square is the enpassant square
+    for (const captureSquare of PAWN_CAPTURE_SQUARES[color][square]) {
+        const code = board[captureSquare];
+        if ((code !== EMPTY_SQUARE && colorOfCode(code) !== color) || captureSquare === position.enpassantSquare) {
+            count = addPawnMove(square, captureSquare, isPromotion, moves, count);
         }
     }
-    return moves;
+    return count;
 }
 
-// Utility function that generates "non-sliding" moves from a set of vectors (eg. Knight and king)
-function generateMovesFromNonSlidingVectors(square, color, position, vectors) {
-    const file = fileOfSquare(square);
-    const rank = rankOfSquare(square);
-    const moves = [];
-    for (const vector of vectors) {
-        const newFile = file + vector[0];
-        const newRank = rank + vector[1];
-        if (validFileAndRank(newFile, newRank)) {
-            const newSquare = createSquare(newFile, newRank);
-            const pieceOnSquare = position.getPieceOnSquare(newSquare);
-            if (!pieceOnSquare || pieceOnSquare.color !== color) {
-                moves.push(createMove(square, newSquare));
-            }
+// Utility function that generates "non-sliding" moves to a set of squares (eg. Knight and king)
+function generateMovesToSquares(square, color, position, targetSquares, moves, count) {
+    const board = position.board;
+    for (const targetSquare of targetSquares) {
+        const code = board[targetSquare];
+        if (code === EMPTY_SQUARE || colorOfCode(code) !== color) {
+            moves[count++] = packMove(square, targetSquare);
         }
     }
-    return moves;
+    return count;
 }
 
-// Utility function that generates "sliding" moves by traversing along a set of vectors until a piece is reached or the edge of the board
-function generateMovesFromSlidingVectors(square, color, position, vectors) {
-    const file = fileOfSquare(square);
-    const rank = rankOfSquare(square);
-    const moves = [];
-    for (const vector of vectors) {
-        let currentFile = file + vector[0];
-        let currentRank = rank + vector[1];
-        while (validFileAndRank(currentFile, currentRank)) {
-            const pieceOnSquare = position.getPieceOnSquare(createSquare(currentFile, currentRank));
-            if (!pieceOnSquare || pieceOnSquare.color !== color) {
-                moves.push(createMove(square, createSquare(currentFile, currentRank)));
-                // Stop expanding along this vector (we can't x-ray through pieces)
-                if (pieceOnSquare) {
-                    break;
-                }
-            } else {
+// Utility function that generates "sliding" moves by traversing along a set of rays until a piece is reached or the edge of the board
+function generateMovesAlongRays(square, color, position, rays, moves, count) {
+    const board = position.board;
+    for (const ray of rays) {
+        for (const targetSquare of ray) {
+            const code = board[targetSquare];
+            if (code === EMPTY_SQUARE || colorOfCode(code) !== color) {
+                moves[count++] = packMove(square, targetSquare);
+            }
+            // Stop expanding along this ray (we can't x-ray through pieces)
+            if (code !== EMPTY_SQUARE) {
                 break;
             }
-            currentFile += vector[0];
-            currentRank += vector[1];
         }
     }
-    return moves;
-}
-
-// Generates all pseudo-legal knight moves from a given square
-function generateKnightMoves(square, color, position) {
-    return generateMovesFromNonSlidingVectors(square, color, position, KNIGHT_MOVE_VECTORS);
-}
-
-// Generates all pseudo-legal bishop moves from a given square
-function generateBishopMoves(square, color, position) {
-    return generateMovesFromSlidingVectors(square, color, position, BISHOP_MOVE_VECTORS);
-}
-
-// Generates all pseudo-legal rook moves from a given square
-function generateRookMoves(square, color, position) {
-    return generateMovesFromSlidingVectors(square, color, position, ROOK_MOVE_VECTORS);
-}
-
-// Generates all pseudo-legal queen moves from a given square
-function generateQueenMoves(square, color, position) {
-    // A queen is essentially a bishop and rook
-    return [...generateBishopMoves(square, color, position), ...generateRookMoves(square, color, position)];
+    return count;
 }
 
 // Generates all pseudo-legal king moves from a given square
-function generateKingMoves(square, color, position) {
-    const moves = generateMovesFromNonSlidingVectors(square, color, position, KING_MOVE_VECTORS);
+function generateKingMoves(square, color, position, moves, count) {
+    const board = position.board;
+    count = generateMovesToSquares(square, color, position, KING_SQUARES[square], moves, count);
 
     const rank = rankOfSquare(square);
     if (position.canCastleKingside(color)) {
-        const isEmptyPath = [createSquare(FILES.FILE_F, rank), createSquare(FILES.FILE_G, rank)].every(sq => !position.isSquareOccupied(sq));
-        if (isEmptyPath) {
-            moves.push(createMove(square, createSquare(FILES.FILE_G, rank)));
+        if (board[createSquare(FILES.FILE_F, rank)] === EMPTY_SQUARE && board[createSquare(FILES.FILE_G, rank)] === EMPTY_SQUARE) {
+            moves[count++] = packMove(square, createSquare(FILES.FILE_G, rank));
         }
     }
     if (position.canCastleQueenside(color)) {
-        const isEmptyPath = [createSquare(FILES.FILE_B, rank), createSquare(FILES.FILE_C, rank), createSquare(FILES.FILE_D, rank)].every(sq => !position.isSquareOccupied(sq));
+        const isEmptyPath = board[createSquare(FILES.FILE_B, rank)] === EMPTY_SQUARE && board[createSquare(FILES.FILE_C, rank)] === EMPTY_SQUARE
+            && board[createSquare(FILES.FILE_D, rank)] === EMPTY_SQUARE;
         if (isEmptyPath) {
-            moves.push(createMove(square, createSquare(FILES.FILE_C, rank)));
+            moves[count++] = packMove(square, createSquare(FILES.FILE_C, rank));
         }
     }
-    return moves;
+    return count;
 }
 
 // Generates all pseudo-legal moves of a given piece on a given square
-function generateMoves(piece, square, color, position) {
+function generatePieceMoves(piece, square, color, position, moves, count) {
     switch (piece) {
     case PIECES.PAWN:
-        return generatePawnMoves(square, color, position);
+        return generatePawnMoves(square, color, position, moves, count);
     case PIECES.KNIGHT:
-        return generateKnightMoves(square, color, position);
+        return generateMovesToSquares(square, color, position, KNIGHT_SQUARES[square], moves, count);
     case PIECES.BISHOP:
-        return generateBishopMoves(square, color, position);
+        return generateMovesAlongRays(square, color, position, BISHOP_RAYS[square], moves, count);
     case PIECES.ROOK:
-        return generateRookMoves(square, color, position);
+        return generateMovesAlongRays(square, color, position, ROOK_RAYS[square], moves, count);
     case PIECES.QUEEN:
-        return generateQueenMoves(square, color, position);
+        // A queen is essentially a bishop and rook
+        count = generateMovesAlongRays(square, color, position, BISHOP_RAYS[square], moves, count);
+        return generateMovesAlongRays(square, color, position, ROOK_RAYS[square], moves, count);
     case PIECES.KING:
-        return generateKingMoves(square, color, position);
+        return generateKingMoves(square, color, position, moves, count);
     }
     throw new Error("Invalid piece type");
 }
 
 // Generates all pseudo-legal moves for the given position
-function generatePseudoLegalMoves(position) {
-    const moves = [];
-    for (let i = 0; i < SQUARE_COUNT; ++i) {
-        const piece = position.getPieceOnSquare(i);
-        if (piece && piece.color === position.colorToMove) {
-            moves.push(...generateMoves(piece.piece, i, piece.color, position));
+function generatePseudoLegalPackedMoves(position, moves, count = 0) {
+    const board = position.board;
+    const color = position.colorToMove;
+    for (let square = 0; square < SQUARE_COUNT; ++square) {
+        const code = board[square];
+        if (code !== EMPTY_SQUARE && colorOfCode(code) === color) {
+            count = generatePieceMoves(pieceTypeOfCode(code), square, color, position, moves, count);
         }
     }
-    return moves;
+    return count;
+}
+
+// Buffer for the functions that return move objects, the moves are unpacked before it is reused
+const MOVE_OBJECT_BUFFER = createMoveBuffer();
+
+function unpackMoves(moves, count) {
+    const result = [];
+    for (let i = 0; i < count; i++) {
+        result.push(unpackMove(moves[i]));
+    }
+    return result;
+}
+
+// Returns the pseudo-legal moves of a given piece on a given square as move objects
+function generateMoves(piece, square, color, position) {
+    return unpackMoves(MOVE_OBJECT_BUFFER, generatePieceMoves(piece, square, color, position, MOVE_OBJECT_BUFFER, 0));
+}
+
+// Returns all pseudo-legal moves for the given position as move objects
+function generatePseudoLegalMoves(position) {
+    return unpackMoves(MOVE_OBJECT_BUFFER, generatePseudoLegalPackedMoves(position, MOVE_OBJECT_BUFFER, 0));
 }
 
 // Convert square to UCI string
@@ -374,27 +472,29 @@ function perft(position, depth, log = false, comparisonData = null) {
             comparison[parts[0]] = Number(parts.slice(1));
         }
     }
-    const internalPerft = (dpth) => {
+    // The moves of each ply are written to the buffer after the moves of the previous ply
+    const moves = createMoveBuffer(Math.max(depth, 1));
+    const internalPerft = (dpth, start) => {
         if (dpth <= 0) {
             return 1;
         }
-        const moves = generatePseudoLegalMoves(position).filter(mv => position.isLegal(mv));
+        const end = position.generateLegalPackedMoves(moves, start);
         if (dpth <= 1 && depth !== 1) {
-            return moves.length;
+            return end - start;
         }
         let count = 0;
-        for (const move of moves) {
-            const undo = position.applyMove(move, false, false);
-            const c = internalPerft(dpth - 1);
+        for (let i = start; i < end; i++) {
+            position.makePackedMove(moves[i]);
+            const c = internalPerft(dpth - 1, end);
             count += c;
-            position.undoMove(move, undo, false, false);
+            position.unmakePackedMove();
             if (dpth === depth) {
-                moveData[moveToString(move)] = c;
+                moveData[moveToString(unpackMove(moves[i]))] = c;
             }
         }
         return count;
     };
-    const total = internalPerft(depth);
+    const total = internalPerft(depth, 0);
     if (log) {
         for (const key of Object.keys(moveData)) {
             console.log(`${key}: ${moveData[key]}`);
@@ -408,3 +508,4 @@ function perft(position, depth, log = false, comparisonData = null) {
     }
     return total;
 }
+/* eslint-enable no-bitwise */
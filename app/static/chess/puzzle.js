@@ -31,6 +31,52 @@ function transformSettingsResponse(settings) {
     };
 }
 
+// Class that collects puzzle completions of a final test and sends them to the server in batches
+class CompletionBuffer {
+    constructor(endpoint, maxSize = 5) {
+        this.endpoint = endpoint;
+        this.maxSize = maxSize;
+        this._pending = [];
+    }
+
+    get size() {
+        return this._pending.length;
+    }
+
+    // Add a completion { puzzle_id, attempts, start_time, end_time }, flushes once maxSize completions are waiting
+    async add(completion) {
+        this._pending.push(completion);
+        if (this._pending.length >= this.maxSize) {
+            return this.flush();
+        }
+        return true;
+    }
+
+    // Send the waiting completions in one request, they are kept if the request fails so a later flush can retry
+    async flush() {
+        if (this._pending.length === 0) {
+            return true;
+        }
+        const completions = this._pending;
+        this._pending = [];
+        const success = await ajax(this.endpoint, "POST", { completions });
+        if (!success) {
+            this._pending = completions.concat(this._pending);
+        }
+        return success;
+    }
+
+    // Send the waiting completions without waiting for a response (used when the page is closed)
+    flushOnUnload() {
+        if (this._pending.length > 0 && navigator.sendBeacon) {
+            const body = new Blob([JSON.stringify({ completions: this._pending })], { type: "application/json" });
+            if (navigator.sendBeacon(this.endpoint, body)) {
+                this._pending = [];
+            }
+        }
+    }
+}
+
 // Class that represents a Puzzle, wraps a board with a starting position and tree of valid moves
 class Puzzle {
     constructor(options) {
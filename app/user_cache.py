@@ -0,0 +1,62 @@
+""" Module that caches snapshots of users so that API requests don't need to query the User table """
+import collections
+import threading
+import time
+
+from flask_sqlalchemy import sqlalchemy
+from app import app
+from app.models import User
+
+# Read-only copy of the user fields needed by the API (settings must not be modified)
+UserSnapshot = collections.namedtuple("UserSnapshot", ["id", "username", "is_admin", "settings"])
+
+class UserCache:
+    """ Bounded LRU cache of user snapshots
+    Entries expire after USER_CACHE_TTL seconds so that changes made by other workers are eventually seen,
+    changes made by this worker invalidate the entry immediately.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # user_id -> (snapshot, time loaded)
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """ Returns the snapshot of a user, or None if the user doesn't exist """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry[1] < app.config["USER_CACHE_TTL"]:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        snapshot = UserSnapshot(id=user.id, username=user.username, is_admin=user.is_admin, settings=dict(user.settings or {}))
+        with self._lock:
+            self._entries[user_id] = (snapshot, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > app.config["USER_CACHE_SIZE"]:
+                self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+user_cache = UserCache()
+
+@sqlalchemy.event.listens_for(User, "after_update")
+def invalidate_updated_user(mapper, connection, user):
+    """ Drops the snapshot of a user whenever their row is changed through the ORM (settings, admin flag, etc.) """
+    user_cache.invalidate(user.id)
+
+@sqlalchemy.event.listens_for(User, "after_delete")
+def invalidate_deleted_user(mapper, connection, user):
+    user_cache.invalidate(user.id)
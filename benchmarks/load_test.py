@@ -0,0 +1,226 @@
+""" Load test which replays the assessment flow with many concurrent simulated users
+
+Each user registers, completes every lesson through PUT /api/lessons/<id>, starts a final test from /puzzle,
+fetches and completes each puzzle of the test and finishes it through /api/tests/<id>.
+Reports the throughput and p50/p95/p99 latency of every endpoint and writes them to a JSON file
+which can be passed back as --baseline to compare a change against.
+
+In-process (Flask test client, temporary SQLite database seeded with the puzzles):
+    python -m benchmarks.load_test --users 50 --concurrency 8
+Against a running server (which must already contain puzzles):
+    python -m benchmarks.load_test --url http://localhost:5000 --users 50 --concurrency 8
+"""
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import http.cookiejar
+import json
+import os
+import re
+import statistics
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+PASSWORD = "loadtest1"
+JSON_ENCODER = json.JSONEncoder()
+
+class TestClientTransport:
+    """ Sends requests to the app in this process through the Flask test client """
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, json=None, form=None):
+        response = self.client.open(path, method=method, json=json, data=form)
+        return response.status_code, response.get_data(as_text=True)
+
+class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+class HttpTransport:
+    """ Sends requests to a running server, keeping the session cookie of the user """
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirectHandler())
+
+    def request(self, method, path, json=None, form=None):
+        headers = {}
+        body = None
+        if json is not None:
+            body = JSON_ENCODER.encode(json).encode()
+            headers["Content-Type"] = "application/json"
+        elif form is not None:
+            body = urllib.parse.urlencode(form).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        request = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with self.opener.open(request) as response:
+                return response.status, response.read().decode()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read().decode()
+
+class Recorder:
+    """ Collects the latency of every request by endpoint """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def call(self, transport, name, method, path, expected=(200,), **kwargs):
+        start = time.perf_counter()
+        status, body = transport.request(method, path, **kwargs)
+        duration = time.perf_counter() - start
+        with self._lock:
+            self.latencies[name].append(duration)
+            if status not in expected:
+                self.errors[name] += 1
+        if status not in expected:
+            raise RuntimeError("{} {} returned {}".format(method, path, status))
+        return status, body
+
+def run_user(transport, recorder, batch):
+    """ Runs the assessment flow for one new user """
+    form = { "username": "load-" + uuid.uuid4().hex[:16], "password": PASSWORD, "played_chess_before": "y" }
+    status, page = recorder.call(transport, "GET /register", "GET", "/register")
+    csrf_token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page)
+    if csrf_token:
+        form["csrf_token"] = csrf_token.group(1)
+    recorder.call(transport, "POST /register", "POST", "/register", expected=(302,), form=form)
+
+    # Lessons are numbered from 0, the first missing id is the end of the lessons
+    lesson_id = 0
+    while recorder.call(transport, "GET /api/lessons/<id>", "GET", "/api/lessons/{}".format(lesson_id), expected=(200, 404))[0] == 200:
+        recorder.call(transport, "PUT /api/lessons/<id>", "PUT", "/api/lessons/{}".format(lesson_id), json={ "progression": 0 })
+        recorder.call(transport, "PUT /api/lessons/<id>", "PUT", "/api/lessons/{}".format(lesson_id), json={ "completed_lesson": True, "completed_test": True })
+        lesson_id += 1
+
+    status, page = recorder.call(transport, "GET /puzzle", "GET", "/puzzle")
+    test_id = int(re.search(r"/api/tests/(\d+)", page).group(1))
+
+    position = None
+    completions = []
+    while True:
+        path = "/api/puzzles/test/{}".format(test_id)
+        if batch and position is not None:
+            path += "?position={}".format(position + 1)
+        data = json.loads(recorder.call(transport, "GET /api/puzzles/test/<id>", "GET", path)[1])
+        if data["puzzle"] is None:
+            break
+        position = data.get("position")
+        now = int(time.time() * 1000)
+        completion = { "attempts": 1, "start_time": now - 5000, "end_time": now }
+        if batch:
+            completions.append({ **completion, "puzzle_id": data["puzzle"]["id"] })
+        else:
+            recorder.call(transport, "POST /api/puzzles/<id>", "POST", "/api/puzzles/{}".format(data["puzzle"]["id"]), json={ **completion, "test_id": test_id })
+        if data["is_final"]:
+            break
+    if batch:
+        recorder.call(transport, "POST /api/tests/<id>/completions", "POST", "/api/tests/{}/completions".format(test_id), json={ "completions": completions })
+    recorder.call(transport, "POST /api/tests/<id>", "POST", "/api/tests/{}".format(test_id), json={})
+    recorder.call(transport, "GET /api/stats/<id>", "GET", "/api/stats/{}".format(test_id))
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)]
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for name, latencies in sorted(recorder.latencies.items()):
+        latencies = sorted(latencies)
+        endpoints[name] = {
+            "count": len(latencies),
+            "errors": recorder.errors[name],
+            "throughput": len(latencies) / elapsed,
+            "mean_ms": 1000 * statistics.mean(latencies),
+            "p50_ms": 1000 * percentile(latencies, 0.5),
+            "p95_ms": 1000 * percentile(latencies, 0.95),
+            "p99_ms": 1000 * percentile(latencies, 0.99),
+        }
+    total = sum(len(latencies) for latencies in recorder.latencies.values())
+    return { "elapsed": elapsed, "requests": total, "throughput": total / elapsed, "endpoints": endpoints }
+
+def print_summary(summary, baseline=None):
+    print("{:<34} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9}".format("endpoint", "count", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for name, stats in summary["endpoints"].items():
+        line = "{:<34} {count:>7} {errors:>7} {throughput:>9.1f} {p50_ms:>9.2f} {p95_ms:>9.2f} {p99_ms:>9.2f}".format(name, **stats)
+        if baseline is not None and name in baseline["endpoints"] and baseline["endpoints"][name]["p95_ms"]:
+            change = 100 * (stats["p95_ms"] / baseline["endpoints"][name]["p95_ms"] - 1)
+            line += "  p95 {:+.1f}%".format(change)
+        print(line)
+    line = "total: {requests} requests in {elapsed:.2f}s ({throughput:.1f} req/s)".format(**summary)
+    if baseline is not None:
+        line += ", throughput {:+.1f}% vs baseline".format(100 * (summary["throughput"] / baseline["throughput"] - 1))
+    print(line)
+
+def create_in_process_app(profile):
+    """ Imports the app with a temporary seeded SQLite database, returns the app and the directory to clean up """
+    directory = tempfile.TemporaryDirectory()
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(directory.name, "load_test.db")
+    os.environ["DATABASE_PROFILE"] = profile
+    from app import app, db
+    from app.seeding import seed_puzzles, load_puzzle_corpus
+    # Forms are posted without fetching a CSRF token from the page
+    app.config["WTF_CSRF_ENABLED"] = False
+    with app.app_context():
+        db.create_all()
+        seed_puzzles(load_puzzle_corpus()[1])
+    return app, directory
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the assessment flow with concurrent simulated users")
+    parser.add_argument("--url", help="Base URL of a running server, the app is run in-process if omitted")
+    parser.add_argument("--users", type=int, default=20, help="Number of simulated users")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of users running at once")
+    parser.add_argument("--batch", action="store_true", help="Submit the test completions in one batch request")
+    parser.add_argument("--profile", default="default", help="DATABASE_PROFILE of the in-process app")
+    parser.add_argument("--output", default="load_test_results.json", help="File the results are written to")
+    parser.add_argument("--baseline", help="Results file of a previous run to compare against")
+    args = parser.parse_args()
+
+    directory = None
+    if args.url:
+        create_transport = lambda: HttpTransport(args.url)
+    else:
+        app, directory = create_in_process_app(args.profile)
+        create_transport = lambda: TestClientTransport(app)
+
+    recorder = Recorder()
+    start = time.perf_counter()
+    failures = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(run_user, create_transport(), recorder, args.batch) for _ in range(args.users)]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as error:
+                failures += 1
+                print("User failed: {}".format(error))
+    summary = summarize(recorder, time.perf_counter() - start)
+    if directory is not None:
+        directory.cleanup()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    print_summary(summary, baseline)
+
+    result = {
+        "created_at": datetime.datetime.now().isoformat(),
+        "options": vars(args),
+        "users": args.users,
+        "failed_users": failures,
+        **summary,
+    }
+    with open(args.output, "w") as file:
+        json.dump(result, file, indent=2)
+    print("Wrote {}".format(args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+""" Benchmark comparing the storage size and decode time of packed move trees (app/move_trees.py) with JSON
+
+Measures the puzzle corpus and randomly generated branching trees, which are larger than most hand written puzzles.
+JSON is measured the way JSONString stored move trees (json.dumps text, decoded with json.loads).
+
+Usage: python -m benchmarks.move_tree_storage [--trees 2000] [--depth 6] [--branching 3] [--repeat 5]
+"""
+import argparse
+import json
+import random
+import timeit
+
+from app.move_trees import encode_move_tree, decode_move_tree
+
+def load_corpus_trees():
+    # Imported here so that the benchmark doesn't need a database
+    from app.seeding import load_puzzle_corpus
+    return [puzzle["move_tree"] for puzzle in load_puzzle_corpus()[1]]
+
+def generate_tree(rng, depth, branching):
+    """ Generates a tree where the solver has one move and the opponent up to `branching` replies """
+    def generate_nodes(remaining, solver):
+        nodes = []
+        for _ in range(1 if solver else rng.randint(1, branching)):
+            node = { "move": { "from": rng.randrange(64), "to": rng.randrange(64), "promotion": rng.choice([-1] * 20 + [1, 2, 3, 4]) } }
+            if remaining > 1:
+                node["continuation"] = generate_nodes(remaining - 1, not solver)
+            nodes.append(node)
+        return nodes
+    return generate_nodes(rng.randint(2, depth), True)
+
+def measure(trees, repeat):
+    json_values = [json.dumps(tree) for tree in trees]
+    packed_values = [encode_move_tree(tree) for tree in trees]
+    assert all(decode_move_tree(value) == tree for value, tree in zip(packed_values, trees))
+    def best_time(function):
+        # Best of several runs of decoding every tree, in microseconds per tree
+        return min(timeit.repeat(function, number=1, repeat=repeat)) / len(trees) * 1e6
+    return {
+        "trees": len(trees),
+        "json_bytes": sum(len(value.encode()) for value in json_values),
+        "packed_bytes": sum(len(value) for value in packed_values),
+        "json_decode_us": best_time(lambda: [json.loads(value) for value in json_values]),
+        "packed_decode_us": best_time(lambda: [decode_move_tree(value) for value in packed_values]),
+        "json_encode_us": best_time(lambda: [json.dumps(tree) for tree in trees]),
+        "packed_encode_us": best_time(lambda: [encode_move_tree(tree) for tree in trees]),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare packed move trees with JSON")
+    parser.add_argument("--trees", type=int, default=2000, help="Number of generated trees")
+    parser.add_argument("--depth", type=int, default=6, help="Largest number of moves in a line of a generated tree")
+    parser.add_argument("--branching", type=int, default=3, help="Largest number of opponent replies in a generated tree")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    tree_sets = [
+        ("corpus", load_corpus_trees()),
+        ("generated", [generate_tree(rng, args.depth, args.branching) for _ in range(args.trees)]),
+    ]
+    print("{:<10} {:>6} {:>12} {:>12} {:>7} {:>11} {:>11} {:>11} {:>11}".format(
+        "trees", "count", "JSON bytes", "packed bytes", "ratio", "JSON dec us", "pack dec us", "JSON enc us", "pack enc us"))
+    for name, trees in tree_sets:
+        result = measure(trees, args.repeat)
+        print("{:<10} {trees:>6} {json_bytes:>12} {packed_bytes:>12} {:>6.1f}x {json_decode_us:>11.2f} {packed_decode_us:>11.2f} {json_encode_us:>11.2f} {packed_encode_us:>11.2f}".format(
+            name, result["json_bytes"] / result["packed_bytes"], **result))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+""" Perft suite for the server-side engine (app/engine), the counterpart of tests/perft.js
+
+Counts the move sequences of every position in tests/perft_suite.json with the root moves split across processes,
+checks the counts against the reference counts of the suite and reports nodes per second.
+Exits with status 1 if a count is wrong.
+
+Usage: python -m benchmarks.perft [--depth 3] [--processes <number of CPUs>] [--filter <name>]
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+from app.engine import Position, perft, move_to_string, move_from_string
+
+SUITE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests", "perft_suite.json")
+
+def load_perft_suite(path=SUITE_PATH):
+    """ Returns the positions of a perft suite as dicts with a name, fen, atomic flag and reference counts by depth """
+    with open(path) as file:
+        return json.load(file)["positions"]
+
+def perft_after_move(fen, atomic, move, depth):
+    """ Returns the number of move sequences of length `depth` starting with `move` (in UCI notation) """
+    position = Position.from_fen(fen, atomic=atomic)
+    position.make_move(move_from_string(move))
+    return perft(position, depth - 1)
+
+def parallel_perft(executor, fen, atomic, depth):
+    """ Counts the move sequences of length `depth` from a position with one task per root move, or in this process if `executor` is None """
+    position = Position.from_fen(fen, atomic=atomic)
+    if executor is None or depth <= 1:
+        return perft(position, depth)
+    # Moves are sent as strings so that the tasks don't depend on how the engine packs moves
+    moves = [move_to_string(move) for move in position.legal_moves()]
+    futures = [executor.submit(perft_after_move, fen, atomic, move, depth) for move in moves]
+    return sum(future.result() for future in futures)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the engine's perft counts and report nodes per second")
+    parser.add_argument("--depth", type=int, default=3, help="Largest depth checked, positions are checked at their deepest reference count up to it")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="Number of worker processes, 1 counts in this process")
+    parser.add_argument("--filter", default=None, help="Only check the positions whose name contains this text")
+    args = parser.parse_args()
+
+    entries = [entry for entry in load_perft_suite() if args.filter is None or args.filter in entry["name"]]
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.processes) if args.processes > 1 else None
+    total_nodes = 0
+    total_seconds = 0
+    failures = 0
+    try:
+        for entry in entries:
+            if not entry["counts"]:
+                continue
+            depth = min(args.depth, len(entry["counts"]))
+            start = time.perf_counter()
+            nodes = parallel_perft(executor, entry["fen"], entry["atomic"], depth)
+            seconds = time.perf_counter() - start
+            total_nodes += nodes
+            total_seconds += seconds
+            expected = entry["counts"][depth - 1]
+            if nodes == expected:
+                status = "ok"
+            else:
+                status = "FAIL expected {}".format(expected)
+                failures += 1
+            print("{:<40} depth {} {:>10} nodes {:>7.2f}s {:>9.0f} nodes/s {}".format(entry["name"], depth, nodes, seconds, nodes / seconds, status))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print("total {} nodes in {:.2f}s ({:.0f} nodes/s) with {} processes".format(total_nodes, total_seconds, total_nodes / total_seconds if total_seconds else 0, args.processes))
+    if failures:
+        print("{} positions have the wrong number of nodes".format(failures))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
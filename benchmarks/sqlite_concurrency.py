@@ -0,0 +1,125 @@
+""" Benchmark comparing SQLite throughput of the database profiles with several worker processes
+
+Each worker process imports the app like a gunicorn worker and runs a mix of requests: reading the user's lesson totals
+and current test (reads) and saving a puzzle completion (writes), each in its own session.
+
+Usage: python -m benchmarks.sqlite_concurrency [--workers 8] [--operations 200] [--read-ratio 0.7] [--profiles default concurrent]
+"""
+import argparse
+import datetime
+import multiprocessing
+import os
+import random
+import statistics
+import tempfile
+import time
+
+def import_app(database_url, profile):
+    """ Imports the app with the given database settings (must be called before anything imports app) """
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["DATABASE_PROFILE"] = profile
+    import app
+    return app
+
+def setup_database(database_url, profile, num_workers):
+    app = import_app(database_url, profile)
+    from app.models import Puzzle, Test, User
+    with app.app.app_context():
+        app.db.create_all()
+        puzzles = [Puzzle(fen="", move_tree={}, is_atomic=True, lesson_id=1 + i % 5) for i in range(20)]
+        app.db.session.add_all(puzzles)
+        for i in range(num_workers):
+            user = User(username="benchmark{}".format(i), pwd_hash="", chess_beginner=True)
+            app.db.session.add(user)
+            app.db.session.flush()
+            app.db.session.add(Test(user=user.id, start_time=datetime.datetime.now(), puzzle_plan=[puzzle.id for puzzle in puzzles], completed_puzzles=0))
+        app.db.session.commit()
+
+def run_worker(database_url, profile, index, operations, read_ratio, barrier, results):
+    app = import_app(database_url, profile)
+    from flask_sqlalchemy import sqlalchemy
+    from app.models import LessonPerformance, Puzzle, Test, User
+    from app.completion_writer import record_completions
+    db = app.db
+    rng = random.Random(index)
+    with app.app.app_context():
+        user_id = User.query.filter_by(username="benchmark{}".format(index)).one().id
+        test_id = Test.query.filter_by(user=user_id).one().id
+        puzzles = db.session.query(Puzzle.id, Puzzle.lesson_id).all()
+        db.session.remove()
+
+        barrier.wait()
+        latencies = []
+        errors = 0
+        start = time.perf_counter()
+        for _ in range(operations):
+            operation_start = time.perf_counter()
+            try:
+                if rng.random() < read_ratio:
+                    LessonPerformance.query.filter_by(user=user_id).all()
+                    Test.query.get(test_id)
+                else:
+                    puzzle_id, lesson_id = rng.choice(puzzles)
+                    now = datetime.datetime.now()
+                    record_completions([{
+                        "user": user_id,
+                        "puzzle_id": puzzle_id,
+                        "lesson_id": lesson_id,
+                        "attempts": 1,
+                        "start_time": now - datetime.timedelta(seconds=10),
+                        "end_time": now,
+                        "test_number": test_id,
+                    }])
+                    db.session.commit()
+                latencies.append(time.perf_counter() - operation_start)
+            except sqlalchemy.exc.OperationalError:
+                # "database is locked" once the busy timeout runs out
+                db.session.rollback()
+                errors += 1
+            finally:
+                db.session.remove()
+        results.put((time.perf_counter() - start, latencies, errors))
+
+def run_profile(profile, args):
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = "sqlite:///" + os.path.join(directory, "benchmark.db")
+        process = context.Process(target=setup_database, args=(database_url, profile, args.workers))
+        process.start()
+        process.join()
+
+        barrier = context.Barrier(args.workers)
+        results = context.Queue()
+        workers = [context.Process(target=run_worker, args=(database_url, profile, i, args.operations, args.read_ratio, barrier, results)) for i in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        worker_results = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+
+    elapsed = max(result[0] for result in worker_results)
+    latencies = sorted(latency for result in worker_results for latency in result[1])
+    errors = sum(result[2] for result in worker_results)
+    return {
+        "profile": profile,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": 1000 * statistics.median(latencies) if latencies else 0,
+        "p99_ms": 1000 * latencies[int(0.99 * (len(latencies) - 1))] if latencies else 0,
+        "errors": errors,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare SQLite database profiles under concurrent load")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--operations", type=int, default=200, help="Operations per worker")
+    parser.add_argument("--read-ratio", type=float, default=0.7)
+    parser.add_argument("--profiles", nargs="+", default=["default", "concurrent"])
+    args = parser.parse_args()
+
+    print("{:<12} {:>12} {:>10} {:>10} {:>8}".format("profile", "ops/sec", "p50 ms", "p99 ms", "errors"))
+    for profile in args.profiles:
+        result = run_profile(profile, args)
+        print("{profile:<12} {throughput:>12.1f} {p50_ms:>10.2f} {p99_ms:>10.2f} {errors:>8}".format(**result))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+// Perft suite for the JS chess library
+// Counts the move sequences of every position in perft_suite.json with the root moves split across worker threads,
+// checks the counts against the reference counts of the suite and reports nodes per second.
+// The counts of the standard positions are published counts. The counts of positions marked regression_baseline (the puzzle corpus)
+// are computed by this library, run with --update to fill them in after adding such positions to the suite.
+// They only catch regressions, though the Python engine (a separate implementation) is checked against them by benchmarks/perft.py.
+//
+// Usage (from the tests directory): node perft.js [--depth 3] [--threads <number of CPUs>] [--filter <name>] [--update]
+const fs = require("fs");
+const os = require("os");
+const path = require("path");
+const vm = require("vm");
+const { Worker, isMainThread, parentPort } = require("worker_threads");
+
+const SUITE_PATH = path.join(__dirname, "perft_suite.json");
+const LIBRARY_PATHS = ["utils.js", "chess.js", "board.js"].map(filename => path.join(__dirname, "..", "app", "static", "chess", filename));
+
+function loadLibrary() {
+    for (const filename of LIBRARY_PATHS) {
+        vm.runInThisContext(fs.readFileSync(filename, "utf8"), { filename });
+    }
+}
+
+function createPosition(fen, atomic) {
+    const position = new Position();
+    position.isAtomic = atomic;
+    position.setFromFen(fen);
+    return position;
+}
+
+function legalMoves(position) {
+    return generatePseudoLegalMoves(position).filter(move => position.isLegal(move));
+}
+
+// Worker: counts the move sequences of a position after one root move
+function runWorker() {
+    loadLibrary();
+    parentPort.on("message", ({ id, fen, atomic, move, depth }) => {
+        const position = createPosition(fen, atomic);
+        position.applyMove(moveFromString(move), false, false);
+        parentPort.postMessage({ id, count: perft(position, depth - 1) });
+    });
+}
+
+// Runs tasks on a fixed number of workers, each task is given to the next idle worker
+class WorkerPool {
+    constructor(size) {
+        this._workers = [];
+        this._idle = [];
+        this._queue = [];
+        this._callbacks = new Map();
+        this._nextId = 0;
+        for (let i = 0; i < size; i++) {
+            const worker = new Worker(__filename);
+            worker.on("message", ({ id, count }) => {
+                this._callbacks.get(id)(count);
+                this._callbacks.delete(id);
+                this._release(worker);
+            });
+            this._workers.push(worker);
+            this._idle.push(worker);
+        }
+    }
+
+    run(task) {
+        return new Promise((resolve) => {
+            const id = this._nextId++;
+            this._callbacks.set(id, resolve);
+            this._queue.push({ id, ...task });
+            this._dispatch();
+        });
+    }
+
+    _release(worker) {
+        this._idle.push(worker);
+        this._dispatch();
+    }
+
+    _dispatch() {
+        while (this._idle.length > 0 && this._queue.length > 0) {
+            this._idle.pop().postMessage(this._queue.shift());
+        }
+    }
+
+    terminate() {
+        return Promise.all(this._workers.map(worker => worker.terminate()));
+    }
+}
+
+function parseArgs(argv) {
+    const args = { depth: 3, threads: os.cpus().length, filter: null, update: false };
+    for (let i = 0; i < argv.length; i++) {
+        switch (argv[i]) {
+        case "--depth":
+            args.depth = Number(argv[++i]);
+            break;
+        case "--threads":
+            args.threads = Number(argv[++i]);
+            break;
+        case "--filter":
+            args.filter = argv[++i];
+            break;
+        case "--update":
+            args.update = true;
+            break;
+        default:
+            throw new Error(`Unknown argument: ${argv[i]}`);
+        }
+    }
+    return args;
+}
+
+async function countNodes(pool, entry, depth) {
+    const moves = legalMoves(createPosition(entry.fen, entry.atomic)).map(moveToString);
+    const counts = await Promise.all(moves.map(move => pool.run({ fen: entry.fen, atomic: entry.atomic, move, depth })));
+    return counts.reduce((total, count) => total + count, 0);
+}
+
+async function main() {
+    const args = parseArgs(process.argv.slice(2));
+    loadLibrary();
+    const suite = JSON.parse(fs.readFileSync(SUITE_PATH, "utf8"));
+    // Published counts are never overwritten
+    const entries = suite.positions.filter(entry => (args.filter === null || entry.name.includes(args.filter)) && (!args.update || entry.regression_baseline));
+    const pool = new WorkerPool(args.threads);
+    let totalNodes = 0;
+    let totalSeconds = 0;
+    let failures = 0;
+    for (const entry of entries) {
+        // Updating computes every depth, otherwise only the deepest reference count up to --depth is checked
+        const depths = [];
+        if (args.update) {
+            for (let depth = 1; depth <= args.depth; depth++) {
+                depths.push(depth);
+            }
+        } else if (entry.counts.length > 0) {
+            depths.push(Math.min(args.depth, entry.counts.length));
+        }
+        for (const depth of depths) {
+            const start = process.hrtime.bigint();
+            const nodes = await countNodes(pool, entry, depth);
+            const seconds = Number(process.hrtime.bigint() - start) / 1e9;
+            totalNodes += nodes;
+            totalSeconds += seconds;
+            let status = "";
+            if (args.update) {
+                entry.counts[depth - 1] = nodes;
+            } else if (nodes !== entry.counts[depth - 1]) {
+                status = `FAIL expected ${entry.counts[depth - 1]}`;
+                failures++;
+            } else {
+                status = entry.regression_baseline ? "ok (regression baseline)" : "ok";
+            }
+            console.log(`${entry.name.padEnd(40)} depth ${depth} ${String(nodes).padStart(10)} nodes ${seconds.toFixed(2).padStart(7)}s ${String(Math.round(nodes / seconds)).padStart(9)} nodes/s ${status}`);
+        }
+    }
+    await pool.terminate();
+    console.log(`total ${totalNodes} nodes in ${totalSeconds.toFixed(2)}s (${Math.round(totalNodes / totalSeconds)} nodes/s) with ${args.threads} threads`);
+    if (args.update) {
+        // One position per line
+        fs.writeFileSync(SUITE_PATH, `{\n    "description": ${JSON.stringify(suite.description)},\n    "positions": [\n${suite.positions.map(entry => `        ${JSON.stringify(entry)}`).join(",\n")}\n    ]\n}\n`);
+        console.log(`Updated ${SUITE_PATH}`);
+    }
+    if (failures > 0) {
+        console.log(`${failures} positions have the wrong number of nodes`);
+        process.exitCode = 1;
+    }
+}
+
+if (isMainThread) {
+    main();
+} else {
+    runWorker();
+}
@@ -58,6 +58,7 @@ function validateJSFiles(contextName, filenames, tempFilename, tempFiles) {
 mocha.describe("JS Validation", function() {
     const tempFiles = [];
     validateJSFiles("Chess Library", [
+        "../app/static/ajax.js",
         "../app/static/chess/utils.js",
         "../app/static/chess/chess.js",
         "../app/static/chess/board.js",
@@ -171,6 +172,77 @@ mocha.describe("Chess Position", function() {
         });
     });
 
+    mocha.describe("Legal Moves", function() {
+        const position = new Position();
+
+        it("Pinned piece", function() {
+            position.isAtomic = false;
+            position.setFromFen("4k3/8/8/8/4r3/8/4R3/4K3 w - - 0 1");
+            expect(position.isLegal(createMove(SQUARES.E2, SQUARES.E4))).to.equal(true);
+            expect(position.isLegal(createMove(SQUARES.E2, SQUARES.D2))).to.equal(false);
+        });
+
+        it("Blocking check", function() {
+            position.isAtomic = false;
+            position.setFromFen("4k3/8/8/8/4r3/8/3N4/4K3 w - - 0 1");
+            expect(position.inCheck).to.equal(true);
+            expect(position.isLegal(createMove(SQUARES.D2, SQUARES.E4))).to.equal(true);
+            expect(position.isLegal(createMove(SQUARES.D2, SQUARES.F3))).to.equal(false);
+            expect(position.isLegal(createMove(SQUARES.E1, SQUARES.E2))).to.equal(false);
+        });
+
+        it("En passant revealing an attack", function() {
+            position.isAtomic = false;
+            position.setFromFen("8/8/8/K2pP2r/8/8/8/7k w - d6 0 1");
+            expect(position.isLegal(createMove(SQUARES.E5, SQUARES.D6))).to.equal(false);
+            expect(position.isLegal(createMove(SQUARES.E5, SQUARES.E6))).to.equal(true);
+        });
+
+        it("Explosion revealing an attack", function() {
+            position.setFromFen("4r2k/8/8/8/3n4/2P1B3/8/4K3 w - - 0 1");
+            position.isAtomic = false;
+            expect(position.isLegal(createMove(SQUARES.C3, SQUARES.D4))).to.equal(true);
+            position.isAtomic = true;
+            expect(position.isLegal(createMove(SQUARES.C3, SQUARES.D4))).to.equal(false);
+        });
+    });
+
+    mocha.describe("Packed Moves", function() {
+        const position = new Position();
+
+        it("Unmake restores the position", function() {
+            position.isAtomic = true;
+            position.setFromFen("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq -");
+            const board = Array.from(position.board);
+            // The capture explodes the black king
+            position.makePackedMove(packMove(SQUARES.E5, SQUARES.F7));
+            expect(position.getKingSquare(COLORS.BLACK)).to.equal(SQUARES.INVALID);
+            expect(position.getPieceOnSquare(SQUARES.F7)).to.equal(null);
+            expect(position.getResult()).to.equal(POSITION_STATE.WHITE_WIN);
+            position.unmakePackedMove();
+            expect(Array.from(position.board)).to.deep.equal(board);
+            expect(position.getKingSquare(COLORS.BLACK)).to.equal(SQUARES.E8);
+            expect(position.canCastleKingside(COLORS.BLACK)).to.equal(true);
+            expect(position.colorToMove).to.equal(COLORS.WHITE);
+        });
+
+        it("Same as applyMove", function() {
+            position.isAtomic = false;
+            position.setFromFen("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq -");
+            const move = createMove(SQUARES.E1, SQUARES.G1);
+            position.makePackedMove(packMoveObject(move));
+            const board = Array.from(position.board);
+            position.unmakePackedMove();
+            const undoInfo = position.applyMove(move);
+            expect(Array.from(position.board)).to.deep.equal(board);
+            expect(position.getPieceOnSquare(SQUARES.F1)).to.deep.equal({ piece: PIECES.ROOK, color: COLORS.WHITE });
+            expect(position.canCastleKingside(COLORS.WHITE)).to.equal(false);
+            position.undoMove(move, undoInfo);
+            expect(position.getKingSquare(COLORS.WHITE)).to.equal(SQUARES.E1);
+            expect(position.canCastleKingside(COLORS.WHITE)).to.equal(true);
+        });
+    });
+
     mocha.describe("Classical Move Generation", function() {
         mocha.describe("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", function() {
             this.timeout(120000);
@@ -1,22 +1,52 @@
-from app.cli import clear_database
+from app.cli import clear_database, seed_load_command, init_db, puzzles_cli, RECORD_FORMATS, format_ndjson_record, create_move, create_move_from_string, create_linear_move_tree, create_move_tree_from_string, move_tree_to_string
 import os
+import concurrent.futures
 import unittest
 import datetime
+import time
+import re
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
 
 from werkzeug.security import check_password_hash, generate_password_hash
-from app import app, db
-from app.models import Puzzle, PuzzleCompletion, Test, User
+from app import app, db, check_config
+from app.models import Puzzle, PuzzleCompletion, Test, User, LessonCompletion, StatsCounter, LessonPerformance, STAT_NUM_USERS
 from app.auth import create_user
-from app.api.puzzles_api import get_incomplete_puzzles_for_test, get_unique_puzzle_completions_for_test
+from app.api.puzzles_api import get_incomplete_puzzles_for_test, get_unique_puzzle_completions_for_test, validate_puzzle_record, PUZZLES_PER_TEST
+from app.puzzle_selection import puzzle_index, create_test_plan
+from app.leaderboard import leaderboard
+from app.user_cache import user_cache
+from app.completion_writer import completion_writer
+from app.lessons import LESSONS_BY_ID
+from app.instrumentation import request_metrics
+from app.metrics import get_worker_snapshot
+from app.profiling import get_profile_files, get_hot_functions
+from app.seeding import seed_puzzles, load_puzzle_corpus
+from app.move_trees import encode_move_tree, decode_move_tree
+from app.engine import Position, perft, move_from_string, BLACK, VALID, DRAW, WHITE_WIN, BLACK_WIN
+from benchmarks.perft import load_perft_suite, parallel_perft
+from app.puzzle_verification import verify_puzzle, verify_puzzle_record, verify_puzzles, has_errors, ISSUE_ERROR, ISSUE_WARNING
 
 from flask import g
+from flask_sqlalchemy import sqlalchemy
 
 BASEDIR = os.path.abspath(os.path.dirname(__file__))
 DATABASE_URI = "sqlite:///" + os.path.join(BASEDIR, "test.db")
+PROFILE_DATABASE_PATH = os.path.join(BASEDIR, "profile.db")
+# Atomic position where white explodes the black king with d1d7 (after any black move which doesn't defend it)
+EXPLODE_KING_FEN = "rnbqkbnr/pppp2pp/5p2/4P3/8/8/PPP1PPPP/RNBQKBNR b KQkq -"
 
 def init_database():
     pass
 
+def login(client, user):
+    """ Assigns the user to the session of the test client """
+    with client.session_transaction() as session:
+        session["current_user"] = user.id
+
 class UserModelCase(unittest.TestCase):
     def setUp(self):
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
@@ -202,6 +232,1418 @@ class PuzzleTestCase(unittest.TestCase):
         self.assertEqual(len(get_unique_puzzle_completions_for_test(test.id, g.user.id)), 4)
         self.assertEqual(len(get_incomplete_puzzles_for_test(test.id, g.user.id)), 0)
 
+class PuzzleIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        self.app = app.test_client()
+        db.create_all()
+
+        self.puzzles = []
+        for lesson_id in [1, 1, 2]:
+            puzzle = Puzzle(
+                fen="",
+                move_tree={},
+                is_atomic=True,
+                lesson_id=lesson_id,
+            )
+            db.session.add(puzzle)
+            self.puzzles.append(puzzle)
+        db.session.commit()
+
+    def tearDown(self):
+        clear_database()
+        db.session.remove()
+
+    def test_random_puzzle(self):
+        self.assertEqual(sorted(puzzle_index.get_ids(1)), sorted([self.puzzles[0].id, self.puzzles[1].id]))
+        self.assertEqual(len(puzzle_index.get_ids()), 3)
+        for _ in range(10):
+            self.assertEqual(puzzle_index.random_puzzle(lesson_id=2).id, self.puzzles[2].id)
+        self.assertIsNone(puzzle_index.random_puzzle(lesson_id=3))
+
+    def test_add_puzzle(self):
+        self.assertEqual(len(puzzle_index.get_ids(3)), 0)
+        puzzle = Puzzle(
+            fen="",
+            move_tree={},
+            is_atomic=True,
+            lesson_id=3,
+        )
+        db.session.add(puzzle)
+        db.session.commit()
+        puzzle_index.add_puzzle(puzzle)
+        self.assertEqual(puzzle_index.get_ids(3), [puzzle.id])
+        self.assertEqual(len(puzzle_index.get_ids()), 4)
+        self.assertEqual(puzzle_index.random_puzzle(lesson_id=3).id, puzzle.id)
+
+    def test_deleted_puzzle(self):
+        self.assertEqual(len(puzzle_index.get_ids(2)), 1)
+        # Delete without clearing the index
+        db.session.delete(self.puzzles[2])
+        db.session.commit()
+        self.assertIsNone(puzzle_index.random_puzzle(lesson_id=2))
+
+class PuzzleListTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        self.app = app.test_client()
+        db.create_all()
+
+        self.puzzle_ids = {}
+        for i, lesson_id in enumerate([1, 2, 1, 1, 2, 1, 3]):
+            puzzle = Puzzle(fen=str(i), move_tree=[], is_atomic=True, lesson_id=lesson_id)
+            db.session.add(puzzle)
+            db.session.commit()
+            self.puzzle_ids.setdefault(lesson_id, []).append(puzzle.id)
+        self.all_ids = sorted(puzzle_id for ids in self.puzzle_ids.values() for puzzle_id in ids)
+        login(self.app, create_user("Test", "password1", chess_beginner=True))
+
+    def tearDown(self):
+        clear_database()
+        db.session.remove()
+
+    def get_all_pages(self, query):
+        """ Follows next_after_id from the first page to the last, returns the ids of the puzzles and the number of pages """
+        ids = []
+        num_pages = 0
+        path = "/api/puzzles?" + query
+        while True:
+            data = self.app.get(path).get_json()
+            num_pages += 1
+            ids += [puzzle["id"] for puzzle in data["puzzles"]]
+            if data["next_after_id"] is None:
+                return ids, num_pages
+            path = "/api/puzzles?{}&after_id={}".format(query, data["next_after_id"])
+
+    def test_pages(self):
+        data = self.app.get("/api/puzzles").get_json()
+        self.assertEqual([puzzle["id"] for puzzle in data["puzzles"]], self.all_ids)
+        self.assertIsNone(data["next_after_id"])
+        self.assertEqual(data["puzzles"][0], Puzzle.query.get(self.all_ids[0]).to_json())
+
+        self.assertEqual(self.get_all_pages("limit=2"), (self.all_ids, 4))
+        self.assertEqual(self.get_all_pages("limit=7"), (self.all_ids, 1))
+        self.assertEqual(self.get_all_pages("limit=2&lesson=1"), (self.puzzle_ids[1], 2))
+        self.assertEqual(self.get_all_pages("lesson=x"), ([], 1))
+
+        app.config["PUZZLES_MAX_PAGE_SIZE"] = 3
+        try:
+            self.assertEqual(len(self.app.get("/api/puzzles?limit=100").get_json()["puzzles"]), 3)
+        finally:
+            app.config["PUZZLES_MAX_PAGE_SIZE"] = 1000
+
+        for limit in ["0", "-1", "x"]:
+            self.assertEqual(self.app.get("/api/puzzles?limit=" + limit).status_code, 400)
+
+    def test_ndjson(self):
+        app.config["PUZZLES_STREAM_BATCH_SIZE"] = 2
+        try:
+            response = self.app.get("/api/puzzles?format=ndjson")
+            self.assertEqual(response.mimetype, "application/x-ndjson")
+            self.assertTrue(response.is_streamed)
+            puzzles = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+            self.assertEqual([puzzle["id"] for puzzle in puzzles], self.all_ids)
+            self.assertEqual(puzzles[-1], Puzzle.query.get(self.all_ids[-1]).to_json())
+
+            response = self.app.get("/api/puzzles?format=ndjson&lesson=1&after_id={}&limit=2".format(self.puzzle_ids[1][0]))
+            self.assertEqual([json.loads(line)["id"] for line in response.get_data(as_text=True).splitlines()], self.puzzle_ids[1][1:3])
+        finally:
+            app.config["PUZZLES_STREAM_BATCH_SIZE"] = 500
+
+class TestPlanTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        self.app = app.test_client()
+        db.create_all()
+
+        self.user = User(
+            username="Test",
+            pwd_hash=generate_password_hash("password"),
+            chess_beginner=True,
+        )
+        db.session.add(self.user)
+        for lesson_id in [1, 1, 2, 3]:
+            db.session.add(Puzzle(
+                fen="",
+                move_tree={},
+                is_atomic=True,
+                lesson_id=lesson_id,
+            ))
+        db.session.commit()
+        login(self.app, self.user)
+
+    def tearDown(self):
+        clear_database()
+        db.session.remove()
+
+    def complete_puzzle(self, puzzle_id, test_id):
+        return self.app.post("/api/puzzles/{}".format(puzzle_id), json={
+            "attempts": 1,
+            "start_time": 0,
+            "end_time": 1000,
+            "test_id": test_id,
+        })
+
+    def test_plan(self):
+        self.assertEqual(self.app.get("/puzzle").status_code, 200)
+        test = Test.query.filter_by(user=self.user.id).first()
+        self.assertEqual(len(test.puzzle_plan), 4)
+        self.assertEqual(len(set(test.puzzle_plan)), 4)
+        self.assertEqual(self.app.post("/api/tests/{}".format(test.id)).status_code, 403)
+
+        for i, puzzle_id in enumerate(test.puzzle_plan):
+            data = self.app.get("/api/puzzles/test/{}".format(test.id)).get_json()
+            self.assertEqual(data["puzzle"]["id"], puzzle_id)
+            self.assertEqual(data["is_final"], i == 3)
+            self.assertEqual(self.complete_puzzle(puzzle_id, test.id).status_code, 200)
+            # Completing the same puzzle again doesn't advance the test
+            self.assertEqual(self.complete_puzzle(puzzle_id, test.id).status_code, 200)
+
+        data = self.app.get("/api/puzzles/test/{}".format(test.id)).get_json()
+        self.assertIsNone(data["puzzle"])
+        self.assertEqual(self.app.post("/api/tests/{}".format(test.id)).status_code, 200)
+        self.assertIsNotNone(Test.query.get(test.id).end_time)
+
+    def test_deleted_puzzles(self):
+        # The index is loaded before a puzzle is deleted, plans don't include it
+        puzzle_index.clear()
+        self.assertEqual(len(create_test_plan(4)), 4)
+        deleted_id = Puzzle.query.first().id
+        Puzzle.query.filter_by(id=deleted_id).delete()
+        db.session.commit()
+        plan = create_test_plan(4)
+        self.assertEqual(len(plan), 3)
+        self.assertNotIn(deleted_id, plan)
+
+        # A puzzle deleted after the plan was made is replaced when it is served
+        test = Test(user=self.user.id, start_time=datetime.datetime.now(), puzzle_plan=[deleted_id] + plan[:2], completed_puzzles=0)
+        db.session.add(test)
+        db.session.commit()
+        data = self.app.get("/api/puzzles/test/{}".format(test.id)).get_json()
+        self.assertEqual(data["puzzle"]["id"], plan[2])
+        self.assertEqual(Test.query.get(test.id).puzzle_plan, plan[2:] + plan[:2])
+
+        # Without another puzzle to replace it with, the puzzle is dropped from the plan
+        test = Test(user=self.user.id, start_time=datetime.datetime.now(), puzzle_plan=plan + [deleted_id], completed_puzzles=3)
+        db.session.add(test)
+        db.session.commit()
+        data = self.app.get("/api/puzzles/test/{}".format(test.id)).get_json()
+        self.assertIsNone(data["puzzle"])
+        test = Test.query.get(test.id)
+        self.assertEqual(test.puzzle_plan, plan)
+        self.assertTrue(test.is_complete())
+
+    def test_legacy_test(self):
+        test = Test(
+            user=self.user.id,
+            start_time=datetime.datetime.now(),
+        )
+        db.session.add(test)
+        db.session.commit()
+        completed_id = Puzzle.query.first().id
+        self.complete_puzzle(completed_id, test.id)
+
+        data = self.app.get("/api/puzzles/test/{}".format(test.id)).get_json()
+        test = Test.query.get(test.id)
+        self.assertEqual(test.puzzle_plan[0], completed_id)
+        self.assertEqual(test.completed_puzzles, 1)
+        self.assertNotEqual(data["puzzle"]["id"], completed_id)
+
+    def test_legacy_test_over_plan_size(self):
+        for _ in range(PUZZLES_PER_TEST):
+            db.session.add(Puzzle(fen="", move_tree={}, is_atomic=True, lesson_id=1))
+        test = Test(user=self.user.id, start_time=datetime.datetime.now())
+        db.session.add(test)
+        db.session.commit()
+        puzzle_ids = [puzzle.id for puzzle in Puzzle.query.all()]
+        for puzzle_id in puzzle_ids:
+            self.complete_puzzle(puzzle_id, test.id)
+
+        # Only the first PUZZLES_PER_TEST completed puzzles are kept and the test can be finished
+        response = self.app.get("/api/puzzles/test/{}".format(test.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.get_json()["puzzle"])
+        test = Test.query.get(test.id)
+        self.assertEqual(len(test.puzzle_plan), PUZZLES_PER_TEST)
+        self.assertEqual(test.completed_puzzles, PUZZLES_PER_TEST)
+        self.assertEqual(self.app.post("/api/tests/{}".format(test.id)).status_code, 200)
+
+class GlobalStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        clear_database()
+        db.session.remove()
+
+    def test_user_counters(self):
+        self.assertEqual(User.get_num_users(), 0)
+        self.assertEqual(User.get_percentage_chess_beginners(), 0)
+        create_user("User1", "password1", chess_beginner=True)
+        create_user("User2", "password1", chess_beginner=False)
+        create_user("User3", "password1", chess_beginner=False)
+        create_user("User4", "password1", chess_beginner=True)
+        self.assertEqual(User.get_num_users(), 4)
+        self.assertEqual(User.get_percentage_chess_beginners(), 50)
+        # Counters are rolled back with a failed insert
+        self.assertRaises(Exception, create_user, "User1", "password1", True)
+        db.session.rollback()
+        self.assertEqual(StatsCounter.get(STAT_NUM_USERS), 4)
+        self.assertEqual(User.get_percentage_chess_beginners(), 50)
+
+    def test_best_times(self):
+        users = [create_user("User{}".format(i), "password1", chess_beginner=False) for i in range(12)]
+        for i, user in enumerate(users):
+            User.record_test_time(user.id, 100 - i)
+        User.record_test_time(users[0].id, 120)
+        User.record_test_time(users[1].id, 20.5)
+        db.session.commit()
+        self.assertEqual(User.query.get(users[0].id).best_test_time, 100)
+        self.assertEqual(User.query.get(users[1].id).best_test_time, 20.5)
+
+class LeaderboardTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        self.app = app.test_client()
+        db.create_all()
+
+        self.users = []
+        for i in range(12):
+            user = User(
+                username="User{}".format(i),
+                pwd_hash=generate_password_hash("password"),
+                chess_beginner=False,
+                best_test_time=100 - i if i < 11 else None,
+            )
+            db.session.add(user)
+            self.users.append(user)
+        db.session.commit()
+
+    def tearDown(self):
+        clear_database()
+        db.session.remove()
+
+    def test_best_times(self):
+        best_times = leaderboard.get_best_times()
+        self.assertEqual(len(best_times), 10)
+        self.assertEqual(best_times[0], (self.users[10], 90))
+        self.assertNotIn(self.users[0], [user for user, time in best_times])
+
+        # Slower times are ignored
+        leaderboard.record(self.users[10].id, 95)
+        leaderboard.record(self.users[0].id, 20.5)
+        leaderboard.record(self.users[11].id, 100)
+        best_times = leaderboard.get_best_times()
+        self.assertEqual(best_times[0], (self.users[0], 20.5))
+        self.assertEqual(best_times[1], (self.users[10], 90))
+        self.assertEqual(best_times[-1], (self.users[2], 98))
+
+    def test_placement(self):
+        self.assertEqual(leaderboard.get_placement(self.users[10].id), (1, 11, 10))
+        self.assertEqual(leaderboard.get_placement(self.users[0].id), (11, 11, 100))
+        self.assertIsNone(leaderboard.get_placement(self.users[11].id))
+        leaderboard.record(self.users[11].id, 95)
+        self.assertEqual(leaderboard.get_placement(self.users[11].id), (6, 12, 50))
+        # Users with the same time share a rank
+        self.assertEqual(leaderboard.get_placement(self.users[5].id), (6, 12, 50))
+        self.assertEqual(leaderboard.get_placement(self.users[4].id), (8, 12, 67))
+
+class PerformanceTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        self.app = app.test_client()
+        db.create_all()
+
+        self.user = User(
+            username="Test",
+            pwd_hash=generate_password_hash("password"),
+            chess_beginner=True,
+        )
+        db.session.add(self.user)
+        self.puzzles = []
+        for lesson_id in [1, 1, 2]:
+            puzzle = Puzzle(
+                fen="",
+                move_tree={},
+                is_atomic=True,
+                lesson_id=lesson_id,
+            )
+            db.session.add(puzzle)
+            self.puzzles.append(puzzle)
+        db.session.flush()
+        self.test = Test(
+            user=self.user.id,
+            start_time=datetime.datetime.now(),
+        )
+        db.session.add(self.test)
+        db.session.commit()
+        login(self.app, self.user)
+
+    def tearDown(self):
+        app.config["USE_PERFORMANCE_SUMMARY"] = True
+        clear_database()
+        db.session.remove()
+
+    def complete_puzzle(self, puzzle, attempts, seconds):
+        return self.app.post("/api/puzzles/{}".format(puzzle.id), json={
+            "attempts": attempts,
+            "start_time": 1000000,
+            "end_time": 1000000 + seconds * 1000,
+            "test_id": self.test.id,
+        })
+
+    def test_performance(self):
+        self.complete_puzzle(self.puzzles[0], 1, 10)
+        self.complete_puzzle(self.puzzles[1], 2, 5)
+        self.complete_puzzle(self.puzzles[1], 4, 3)
+        self.complete_puzzle(self.puzzles[2], 1, 2.5)
+        expected = ([0, 6.0, 2.5, 0, 0, 0], { 1: 3, 2: 1 }, 4, [0, 58.3, 100.0, 0, 0, 0])
+
+        user = User.query.get(self.user.id)
+        app.config["USE_PERFORMANCE_SUMMARY"] = True
+        self.assertEqual(user.get_performance(), expected)
+        app.config["USE_PERFORMANCE_SUMMARY"] = False
+        self.assertEqual(user.get_performance(), expected)
+
+        # Rebuilding the totals from the completions gives the same results
+        LessonPerformance.rebuild()
+        db.session.commit()
+        app.config["USE_PERFORMANCE_SUMMARY"] = True
+        self.assertEqual(user.get_performance(), expected)
+
+    def test_invalid_attempts(self):
+        self.assertEqual(self.complete_puzzle(self.puzzles[0], 0, 10).status_code, 400)
+        self.assertEqual(self.complete_puzzle(self.puzzles[0], "1", 10).status_code, 400)
+        self.assertEqual(PuzzleCompletion.query.count(), 0)
+        self.assertIsNone(LessonPerformance.query.get((self.user.id, 1)))
+
+class WriteBehindTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.config["COMPLETION_WRITE_BEHIND"] = True
+        app.config["COMPLETION_FLUSH_INTERVAL"] = 60
+        self.app = app.test_client()
+        db.create_all()
+
+        self.user = create_user("Test", "password1", chess_beginner=True)
+        self.puzzles = []
+        for i in range(3):
+            puzzle = Puzzle(fen="", move_tree={}, is_atomic=True, lesson_id=1)
+            db.session.add(puzzle)
+            self.puzzles.append(puzzle)
+        db.session.flush()
+        self.test = Test(
+            user=self.user.id,
+            start_time=datetime.datetime.now(),
+            puzzle_plan=[puzzle.id for puzzle in self.puzzles],
+            completed_puzzles=0,
+        )
+        db.session.add(self.test)
+        db.session.commit()
+        login(self.app, self.user)
+        # Sessions are removed while waiting for the writer so keep the ids rather than the instances
+        self.user_id, self.test_id = self.user.id, self.test.id
+        self.puzzle_ids = [puzzle.id for puzzle in self.puzzles]
+
+    def tearDown(self):
+        app.config["COMPLETION_WRITE_BEHIND"] = False
+        app.config["COMPLETION_FLUSH_INTERVAL"] = 1.0
+        app.config["COMPLETION_BATCH_SIZE"] = 100
+        clear_database()
+        db.session.remove()
+
+    def complete_puzzle(self, puzzle_id):
+        response = self.app.post("/api/puzzles/{}".format(puzzle_id), json={
+            "attempts": 1,
+            "start_time": 1000000,
+            "end_time": 1005000,
+            "test_id": self.test_id,
+        })
+        self.assertEqual(response.status_code, 200)
+
+    def count_completions(self):
+        count = PuzzleCompletion.query.count()
+        db.session.remove()
+        return count
+
+    def test_read_your_writes(self):
+        self.complete_puzzle(self.puzzle_ids[0])
+        self.complete_puzzle(self.puzzle_ids[1])
+        self.assertEqual(self.count_completions(), 0)
+        self.assertTrue(completion_writer.has_unsaved(self.user_id))
+
+        # Serving the next puzzle saves the queued completions first
+        response = self.app.get("/api/puzzles/test/{}".format(self.test_id))
+        self.assertEqual(response.get_json()["puzzle"]["id"], self.puzzle_ids[2])
+        self.assertEqual(self.count_completions(), 2)
+        self.assertFalse(completion_writer.has_unsaved(self.user_id))
+        self.assertEqual(LessonPerformance.query.get((self.user_id, 1)).num_puzzles, 2)
+
+        self.complete_puzzle(self.puzzle_ids[2])
+        self.assertEqual(self.app.post("/api/tests/{}".format(self.test_id), json={}).status_code, 200)
+        self.assertEqual(self.count_completions(), 3)
+
+    def test_invalid_completions(self):
+        for start_time, end_time in [("1000000", 1005000), (1000000, None), (1005000, 1000000), (True, 1005000), (1000000, 1e30)]:
+            response = self.app.post("/api/puzzles/{}".format(self.puzzle_ids[0]), json={
+                "attempts": 1,
+                "start_time": start_time,
+                "end_time": end_time,
+                "test_id": self.test_id,
+            })
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(completion_writer.has_unsaved(self.user_id))
+
+    def test_bad_row_in_batch(self):
+        other_user_id = create_user("Test2", "password1", chess_beginner=True).id
+        # A completion which fails to save (queued without going through the API validation) alongside a valid one
+        completion_writer.add({
+            "user": other_user_id,
+            "puzzle_id": self.puzzle_ids[0],
+            "lesson_id": 1,
+            "attempts": 0,
+            "start_time": datetime.datetime.now(),
+            "end_time": datetime.datetime.now(),
+            "test_number": None,
+        })
+        self.complete_puzzle(self.puzzle_ids[0])
+        # Only the bad completion is dropped and the request which flushes the batch doesn't fail
+        with self.assertLogs("app.completion_writer", level="ERROR"):
+            response = self.app.get("/api/puzzles/test/{}".format(self.test_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["puzzle"]["id"], self.puzzle_ids[1])
+        self.assertEqual(self.count_completions(), 1)
+        self.assertFalse(completion_writer.has_unsaved(other_user_id))
+
+    def test_batch_size(self):
+        app.config["COMPLETION_BATCH_SIZE"] = 2
+        self.complete_puzzle(self.puzzle_ids[0])
+        self.complete_puzzle(self.puzzle_ids[1])
+        # The background thread saves the batch
+        for _ in range(50):
+            if self.count_completions() == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.count_completions(), 2)
+        self.assertEqual(Test.query.get(self.test_id).completed_puzzles, 2)
+
+    def test_single_worker(self):
+        # Other workers can't save this worker's queue before serving the user's test
+        with self.assertRaises(ValueError):
+            check_config({ "COMPLETION_WRITE_BEHIND": True, "WORKER_PROCESSES": 2 })
+        check_config({ "COMPLETION_WRITE_BEHIND": True, "WORKER_PROCESSES": 1 })
+        check_config({ "COMPLETION_WRITE_BEHIND": False, "WORKER_PROCESSES": 2 })
+
+class BatchCompletionTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        self.app = app.test_client()
+        db.create_all()
+
+        self.user = create_user("Test", "password1", chess_beginner=True)
+        self.puzzles = []
+        for lesson_id in [1, 1, 2]:
+            puzzle = Puzzle(fen="", move_tree={}, is_atomic=True, lesson_id=lesson_id)
+            db.session.add(puzzle)
+            self.puzzles.append(puzzle)
+        db.session.flush()
+        self.test = Test(
+            user=self.user.id,
+            start_time=datetime.datetime.now(),
+            puzzle_plan=[puzzle.id for puzzle in self.puzzles],
+            completed_puzzles=0,
+        )
+        db.session.add(self.test)
+        db.session.commit()
+        login(self.app, self.user)
+
+    def tearDown(self):
+        clear_database()
+        db.session.remove()
+
+    def create_completion(self, puzzle_id, attempts=1):
+        return { "puzzle_id": puzzle_id, "attempts": attempts, "start_time": 1000000, "end_time": 1004000 }
+
+    def test_batch(self):
+        # Puzzles can be served ahead of the saved completions
+        response = self.app.get("/api/puzzles/test/{}?position=1".format(self.test.id)).get_json()
+        self.assertEqual((response["puzzle"]["id"], response["position"], response["is_final"]), (self.puzzles[1].id, 1, False))
+        self.assertTrue(self.app.get("/api/puzzles/test/{}?position=2".format(self.test.id)).get_json()["is_final"])
+        self.assertIsNone(self.app.get("/api/puzzles/test/{}?position=3".format(self.test.id)).get_json()["puzzle"])
+
+        response = self.app.post("/api/tests/{}/completions".format(self.test.id), json={ "completions": [
+            self.create_completion(self.puzzles[0].id),
+            self.create_completion(self.puzzles[1].id, attempts=2),
+            { "puzzle_id": self.puzzles[2].id },
+            self.create_completion(self.puzzles[2].id, attempts=0),
+            self.create_completion(self.puzzles[2].id + 1),
+            dict(self.create_completion(self.puzzles[2].id), start_time="1000000"),
+            dict(self.create_completion(self.puzzles[2].id), end_time=999000),
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result["status"] for result in response.get_json()["results"]],
+            ["Ok", "Ok", "Invalid data", "Invalid data", "Puzzle not found", "Invalid data", "Invalid data"])
+        self.assertEqual(PuzzleCompletion.query.filter_by(test_number=self.test.id).count(), 2)
+        self.assertEqual(Test.query.get(self.test.id).completed_puzzles, 2)
+        self.assertEqual(LessonPerformance.query.get((self.user.id, 1)).num_puzzles, 2)
+        self.assertEqual(self.app.post("/api/tests/{}".format(self.test.id), json={}).status_code, 403)
+
+        self.app.post("/api/tests/{}/completions".format(self.test.id), json={ "completions": [self.create_completion(self.puzzles[2].id)] })
+        self.assertEqual(self.app.post("/api/tests/{}".format(self.test.id), json={}).status_code, 200)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.app.post("/api/tests/{}/completions".format(self.test.id), json=[]).status_code, 400)
+        self.assertEqual(self.app.post("/api/tests/{}/completions".format(self.test.id + 1), json={ "completions": [] }).status_code, 404)
+        other_user = create_user("Test2", "password1", chess_beginner=True)
+        login(self.app, other_user)
+        self.assertEqual(self.app.post("/api/tests/{}/completions".format(self.test.id), json={ "completions": [] }).status_code, 401)
+
+class DatabaseProfileTestCase(unittest.TestCase):
+    def tearDown(self):
+        app.config["DATABASE_PROFILE"] = "default"
+        app.config["SQLITE_PRAGMAS"] = {}
+        app.config["DATABASE_POOL_SIZE"] = None
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(PROFILE_DATABASE_PATH + suffix):
+                os.remove(PROFILE_DATABASE_PATH + suffix)
+
+    def create_engine(self, uri):
+        sa_url, options = db.apply_driver_hacks(app, sqlalchemy.engine.url.make_url(uri), {})
+        return db.create_engine(sa_url, options), options
+
+    def test_concurrent_profile(self):
+        app.config["DATABASE_PROFILE"] = "concurrent"
+        app.config["SQLITE_PRAGMAS"] = { "busy_timeout": 2000 }
+        engine, options = self.create_engine("sqlite:///" + PROFILE_DATABASE_PATH)
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute("PRAGMA journal_mode").scalar(), "wal")
+            self.assertEqual(connection.execute("PRAGMA busy_timeout").scalar(), 2000)
+            self.assertEqual(connection.execute("PRAGMA synchronous").scalar(), 1)
+            self.assertEqual(connection.execute("PRAGMA cache_size").scalar(), -16000)
+        engine.dispose()
+
+    def test_default_profile(self):
+        engine, options = self.create_engine("sqlite:///" + PROFILE_DATABASE_PATH)
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute("PRAGMA journal_mode").scalar(), "delete")
+        engine.dispose()
+
+        app.config["SQLITE_PRAGMAS"] = { "journal_mode": "WAL; DROP TABLE user" }
+        with self.assertRaises(ValueError):
+            self.create_engine("sqlite:///" + PROFILE_DATABASE_PATH)
+
+    def test_pool_options(self):
+        app.config["DATABASE_POOL_SIZE"] = 20
+        sa_url, options = db.apply_driver_hacks(app, sqlalchemy.engine.url.make_url("postgresql://user@localhost/atomic"), {})
+        self.assertEqual(options["pool_size"], 20)
+        self.assertNotIn("max_overflow", options)
+        self.assertNotIn("sqlite_pragmas", options)
+
+class QueryPlanTestCase(unittest.TestCase):
+    """ Runs EXPLAIN QUERY PLAN on every query made by the page and API routes and fails on full table scans """
+    # (url, table) pairs where reading the entire table is intended
+    ALLOWED_SCANS = {
+        # The puzzle ids are cached by the puzzle index
+        ("/puzzle", "puzzle"),
+        ("/api/puzzles/random", "puzzle"),
+    }
+
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        self.app = app.test_client()
+        db.create_all()
+
+        self.user = create_user("Test", "password1", chess_beginner=True)
+        self.admin = create_user("Admin", "password1", chess_beginner=False, admin=True)
+        for lesson_id in [1, 1, 2, 2, 3]:
+            db.session.add(Puzzle(fen="", move_tree={}, is_atomic=True, lesson_id=lesson_id))
+        db.session.add(LessonCompletion(user=self.user.id, lesson_id=1, progression=0, completed_lesson=True))
+        db.session.commit()
+        self.user_id, self.admin_id = self.user.id, self.admin.id
+        puzzle_index.clear()
+        leaderboard.clear()
+        user_cache.clear()
+
+    def tearDown(self):
+        app.config["USE_PERFORMANCE_SUMMARY"] = True
+        clear_database()
+        db.session.remove()
+
+    def request(self, method, url, **kwargs):
+        """ Makes a request and returns the response along with the (table, plan) of every full table scan it caused """
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if not executemany and statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                statements.append((statement, parameters))
+        sqlalchemy.event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            response = self.app.open(url, method=method, **kwargs)
+        finally:
+            sqlalchemy.event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+        self.assertLess(response.status_code, 400, url)
+
+        scans = []
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for statement, parameters in statements:
+                for row in cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters):
+                    match = re.match(r"SCAN (?:TABLE )?(\w+)(.*)", row[-1])
+                    # Scanning an index (e.g. a covering index) is fine, scanning the table isn't
+                    if match and "INDEX" not in match.group(2):
+                        scans.append((match.group(1), statement))
+        finally:
+            connection.close()
+        return response, scans
+
+    def assertNoScans(self, method, url, **kwargs):
+        response, scans = self.request(method, url, **kwargs)
+        path = url.split("?")[0]
+        scans = [(table, statement) for table, statement in scans if (path, table) not in self.ALLOWED_SCANS]
+        self.assertEqual(scans, [], url)
+        return response
+
+    def test_routes(self):
+        login(self.app, self.user)
+        for url in ["/", "/learn", "/settings", "/lessons/{}".format(LESSONS_BY_ID[1].name), "/puzzle?lesson=1"]:
+            self.assertNoScans("GET", url)
+        self.assertNoScans("GET", "/puzzle")
+        test = Test.query.filter_by(user=self.user_id).one()
+        puzzle_ids = list(test.puzzle_plan)
+        test_id = test.id
+        db.session.remove()
+
+        self.assertNoScans("GET", "/api/lessons/1")
+        self.assertNoScans("PUT", "/api/lessons/1", json={ "progression": 1 })
+        self.assertNoScans("GET", "/api/lessons/2")
+        self.assertNoScans("PUT", "/api/lessons/2", json={ "progression": 1 })
+        self.assertNoScans("GET", "/api/puzzles/random")
+        self.assertNoScans("GET", "/api/puzzles/random?lesson=2")
+        self.assertNoScans("GET", "/api/puzzles?lesson=2")
+        self.assertNoScans("GET", "/api/puzzles")
+        self.assertNoScans("GET", "/api/puzzles?after_id={}&limit=2".format(puzzle_ids[0]))
+        self.assertNoScans("GET", "/api/puzzles?lesson=2&after_id={}&limit=2".format(puzzle_ids[0]))
+        self.assertNoScans("GET", "/api/puzzles?format=ndjson&after_id={}".format(puzzle_ids[0]))
+        self.assertNoScans("GET", "/api/settings")
+        self.assertNoScans("POST", "/api/settings", json={ "animation_time_ms": 100 })
+
+        completion = { "attempts": 1, "start_time": 1000000, "end_time": 1004000, "test_id": test_id }
+        self.assertNoScans("GET", "/api/puzzles/test/{}".format(test_id))
+        self.assertNoScans("POST", "/api/puzzles/{}".format(puzzle_ids[0]), json=completion)
+        self.assertNoScans("GET", "/api/puzzles/test/{}?position=2".format(test_id))
+        self.assertNoScans("POST", "/api/tests/{}/completions".format(test_id), json={ "completions": [
+            { "puzzle_id": puzzle_id, "attempts": 2, "start_time": 1000000, "end_time": 1002000 } for puzzle_id in puzzle_ids[1:]
+        ]})
+        self.assertNoScans("POST", "/api/tests/{}".format(test_id), json={})
+        self.assertNoScans("GET", "/api/stats/{}".format(test_id))
+        self.assertNoScans("GET", "/stats")
+        app.config["USE_PERFORMANCE_SUMMARY"] = False
+        self.assertNoScans("GET", "/stats")
+        self.assertNoScans("GET", "/learn")
+
+        login(self.app, User.query.get(self.admin_id))
+        self.assertNoScans("GET", "/create_puzzle")
+        self.assertNoScans("POST", "/api/puzzles", json=load_puzzle_corpus()[1][0])
+        self.assertNoScans("GET", "/api/admin/metrics")
+        self.assertNoScans("GET", "/profiles")
+
+    def test_detects_scans(self):
+        # Ensure that the check would catch a query which can't use an index
+        connection = db.engine.raw_connection()
+        try:
+            plan = [row[-1] for row in connection.cursor().execute("EXPLAIN QUERY PLAN SELECT * FROM puzzle_completion WHERE attempts = 1")]
+        finally:
+            connection.close()
+        self.assertTrue(any(re.match(r"SCAN (?:TABLE )?puzzle_completion$", detail) for detail in plan))
+
+class InstrumentationTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        self.app = app.test_client()
+        db.create_all()
+
+        self.user = create_user("Test", "password1", chess_beginner=True)
+        login(self.app, self.user)
+        user_cache.clear()
+        request_metrics.clear()
+        # Start with an empty identity map so the user is queried
+        db.session.remove()
+
+    def tearDown(self):
+        app.config["SLOW_REQUEST_BUDGET_MS"] = 500
+        app.config["SQL_INSTRUMENTATION"] = True
+        clear_database()
+        db.session.remove()
+
+    def test_server_timing(self):
+        response = self.app.get("/api/settings")
+        timings = response.headers.getlist("Server-Timing")
+        self.assertEqual(len(timings), 2)
+        self.assertTrue(re.match(r'db;dur=[0-9.]+;desc="1 queries"', timings[0]))
+        self.assertTrue(timings[1].startswith("app;dur="))
+
+        # The user is now cached
+        self.app.get("/api/settings")
+        stats = request_metrics.snapshot()["get_settings"]
+        self.assertEqual(stats["count"], 2)
+        self.assertEqual(stats["query_count"], 1)
+        self.assertEqual(stats["max_query_count"], 1)
+        self.assertEqual(sum(stats["buckets"]), 2)
+        self.assertIn("FROM user", stats["slowest_queries"][0][1])
+
+        app.config["SQL_INSTRUMENTATION"] = False
+        self.assertNotIn("Server-Timing", self.app.get("/api/settings").headers)
+        self.assertEqual(request_metrics.snapshot()["get_settings"]["count"], 2)
+
+    def test_slow_request_log(self):
+        app.config["SLOW_REQUEST_BUDGET_MS"] = -1
+        with self.assertLogs("app.instrumentation", level="WARNING") as logs:
+            self.app.get("/api/lessons/1")
+        self.assertIn("lesson_api", logs.output[0])
+        self.assertIn("FROM lesson_completion", logs.output[0])
+
+    def test_failed_queries(self):
+        connection = db.session.connection()
+        for _ in range(3):
+            with self.assertRaises(sqlalchemy.exc.OperationalError):
+                connection.execute("SELECT * FROM missing_table")
+        self.assertEqual(connection.info.get("query_start_times"), [])
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.config["METRICS_DIRECTORY"] = tempfile.mkdtemp()
+        self.app = app.test_client()
+        db.create_all()
+
+        self.user = create_user("Test", "password1", chess_beginner=True)
+        self.admin = create_user("Admin", "password1", chess_beginner=False, admin=True)
+        db.session.add(Test(user=self.user.id, start_time=datetime.datetime.now()))
+        db.session.add(Test(user=self.user.id, start_time=datetime.datetime.now() - datetime.timedelta(days=1)))
+        db.session.commit()
+        request_metrics.clear()
+
+    def tearDown(self):
+        shutil.rmtree(app.config["METRICS_DIRECTORY"])
+        app.config["METRICS_DIRECTORY"] = None
+        clear_database()
+        db.session.remove()
+
+    def get_metrics(self):
+        login(self.app, self.admin)
+        response = self.app.get("/api/admin/metrics")
+        self.assertEqual(response.status_code, 200)
+        return response.get_data(as_text=True).splitlines()
+
+    def test_metrics(self):
+        login(self.app, self.user)
+        self.assertEqual(self.app.get("/api/admin/metrics").status_code, 403)
+        for _ in range(3):
+            self.app.get("/api/settings")
+        lines = self.get_metrics()
+        self.assertIn('atomic_http_requests_total{endpoint="get_settings"} 3', lines)
+        self.assertIn('atomic_http_request_duration_seconds_bucket{endpoint="get_settings",le="+Inf"} 3', lines)
+        self.assertIn('atomic_http_request_duration_seconds_count{endpoint="get_settings"} 3', lines)
+        self.assertIn("atomic_active_tests 1", lines)
+        self.assertIn("atomic_metrics_workers 1", lines)
+        self.assertIn("# TYPE atomic_http_request_duration_seconds histogram", lines)
+
+    def test_merge_workers(self):
+        login(self.app, self.user)
+        self.app.get("/api/settings")
+        # A running worker (the parent process) and one that has exited
+        other_worker = get_worker_snapshot()
+        other_worker["pid"] = os.getppid()
+        other_worker["user_cache"] = { "hits": 3, "misses": 1 }
+        exited_worker = dict(other_worker, pid=2 ** 22 + 1)
+        for snapshot in [other_worker, exited_worker]:
+            with open(os.path.join(app.config["METRICS_DIRECTORY"], "worker-{}.json".format(snapshot["pid"])), "w") as file:
+                json.dump(snapshot, file)
+
+        lines = self.get_metrics()
+        # The totals of the exited worker are kept in the archive
+        self.assertIn('atomic_http_requests_total{endpoint="get_settings"} 3', lines)
+        self.assertIn("atomic_metrics_workers 2", lines)
+        self.assertIn("atomic_user_cache_hits_total {}".format(user_cache.hits + 6), lines)
+        self.assertFalse(os.path.exists(os.path.join(app.config["METRICS_DIRECTORY"], "worker-{}.json".format(exited_worker["pid"]))))
+
+    def test_exited_worker_totals(self):
+        login(self.app, self.user)
+        self.app.get("/api/settings")
+        worker = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+        try:
+            snapshot = get_worker_snapshot()
+            snapshot["pid"] = worker.pid
+            with open(os.path.join(app.config["METRICS_DIRECTORY"], "worker-{}.json".format(worker.pid)), "w") as file:
+                json.dump(snapshot, file)
+            lines = self.get_metrics()
+            self.assertIn('atomic_http_requests_total{endpoint="get_settings"} 2', lines)
+            self.assertIn("atomic_metrics_workers 2", lines)
+        finally:
+            worker.kill()
+            worker.wait()
+
+        # The worker has exited, its totals are still counted but it is no longer a worker
+        for _ in range(2):
+            lines = self.get_metrics()
+            self.assertIn('atomic_http_requests_total{endpoint="get_settings"} 2', lines)
+            self.assertIn("atomic_metrics_workers 1", lines)
+        self.assertFalse(os.path.exists(os.path.join(app.config["METRICS_DIRECTORY"], "worker-{}.json".format(worker.pid))))
+
+class ProfilingTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.config["PROFILE_DIRECTORY"] = tempfile.mkdtemp()
+        self.app = app.test_client()
+        db.create_all()
+
+        self.user = create_user("Test", "password1", chess_beginner=True)
+        self.admin = create_user("Admin", "password1", chess_beginner=False, admin=True)
+
+    def tearDown(self):
+        shutil.rmtree(app.config["PROFILE_DIRECTORY"])
+        app.config["PROFILE_DIRECTORY"] = None
+        app.config["PROFILE_SAMPLE_RATE"] = 0.0
+        app.config["PROFILES_KEPT"] = 50
+        clear_database()
+        db.session.remove()
+
+    def test_profile_header(self):
+        login(self.app, self.user)
+        self.app.get("/api/settings", headers={ "X-Profile": "1" })
+        self.assertEqual(get_profile_files(), [])
+
+        login(self.app, self.admin)
+        self.app.get("/api/settings")
+        self.assertEqual(get_profile_files(), [])
+        self.app.get("/api/settings", headers={ "X-Profile": "1" })
+        self.assertEqual(len(get_profile_files()), 1)
+        self.assertIn("get_settings", get_profile_files()[0])
+
+        response = self.app.get("/profiles")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"get_settings", response.data)
+
+        login(self.app, self.user)
+        self.assertEqual(self.app.get("/profiles").status_code, 302)
+
+    def test_sampling_rotation(self):
+        app.config["PROFILE_SAMPLE_RATE"] = 1.0
+        app.config["PROFILES_KEPT"] = 3
+        login(self.app, self.user)
+        for _ in range(5):
+            self.app.get("/api/settings")
+        self.assertEqual(len(get_profile_files()), 3)
+        num_profiles, hot_functions = get_hot_functions(limit=5, sort_by="cumtime")
+        self.assertEqual(num_profiles, 3)
+        self.assertEqual(len(hot_functions), 5)
+        self.assertGreaterEqual(hot_functions[0]["cumtime"], hot_functions[-1]["cumtime"])
+
+    def test_unreadable_profiles(self):
+        login(self.app, self.admin)
+        self.app.get("/api/settings", headers={ "X-Profile": "1" })
+        # Profiles which another worker is still writing
+        with open(get_profile_files()[0], "rb") as file:
+            data = file.read()
+        for name, partial_data in [("empty.prof", b""), ("truncated.prof", data[:len(data) // 2])]:
+            with open(os.path.join(app.config["PROFILE_DIRECTORY"], name), "wb") as file:
+                file.write(partial_data)
+        num_profiles, hot_functions = get_hot_functions(limit=5)
+        self.assertEqual(num_profiles, 1)
+        self.assertEqual(len(hot_functions), 5)
+
+        self.assertEqual(self.app.get("/profiles?limit=x").status_code, 200)
+        response = self.app.get("/profiles?limit=0")
+        self.assertEqual(response.status_code, 200)
+
+class SeedLoadTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        db.create_all()
+        for i in range(12):
+            db.session.add(Puzzle(fen="", move_tree={}, is_atomic=True, lesson_id=1 + i % 5))
+        db.session.commit()
+
+    def tearDown(self):
+        clear_database()
+        db.session.remove()
+
+    def get_totals(self):
+        return (
+            db.session.query(db.func.count(PuzzleCompletion.id), db.func.sum(PuzzleCompletion.attempts)).one(),
+            db.session.query(db.func.sum(User.best_test_time)).scalar(),
+            LessonCompletion.query.count(),
+        )
+
+    def test_seed_load(self):
+        result = app.test_cli_runner().invoke(seed_load_command, ["--users", "30", "--completions", "205", "--seed", "1", "--chunk-size", "50"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(User.query.count(), 30)
+        self.assertEqual(Test.query.count(), 20)
+        self.assertEqual(PuzzleCompletion.query.count(), 200)
+        self.assertEqual(User.get_num_users(), 30)
+        self.assertEqual(User.query.filter(User.best_test_time!=None).count(), len({ test.user for test in Test.query }))
+        self.assertTrue(all(Test.query.get(test.id).is_complete() for test in Test.query))
+
+        # The totals match the completions
+        totals = sorted((row.user, row.lesson_id, row.num_puzzles) for row in LessonPerformance.query)
+        LessonPerformance.rebuild()
+        self.assertEqual(sorted((row.user, row.lesson_id, row.num_puzzles) for row in LessonPerformance.query), totals)
+
+        # The same seed generates the same data
+        totals = self.get_totals()
+        clear_database()
+        for i in range(12):
+            db.session.add(Puzzle(fen="", move_tree={}, is_atomic=True, lesson_id=1 + i % 5))
+        db.session.commit()
+        app.test_cli_runner().invoke(seed_load_command, ["--users", "30", "--completions", "205", "--seed", "1"])
+        self.assertEqual(self.get_totals(), totals)
+
+    def test_requires_puzzles(self):
+        clear_database()
+        result = app.test_cli_runner().invoke(seed_load_command, ["--users", "1"])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertEqual(User.query.count(), 0)
+
+class SeedPuzzlesTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        db.create_all()
+        self.version, self.puzzles = load_puzzle_corpus()
+        create_user("Admin", "password", chess_beginner=False, admin=True)
+
+    def tearDown(self):
+        clear_database()
+        db.session.remove()
+
+    def get_puzzles(self):
+        return sorted((puzzle.id, puzzle.content_hash, puzzle.lesson_id, puzzle.is_atomic) for puzzle in Puzzle.query)
+
+    def test_corpus(self):
+        self.assertEqual(self.version, 1)
+        self.assertTrue({ puzzle["lesson_id"] for puzzle in self.puzzles } <= set(LESSONS_BY_ID))
+        self.assertEqual(len(self.puzzles), len({ Puzzle.compute_content_hash(puzzle["fen"], puzzle["move_tree"]) for puzzle in self.puzzles }))
+
+    def test_idempotent(self):
+        self.assertEqual(seed_puzzles(self.puzzles, chunk_size=10), (len(self.puzzles), 0, 0))
+        puzzles = self.get_puzzles()
+        self.assertEqual(seed_puzzles(self.puzzles), (0, 0, len(self.puzzles)))
+        self.assertEqual(self.get_puzzles(), puzzles)
+
+        # The hash of seeded puzzles is the same as puzzles added through the ORM
+        puzzle = Puzzle.query.first()
+        self.assertEqual(puzzle.content_hash, Puzzle.compute_content_hash(puzzle.fen, puzzle.move_tree))
+
+    def test_diff(self):
+        seed_puzzles(self.puzzles)
+        user_id = User.query.first().id
+        puzzle_id = Puzzle.query.first().id
+        test = Test(user=user_id, start_time=datetime.datetime.now(), puzzle_plan=[puzzle_id])
+        db.session.add(test)
+        db.session.commit()
+        db.session.add(PuzzleCompletion(user=user_id, puzzle_id=puzzle_id, attempts=1, start_time=datetime.datetime.now(), end_time=datetime.datetime.now(), test_number=test.id))
+        db.session.commit()
+
+        # Change the lesson of one puzzle, replace another with a new puzzle and add a duplicate
+        puzzles = [dict(puzzle) for puzzle in self.puzzles]
+        puzzles[0]["lesson_id"] = 2
+        removed = puzzles.pop()
+        puzzles.append({ **removed, "fen": "8/8/8/8/8/8/8/K6k w - - 0 1" })
+        puzzles.append(dict(puzzles[1]))
+        self.assertEqual(seed_puzzles(puzzles), (1, 1, len(puzzles) - 2))
+
+        self.assertEqual(Puzzle.query.count(), len(self.puzzles) + 1)
+        self.assertEqual(Puzzle.query.filter_by(content_hash=Puzzle.compute_content_hash(puzzles[0]["fen"], puzzles[0]["move_tree"])).one().lesson_id, 2)
+        # Puzzles that left the corpus and completions are kept
+        self.assertEqual(Puzzle.query.filter_by(content_hash=Puzzle.compute_content_hash(removed["fen"], removed["move_tree"])).count(), 1)
+        self.assertEqual(PuzzleCompletion.query.count(), 1)
+
+    def test_init_db(self):
+        result = app.test_cli_runner().invoke(init_db)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(Puzzle.query.count(), len(self.puzzles))
+        result = app.test_cli_runner().invoke(init_db)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("0 added, 0 updated, {} unchanged".format(len(self.puzzles)), result.output)
+        self.assertEqual(Puzzle.query.count(), len(self.puzzles))
+        self.assertEqual(User.query.count(), 1)
+
+class MoveTreeStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        db.create_all()
+
+    def tearDown(self):
+        clear_database()
+        db.session.remove()
+
+    def test_packing(self):
+        move_tree = create_move_tree_from_string("h3h4 (f4e3 h4h5 g7g8q) (f4e4 h4h5) (e2e1n)")
+        data = encode_move_tree(move_tree)
+        # Header and 3 bytes per node
+        self.assertEqual(len(data), 2 + 3 * 7)
+        self.assertEqual(decode_move_tree(data), move_tree)
+        for puzzle in load_puzzle_corpus()[1]:
+            self.assertEqual(decode_move_tree(encode_move_tree(puzzle["move_tree"])), puzzle["move_tree"])
+
+    def test_json_fallback(self):
+        # Trees which can't be packed losslessly are kept as JSON
+        for move_tree in [{}, [], [{ "move": { "move": create_move(0, 1), "animate": True } }], [{ "move": create_move(0, 1), "continuation": [] }],
+                          [{ "move": create_move(0, 1), "continuation": None }], [{ "move": create_move(0, 64) }]]:
+            self.assertEqual(decode_move_tree(encode_move_tree(move_tree)), move_tree)
+        self.assertEqual(encode_move_tree({}), b"{}")
+
+    def test_lazy_decoding(self):
+        move_tree = create_move_tree_from_string("e2e4 (e7e5) (c7c5)")
+        puzzle = Puzzle(fen="", move_tree=move_tree, is_atomic=True, lesson_id=1)
+        db.session.add(puzzle)
+        db.session.commit()
+        puzzle_id = puzzle.id
+        db.session.remove()
+
+        puzzle = Puzzle.query.get(puzzle_id)
+        self.assertIsNone(getattr(puzzle, "_move_tree_cache", None))
+        self.assertEqual(puzzle.to_json()["move_tree"], move_tree)
+        self.assertIs(puzzle.move_tree, puzzle.move_tree)
+        self.assertEqual(puzzle.content_hash, Puzzle.compute_content_hash("", move_tree))
+
+        puzzle.move_tree = move_tree[:1]
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(Puzzle.query.get(puzzle_id).move_tree, move_tree[:1])
+
+class EngineTestCase(unittest.TestCase):
+    """ The expected values are the ones tests/test.js checks the JS chess library with """
+    def assert_perft(self, fen, counts, atomic=True):
+        position = Position.from_fen(fen, atomic)
+        for depth, count in enumerate(counts, 1):
+            self.assertEqual(perft(position, depth), count, "{} depth {}".format(fen, depth))
+        self.assertEqual(position.fen, " ".join(fen.split()[:4]))
+
+    def test_atomic_perft(self):
+        self.assert_perft("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -", [20, 400, 8902])
+        self.assert_perft("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq -", [48, 1939])
+        self.assert_perft("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - -", [14, 203, 2784])
+        self.assert_perft("rnb1kbnr/2P5/8/8/8/8/PP1PPPPP/RNBQKBNR w KQkq - 0 1", [25, 775])
+
+    def test_classical_perft(self):
+        self.assert_perft("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -", [20, 400, 8902], atomic=False)
+        self.assert_perft("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq -", [48, 2039], atomic=False)
+        self.assert_perft("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", [6, 264], atomic=False)
+        self.assert_perft("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", [44, 1486], atomic=False)
+
+    def test_result(self):
+        self.assertEqual(Position.from_fen("rnb1kbnr/pppp1ppp/4p3/8/5PPq/8/PPPPP2P/RNBQKBNR w KQkq - 1 3", atomic=False).result(), BLACK_WIN)
+        self.assertEqual(Position.from_fen("r1bqkbnr/ppp2Qpp/2np4/4p3/2B1P3/8/PPPP1PPP/RNB1K1NR b KQkq - 0 4", atomic=False).result(), WHITE_WIN)
+        self.assertEqual(Position.from_fen("4k3/8/8/7b/8/6q1/8/7K w - - 4 3", atomic=False).result(), DRAW)
+        self.assertEqual(Position.from_fen("8/3k4/8/4K3/8/8/8/8 w - - 1 2", atomic=False).result(), DRAW)
+        self.assertEqual(Position.from_fen("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1").result(), VALID)
+
+        # Capturing next to the king explodes it
+        position = Position.from_fen("rnbqkbnr/pppp2pp/5p2/4P3/8/8/PPP1PPPP/RNBQKBNR w KQkq - 0 3")
+        position.make_move(move_from_string("d1d7"))
+        self.assertEqual(position.king_square(BLACK), -1)
+        self.assertIsNone(position.piece_at(move_from_string("d1d7") >> 6))
+        self.assertEqual(position.result(), WHITE_WIN)
+        position.unmake_move()
+        self.assertEqual(position.fen, "rnbqkbnr/pppp2pp/5p2/4P3/8/8/PPP1PPPP/RNBQKBNR w KQkq -")
+
+    def test_atomic_rules(self):
+        # Kings can't capture
+        fen = "8/8/8/8/8/8/3p4/4K2k w - -"
+        self.assertNotIn(move_from_string("e1d2"), Position.from_fen(fen).legal_moves())
+        self.assertIn(move_from_string("e1d2"), Position.from_fen(fen, atomic=False).legal_moves())
+
+        # Touching kings can't be attacked, the rook capture would explode both kings
+        self.assertFalse(Position.from_fen("8/8/8/R3k3/4K3/8/8/8 b - -").in_check)
+        position = Position.from_fen("8/8/R7/4k3/4K3/8/8/8 b - -")
+        self.assertIn(move_from_string("e5f5"), position.legal_moves())
+        self.assertNotIn(move_from_string("e5e6"), position.legal_moves())
+
+        # Captures next to our own king are illegal, the explosion of a capture removes pieces but not pawns
+        position = Position.from_fen("4k3/8/8/8/8/2p5/1pn5/1KR5 w - -")
+        self.assertNotIn(move_from_string("c1c2"), position.legal_moves())
+        position = Position.from_fen("4k3/8/8/8/2n5/1pp5/2r5/K1R5 w - -")
+        position.make_move(move_from_string("c1c2"))
+        self.assertEqual(position.fen, "4k3/8/8/8/2n5/1pp5/8/K7 b - -")
+
+        # Castling through an attacked square or with an enemy pawn in front of the king's path is illegal
+        position = Position.from_fen("r3k2r/8/8/8/8/8/8/R3K2R w KQkq -")
+        self.assertIn(move_from_string("e1g1"), position.legal_moves())
+        position.make_move(move_from_string("e1g1"))
+        self.assertEqual(position.fen, "r3k2r/8/8/8/8/8/8/R4RK1 b kq -")
+        self.assertNotIn(move_from_string("e1g1"), Position.from_fen("r3k2r/8/8/8/8/8/6p1/R3K2R w KQkq -").legal_moves())
+        self.assertNotIn(move_from_string("e1c1"), Position.from_fen("r2rk3/8/8/8/8/8/8/R3K2R w KQ -").legal_moves())
+
+    def test_perft_suite(self):
+        # The reference counts of the perft suite were computed by the JS chess library (tests/perft.js)
+        for entry in load_perft_suite():
+            self.assert_perft(entry["fen"], entry["counts"][:2], entry["atomic"])
+
+    def test_parallel_perft(self):
+        fen = "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq -"
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(parallel_perft(executor, fen, True, 3), 88298)
+            self.assertEqual(parallel_perft(executor, fen, False, 2), 2039)
+        self.assertEqual(parallel_perft(None, fen, True, 2), 1939)
+
+class PuzzleVerificationTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        self.app = app.test_client()
+        db.create_all()
+        self.admin = create_user("Admin", "password1", chess_beginner=False, admin=True)
+        puzzle_index.clear()
+
+    def tearDown(self):
+        clear_database()
+        db.session.remove()
+
+    def test_verify_puzzle(self):
+        for puzzle in load_puzzle_corpus()[1]:
+            self.assertFalse(has_errors(verify_puzzle_record(puzzle)), puzzle["fen"])
+        self.assertEqual(verify_puzzle(EXPLODE_KING_FEN, create_move_tree_from_string("a7a6 d1d7"), True), [])
+        # Every branch is replayed, the first move is the opponent's and the player has a missing win after it
+        self.assertEqual(verify_puzzle(EXPLODE_KING_FEN, create_move_tree_from_string("a7a6 (a7a5) (e1e2 d1d7)"), True), [
+            (ISSUE_ERROR, "Illegal move a7a5 after a7a6"),
+            (ISSUE_ERROR, "Illegal move e1e2 after a7a6"),
+            (ISSUE_WARNING, "Winning move d1d7 is missing after a7a6"),
+        ])
+        # Capturing on d7 doesn't win in standard chess
+        self.assertEqual(verify_puzzle(EXPLODE_KING_FEN, create_move_tree_from_string("a7a6 d1d6"), False), [])
+        self.assertEqual(verify_puzzle("8/8/8/8/8/8/8/8 b - -", create_move_tree_from_string("a7a6"), True), [(ISSUE_ERROR, "Illegal move a7a6 in the puzzle position")])
+        self.assertTrue(has_errors(verify_puzzle("8/8/8/8/8/8/8 b - -", create_move_tree_from_string("a7a6"), True)))
+
+    def test_verify_puzzles(self):
+        records = list(enumerate(load_puzzle_corpus()[1]))
+        expected = [(key, puzzle, verify_puzzle_record(puzzle)) for key, puzzle in records]
+        self.assertEqual(list(verify_puzzles(records, processes=1)), expected)
+        self.assertEqual(list(verify_puzzles(records, processes=2, batch_size=10)), expected)
+
+    def test_create_puzzle(self):
+        login(self.app, self.admin)
+        puzzle = { "fen": EXPLODE_KING_FEN, "move_tree": create_move_tree_from_string("a7a6 d1d6"), "is_atomic": True, "lesson_id": 1 }
+        response = self.app.post("/api/puzzles", json=puzzle)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["warnings"], ["Winning move d1d7 is missing after a7a6"])
+
+        response = self.app.post("/api/puzzles", json={ **puzzle, "move_tree": create_move_tree_from_string("a7a6 d1d8") })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()["message"], "Illegal move d1d8 after a7a6")
+        self.assertEqual(self.app.post("/api/puzzles", json={ **puzzle, "fen": "" }).status_code, 400)
+        self.assertEqual(Puzzle.query.count(), 1)
+
+    def test_verify_command(self):
+        seed_puzzles(load_puzzle_corpus()[1])
+        db.session.add(Puzzle(fen=EXPLODE_KING_FEN, move_tree=create_move_tree_from_string("a7a6 d1d8"), is_atomic=True, lesson_id=1))
+        db.session.commit()
+        runner = app.test_cli_runner(mix_stderr=False)
+        result = runner.invoke(puzzles_cli, ["verify", "--processes", "2"])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Illegal move d1d8 after a7a6", result.stdout)
+        self.assertIn("Verified {} puzzles".format(Puzzle.query.count()), result.stderr)
+        self.assertIn(" 1 with errors", result.stderr)
+        result = runner.invoke(puzzles_cli, ["verify", "--lesson", "2"])
+        self.assertEqual(result.exit_code, 0, result.stderr)
+
+class PuzzleImportExportTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        db.create_all()
+        _, self.puzzles = load_puzzle_corpus()
+        seed_puzzles(self.puzzles)
+        self.directory = tempfile.mkdtemp()
+        self.runner = app.test_cli_runner(mix_stderr=False)
+
+    def tearDown(self):
+        clear_database()
+        db.session.remove()
+        shutil.rmtree(self.directory)
+
+    def get_hashes(self):
+        return sorted(content_hash for content_hash, in db.session.query(Puzzle.content_hash))
+
+    def test_move_tree_string(self):
+        move_tree = create_move_tree_from_string("h3h4 (f4e3 h4h5) (f4e4 h4h5 g7g8q)")
+        self.assertEqual(move_tree, [{ "move": create_move_from_string("h3h4"), "continuation": [
+            { "move": create_move_from_string("f4e3"), "continuation": [{ "move": create_move_from_string("h4h5") }] },
+            { "move": create_move_from_string("f4e4"), "continuation": [{ "move": create_move_from_string("h4h5"), "continuation": [{ "move": create_move(54, 62, 4) }] }] },
+        ]}])
+        self.assertEqual(move_tree_to_string(move_tree), "h3h4 (f4e3 h4h5) (f4e4 h4h5 g7g8q)")
+        self.assertEqual(create_move_tree_from_string("e2e4 e7e5"), create_linear_move_tree([create_move_from_string("e2e4"), create_move_from_string("e7e5")]))
+        for string in ["e2e4 (e7e5", "e2e4 e7e5)", "e2e9"]:
+            self.assertRaises(ValueError, create_move_tree_from_string, string)
+
+    def test_validation(self):
+        puzzle = { "fen": "8/6Q1/8/8/5K2/7k/8/8 b - - 0 1", "move_tree": [{ "move": create_move_from_string("h3h4") }], "is_atomic": True, "lesson_id": 1 }
+        self.assertTrue(validate_puzzle_record(puzzle))
+        self.assertTrue(validate_puzzle_record({ **puzzle, "fen": "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3" }))
+        for fen in ["", "8/8/8/8/8/8/8 w - -", "9/8/8/8/8/8/8/8 w - -", "8/8/8/8/8/8/8/7x w - -", "8/8/8/8/8/8/8/8 x - -", "8/8/8/8/8/8/8/8 w - - 0"]:
+            self.assertFalse(validate_puzzle_record({ **puzzle, "fen": fen }), fen)
+        for move_tree in [[], {}, [{}], [{ "move": create_move(0, 64) }], [{ "move": create_move(0, 1, 5) }], [{ "move": create_move(0, 1), "continuation": [] }]]:
+            self.assertFalse(validate_puzzle_record({ **puzzle, "move_tree": move_tree }), move_tree)
+        self.assertFalse(validate_puzzle_record({ **puzzle, "lesson_id": 100 }))
+        self.assertFalse(validate_puzzle_record({ **puzzle, "is_atomic": 1 }))
+
+    def test_round_trip(self):
+        hashes = self.get_hashes()
+        for record_format in RECORD_FORMATS:
+            path = os.path.join(self.directory, "puzzles." + record_format)
+            result = self.runner.invoke(puzzles_cli, ["export", path, "--format", record_format])
+            self.assertEqual(result.exit_code, 0, result.stderr)
+            with open(path) as file:
+                self.assertEqual(sum(1 for _ in file), len(self.puzzles))
+
+            # Importing into the same database changes nothing
+            result = self.runner.invoke(puzzles_cli, ["import", path])
+            self.assertIn("0 added, 0 updated, {} unchanged, 0 invalid".format(len(self.puzzles)), result.stderr)
+
+            db.session.execute(Puzzle.__table__.delete())
+            db.session.commit()
+            result = self.runner.invoke(puzzles_cli, ["import", path, "--chunk-size", "10"])
+            self.assertEqual(result.exit_code, 0, result.stderr)
+            self.assertEqual(self.get_hashes(), hashes)
+
+    def test_invalid_records(self):
+        path = os.path.join(self.directory, "puzzles.ndjson")
+        with open(path, "w") as file:
+            file.write('{ "fen": "" }\nnot json\n\n')
+            file.write(format_ndjson_record({ **self.puzzles[0], "fen": "8/8/8/8/8/8/8/K6k w - -" }) + "\n")
+            file.write(format_ndjson_record({ **self.puzzles[0], "fen": EXPLODE_KING_FEN, "move_tree": create_move_tree_from_string("a7a6 d1d7") }) + "\n")
+            file.write(format_ndjson_record({ **self.puzzles[0], "fen": EXPLODE_KING_FEN, "move_tree": create_move_tree_from_string("a7a6 d1d6") }) + "\n")
+        for processes in ["1", "2"]:
+            clear_database()
+            seed_puzzles(self.puzzles)
+            result = self.runner.invoke(puzzles_cli, ["import", path, "--processes", processes])
+            self.assertEqual(result.exit_code, 0, result.stderr)
+            self.assertIn("Line 1: Invalid puzzle", result.stderr)
+            self.assertIn("Line 2: ", result.stderr)
+            # The moves of the puzzle can't be played from the FEN
+            self.assertIn("Line 4: Illegal move d7d5 in the puzzle position", result.stderr)
+            # Puzzles which are playable but miss a winning move are imported with a warning
+            self.assertIn("Line 6: warning: Winning move d1d7 is missing after a7a6", result.stderr)
+            self.assertIn("2 added, 0 updated, 0 unchanged, 3 invalid, 1 with warnings", result.stderr)
+            self.assertEqual(Puzzle.query.count(), len(self.puzzles) + 2)
+
+        # Unverified imports only check the records
+        clear_database()
+        result = self.runner.invoke(puzzles_cli, ["import", path, "--no-verify"])
+        self.assertIn("3 added, 0 updated, 0 unchanged, 2 invalid, 0 with warnings", result.stderr)
+
+class UserCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        self.app = app.test_client()
+        db.create_all()
+
+        self.user = create_user("Test", "password1", chess_beginner=True)
+        user_cache.clear()
+
+    def tearDown(self):
+        app.config["USER_CACHE_SIZE"] = 10000
+        clear_database()
+        db.session.remove()
+
+    def get_statements(self, url, **kwargs):
+        """ Makes a GET request and returns the response and the SQL statements it executed """
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        sqlalchemy.event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            response = self.app.get(url, **kwargs)
+        finally:
+            sqlalchemy.event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+        return response, statements
+
+    def test_no_user_queries(self):
+        self.assertEqual(self.app.get("/api/settings").status_code, 401)
+        login(self.app, self.user)
+        hits, misses = user_cache.hits, user_cache.misses
+        response, statements = self.get_statements("/api/settings")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(user_cache.misses, misses + 1)
+
+        response, statements = self.get_statements("/api/settings")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(statements, [])
+        response, statements = self.get_statements("/api/lessons/1")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any("FROM user" in statement for statement in statements))
+        self.assertEqual(user_cache.hits, hits + 2)
+
+    def test_settings_invalidation(self):
+        login(self.app, self.user)
+        self.assertEqual(self.app.get("/api/settings").get_json()["settings"]["animation_time_ms"], 300)
+        self.app.post("/api/settings", json={ "animation_time_ms": 100 })
+        self.assertEqual(self.app.get("/api/settings").get_json()["settings"]["animation_time_ms"], 100)
+
+    def test_eviction(self):
+        app.config["USER_CACHE_SIZE"] = 1
+        user = create_user("Test2", "password1", chess_beginner=True)
+        misses = user_cache.misses
+        self.assertEqual(user_cache.get(self.user.id).username, "Test")
+        self.assertEqual(user_cache.get(user.id).username, "Test2")
+        self.assertEqual(user_cache.get(self.user.id).username, "Test")
+        self.assertEqual(user_cache.misses, misses + 3)
+        self.assertIsNone(user_cache.get(user.id + 1))
+
+class TokenTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        self.app = app.test_client()
+        db.create_all()
+
+        self.user = create_user("Test", "password1", chess_beginner=True)
+        self.admin = create_user("Admin", "password1", chess_beginner=False, admin=True)
+
+    def tearDown(self):
+        app.config["API_TOKEN_MAX_AGE"] = 3600
+        clear_database()
+        db.session.remove()
+
+    def get_token(self, user):
+        client = app.test_client()
+        self.assertEqual(client.post("/api/tokens").status_code, 401)
+        login(client, user)
+        return client.post("/api/tokens").get_json()["token"]
+
+    def test_token_authentication(self):
+        token = self.get_token(self.user)
+        headers = { "Authorization": "Bearer " + token }
+        # The test client used here has no session
+        self.assertEqual(self.app.get("/api/settings").status_code, 401)
+        response = self.app.get("/api/settings", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["settings"]["animation_time_ms"], 300)
+        self.assertEqual(self.app.get("/api/lessons/1", headers=headers).status_code, 200)
+        # Tokens can't be used to issue new tokens
+        self.assertEqual(self.app.post("/api/tokens", headers=headers).status_code, 401)
+
+    def test_invalid_token(self):
+        token = self.get_token(self.user)
+        self.assertEqual(self.app.get("/api/settings", headers={ "Authorization": "Bearer " + token[:-2] }).status_code, 401)
+        self.assertEqual(self.app.get("/api/settings", headers={ "Authorization": "Bearer" }).status_code, 401)
+
+        app.config["API_TOKEN_MAX_AGE"] = -1
+        self.assertEqual(self.app.get("/api/settings", headers={ "Authorization": "Bearer " + token }).status_code, 401)
+
+    def test_admin_token(self):
+        user_headers = { "Authorization": "Bearer " + self.get_token(self.user) }
+        admin_headers = { "Authorization": "Bearer " + self.get_token(self.admin) }
+        self.assertEqual(self.app.post("/api/puzzles", json={}, headers=user_headers).status_code, 403)
+        self.assertNotIn(self.app.post("/api/puzzles", json={}, headers=admin_headers).status_code, (401, 403))
+
+    def test_deleted_user(self):
+        headers = { "Authorization": "Bearer " + self.get_token(self.user) }
+        db.session.delete(User.query.get(self.user.id))
+        db.session.commit()
+        # The token is still valid but its user no longer exists
+        self.assertEqual(self.app.get("/api/settings", headers=headers).status_code, 401)
+        self.assertEqual(self.app.post("/api/settings", json={ "animation_time_ms": 100 }, headers=headers).status_code, 401)
+
 if __name__ == "__main__":
     with app.app_context():
         unittest.main(verbosity=2)